@@ -0,0 +1,43 @@
+"""
+Motor client for the async (ASGI) views.
+
+A motor client is bound to the event loop it was created on, so one client
+is kept per running loop. Under an ASGI server that is one connection pool
+per worker process, shared by every request the worker is serving.
+"""
+import asyncio
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .metrics import MongoCommandListener
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        try:
+            from motor.motor_asyncio import AsyncIOMotorClient
+        except ImportError:
+            raise ImproperlyConfigured("The async views require the 'motor' package.")
+        client = AsyncIOMotorClient(
+            settings.MONGODB_HOST,
+            maxPoolSize=getattr(settings, "MONGODB_ASYNC_MAX_POOL_SIZE", 100),
+            io_loop=loop,
+            event_listeners=[MongoCommandListener()],
+        )
+        _clients[loop] = client
+    return client
+
+
+def get_database():
+    return get_client()[settings.MONGODB_NAME]
+
+
+def get_collection(document):
+    """ The motor collection backing a MongoEngine document class """
+    return get_database()[document._get_collection_name()]
@@ -0,0 +1,211 @@
+"""
+Async versions of the hot read paths, for deployment under ASGI
+(`e_commerce_api.asgi`).
+
+They return the same payloads as their `views.py` counterparts but query
+MongoDB through motor (`async_mongo`), so a slow query suspends the request
+instead of blocking the worker. Under WSGI each request would run in its own
+event loop and gain nothing, so keep serving the sync routes there.
+"""
+from asgiref.sync import sync_to_async
+from bson import ObjectId
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotAuthenticated, NotFound, PermissionDenied, Throttled
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from . import fieldsets
+from .async_mongo import get_collection, get_database
+from .caching import (
+    CATALOG,
+    CATEGORY_LIST,
+    PRODUCT_LIST,
+    aget_generations,
+    aresponse_cache_key_and_etag,
+    cart_tag,
+    entity_tag,
+    none_match,
+    product_tag,
+)
+from .cart_ops import as_cart_data
+from .fast_render import CATEGORY_ROWS, PRODUCT_ROWS
+from .filters import parse_product_filters
+from .jwt_auth import MongoDBJWTAuthentication
+from .models import Cart, Category, Product
+from .pagination import ProductKeysetPagination
+from .renderers import MongoJSONRenderer
+from .serializers import CartSerializer, CategorySerializer, ProductSerializer
+
+
+def catalog_cache_timeout():
+    return getattr(settings, "CATALOG_CACHE_TIMEOUT", 300)
+
+
+class AsyncAPIView(View):
+    """
+    The slice of `APIView` these endpoints need: JWT authentication, an
+    admin check, throttling, DRF-style error bodies and JSON rendering.
+    `throttle_scope` and `action` match the sync view, so both share a bucket.
+    Handlers set `self.etag` to send one and return (None, 304) when the
+    client's copy is current.
+    """
+    http_method_names = ["get"]
+    admin_only = False
+    throttle_scope = None
+    action = None
+    etag = None
+    authenticator = MongoDBJWTAuthentication()
+    renderer = MongoJSONRenderer()
+
+    async def dispatch(self, request, *args, **kwargs):
+        # Wrapping gives the DRF helpers reused here `query_params` and `user`.
+        request = Request(request, authenticators=())
+        try:
+            if request.method.lower() not in self.http_method_names:
+                return self.render({"detail": f'Method "{request.method}" not allowed.'}, status.HTTP_405_METHOD_NOT_ALLOWED)
+            await self.authenticate(request)
+            await self.check_throttles(request)
+            payload, status_code = await getattr(self, request.method.lower())(request, *args, **kwargs)
+        except APIException as exc:
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {"detail": exc.detail}
+            response = self.render(detail, exc.status_code)
+            if isinstance(exc, NotAuthenticated) or exc.status_code == status.HTTP_401_UNAUTHORIZED:
+                response["WWW-Authenticate"] = self.authenticator.authenticate_header(request)
+            if getattr(exc, "wait", None):
+                response["Retry-After"] = "%d" % exc.wait
+            return response
+        if status_code == status.HTTP_304_NOT_MODIFIED:
+            response = HttpResponse(status=status_code)
+        else:
+            response = self.render(payload, status_code)
+        if self.etag and status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response["ETag"] = self.etag
+        return response
+
+    async def authenticate(self, request):
+        result = await self.authenticator.aauthenticate(request)
+        user = result[0] if result else None
+        if user is None:
+            raise NotAuthenticated()
+        if self.admin_only and not user.is_admin:
+            raise PermissionDenied()
+        request.user = user
+
+    async def check_throttles(self, request):
+        waits = []
+        for throttle_class in api_settings.DEFAULT_THROTTLE_CLASSES:
+            throttle = throttle_class()
+            if not await sync_to_async(throttle.allow_request, thread_sensitive=False)(request, self):
+                waits.append(throttle.wait())
+        if waits:
+            raise Throttled(max((wait for wait in waits if wait is not None), default=None))
+
+    def render(self, data, status_code):
+        return HttpResponse(self.renderer.render(data), status=status_code, content_type="application/json")
+
+
+class AsyncProductListView(AsyncAPIView):
+    throttle_scope = "products"
+    action = "list"
+    pagination_class = ProductKeysetPagination
+
+    async def get(self, request):
+        converter = PRODUCT_ROWS.subset(fieldsets.parse(request.query_params, ProductSerializer))
+        key, self.etag = await aresponse_cache_key_and_etag("product:async-list", [PRODUCT_LIST, CATALOG], request)
+        if none_match(request, self.etag):
+            return None, status.HTTP_304_NOT_MODIFIED
+        data = await cache.aget(key)
+        if data is not None:
+            return data, status.HTTP_200_OK
+
+        category, min_price, max_price = parse_product_filters(request.query_params)
+        query = {}
+        if category:
+            query["category"] = category
+        price = {}
+        if min_price is not None:
+            price["$gte"] = float(min_price)
+        if max_price is not None:
+            price["$lte"] = float(max_price)
+        if price:
+            query["price"] = price
+
+        paginator = self.pagination_class()
+        query, sort, limit = paginator.get_raw_query(request, query)
+        projection = {field: 1 for field in (*converter.fields, *paginator.get_sort_fields(request))} or {"_id": 1}
+        cursor = get_collection(Product).find(query, projection)
+        page = paginator.set_page(await cursor.sort(sort).limit(limit).to_list(length=limit))
+
+        data = {
+            "next": paginator.get_next_link(),
+            "results": await converter.aconvert(page, get_database()),
+        }
+        await cache.aset(key, data, timeout=catalog_cache_timeout())
+        return data, status.HTTP_200_OK
+
+
+class AsyncProductDetailView(AsyncAPIView):
+    throttle_scope = "products"
+    action = "retrieve"
+
+    async def get(self, request, id):
+        converter = PRODUCT_ROWS.subset(fieldsets.parse(request.query_params, ProductSerializer))
+        key, self.etag = await aresponse_cache_key_and_etag(
+            "product:async-retrieve", [product_tag(id), CATALOG], request, detail=True
+        )
+        if none_match(request, self.etag):
+            return None, status.HTTP_304_NOT_MODIFIED
+        data = await cache.aget(key)
+        if data is not None:
+            return data, status.HTTP_200_OK
+
+        if not ObjectId.is_valid(id):
+            raise NotFound()
+        doc = await get_collection(Product).find_one(
+            {"_id": ObjectId(id)}, {field: 1 for field in converter.fields} or {"_id": 1}
+        )
+        if doc is None:
+            raise NotFound()
+
+        data = (await converter.aconvert([doc], get_database()))[0]
+        await cache.aset(key, data, timeout=catalog_cache_timeout())
+        return data, status.HTTP_200_OK
+
+
+class AsyncCategoryListView(AsyncAPIView):
+    admin_only = True
+    throttle_scope = "categories"
+    action = "list"
+
+    async def get(self, request):
+        converter = CATEGORY_ROWS.subset(fieldsets.parse(request.query_params, CategorySerializer))
+        key, self.etag = await aresponse_cache_key_and_etag("category:async-list", [CATEGORY_LIST], request)
+        if none_match(request, self.etag):
+            return None, status.HTTP_304_NOT_MODIFIED
+        data = await cache.aget(key)
+        if data is not None:
+            return data, status.HTTP_200_OK
+
+        # Unpaginated, like CategoryViewSet.list.
+        cursor = get_collection(Category).find({"deleted_at": None}, {field: 1 for field in converter.fields} or {"_id": 1})
+        data = await converter.aconvert(await cursor.to_list(length=None), get_database())
+        await cache.aset(key, data, timeout=catalog_cache_timeout())
+        return data, status.HTTP_200_OK
+
+
+class AsyncCartView(AsyncAPIView):
+    throttle_scope = "cart"
+
+    async def get(self, request):
+        fields = fieldsets.parse(request.query_params, CartSerializer)
+        self.etag = entity_tag(await aget_generations([cart_tag(request.user.id)]), request, detail=True)
+        if none_match(request, self.etag):
+            return None, status.HTTP_304_NOT_MODIFIED
+        cart = await get_collection(Cart).find_one({"user": ObjectId(request.user.id)}, fieldsets.projection(CartSerializer, fields))
+        if not cart:
+            return {"message": "Cart is empty."}, status.HTTP_404_NOT_FOUND
+        return fieldsets.serializer_for(CartSerializer, fields)(as_cart_data(cart)).data, status.HTTP_200_OK
@@ -0,0 +1,542 @@
+"""
+Helpers shared by the benchmark management commands: an optional in-memory
+MongoDB (mongomock) and Redis (fakeredis), synthetic data, timing, and the
+endpoint harness behind `bench_endpoints` and the query budget tests.
+"""
+import json
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import mongoengine
+from bson import ObjectId
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import CommandError
+
+from . import metrics
+from .cart_ops import SNAPSHOT_PROJECTION, snapshot_fields
+from .models import Cart, Category, CategoryDeletion, Coupon, Order, OutboxEvent, Product, SalesRollup, TaskCheckpoint, User
+
+DOCUMENTS = [User, Category, Product, Cart, Order, Coupon, TaskCheckpoint, OutboxEvent, SalesRollup, CategoryDeletion]
+
+
+def use_mongomock(db="bench_db"):
+    """ Point every document at a fresh in-memory database """
+    try:
+        import mongomock
+    except ImportError:
+        raise CommandError("mongomock is not installed; run against a local mongod instead (pip install mongomock).")
+    mongoengine.disconnect()
+    mongoengine.connect(db, host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+    _forget_collections()
+
+
+def use_mongod(url, db="bench_db"):
+    """ Point every document at `db` on a real server, emptied first """
+    mongoengine.disconnect()
+    mongoengine.connect(db, host=url, event_listeners=[metrics.MongoCommandListener()])
+    _forget_collections()
+    for document in DOCUMENTS:
+        document.drop_collection()
+        document.ensure_indexes()
+
+
+def _forget_collections():
+    """ Drop the collection handles cached from the previous connection """
+    for document in DOCUMENTS:
+        document._collection = None
+    # Viewsets build their class-level queryset (and its collection) at import.
+    views = sys.modules.get("api.views")
+    for view in vars(views).values() if views else ():
+        queryset = getattr(view, "queryset", None) if isinstance(view, type) else None
+        if isinstance(queryset, mongoengine.QuerySet):
+            view.queryset = queryset._document.objects
+
+
+def fakeredis_caches():
+    """ A CACHES setting whose Redis is fakeredis, for `override_settings` """
+    try:
+        from fakeredis import FakeConnection
+    except ImportError:
+        raise CommandError("fakeredis is not installed (pip install fakeredis lupa).")
+    return {
+        "default": {
+            "BACKEND": "api.cache_backends.RedisCache",
+            "LOCATION": "redis://fakeredis:6379/0",
+            "OPTIONS": {"CONNECTION_POOL_KWARGS": {"connection_class": FakeConnection}},
+        }
+    }
+
+
+# mongomock method -> the wire command a real driver would send for it.
+MONGOMOCK_COMMANDS = {
+    "find": "find", "find_one": "find", "aggregate": "aggregate", "distinct": "distinct",
+    "count_documents": "aggregate", "estimated_document_count": "count",
+    "find_one_and_update": "findAndModify", "find_one_and_replace": "findAndModify",
+    "find_one_and_delete": "findAndModify", "insert_one": "insert", "insert_many": "insert",
+    "update_one": "update", "update_many": "update", "replace_one": "update",
+    "delete_one": "delete", "delete_many": "delete", "bulk_write": "bulkWrite",
+}
+
+
+class count_mongomock_commands:
+    """
+    mongomock never talks to a server, so pymongo's command listeners stay
+    silent. While active, this reports each outermost collection call to
+    the metrics listener as the command a driver would have sent.
+    """
+
+    def __enter__(self):
+        import mongomock
+        self.collection_class = mongomock.collection.Collection
+        self.originals = {name: getattr(self.collection_class, name) for name in MONGOMOCK_COMMANDS}
+        listener = metrics.MongoCommandListener()
+        depth = threading.local()
+
+        def wrap(method, command_name):
+            def counted(collection, *args, **kwargs):
+                if getattr(depth, "value", 0):
+                    return method(collection, *args, **kwargs)
+                depth.value = 1
+                started = time.perf_counter()
+                try:
+                    listener.started(_Event(command_name, {command_name: collection.name}))
+                    return method(collection, *args, **kwargs)
+                finally:
+                    depth.value = 0
+                    listener.succeeded(_Event(command_name, None, int((time.perf_counter() - started) * 1e6)))
+            return counted
+
+        for name, method in self.originals.items():
+            setattr(self.collection_class, name, wrap(method, MONGOMOCK_COMMANDS[name]))
+        return self
+
+    def __exit__(self, *exc):
+        for name, method in self.originals.items():
+            setattr(self.collection_class, name, method)
+
+
+class _Event:
+    __slots__ = ("command_name", "command", "duration_micros")
+
+    def __init__(self, command_name, command, duration_micros=0):
+        self.command_name = command_name
+        self.command = command
+        self.duration_micros = duration_micros
+
+
+def seed_catalog(products, categories=20, seed=0, batch_size=5000):
+    """ Insert `categories` categories and `products` products; returns category ids """
+    rng = random.Random(seed)
+    category_ids = Category._get_collection().insert_many([
+        {"name": f"Bench category {i}", "description": f"Synthetic category {i}"}
+        for i in range(categories)
+    ]).inserted_ids
+
+    collection = Product._get_collection()
+    for start in range(0, products, batch_size):
+        collection.insert_many([
+            {
+                "name": f"Bench product {i}",
+                "description": f"Synthetic product {i} for benchmarking",
+                "category": rng.choice(category_ids),
+                "price": float(Decimal(rng.randint(100, 100000)) / 100),
+                "stock": rng.randint(0, 500),
+                "images": [f"https://cdn.example.com/products/{i}/{n}.jpg" for n in range(3)],
+            }
+            for i in range(start, min(start + batch_size, products))
+        ])
+    return category_ids
+
+
+def seed_users(count, password="bench-password"):
+    """ Insert `count` users and one admin; returns (user ids, admin id) """
+    hashed = make_password(password)  # hashing is slow; every user shares one
+    users = User._get_collection()
+    admin_id = users.insert_one({"email": "bench-admin@example.com", "password": hashed, "is_admin": True}).inserted_id
+    user_ids = users.insert_many([
+        {"email": f"bench-user{i}@example.com", "password": hashed, "is_admin": False} for i in range(count)
+    ]).inserted_ids
+    return user_ids, admin_id
+
+
+def seed_carts(user_ids, product_ids, lines=3, seed=0):
+    """ Give every user a cart of `lines` distinct products """
+    rng = random.Random(seed)
+    snapshots = {
+        doc["_id"]: snapshot_fields(doc)
+        for doc in Product._get_collection().find({"_id": {"$in": list(product_ids)}}, SNAPSHOT_PROJECTION)
+    }
+    carts = []
+    for user_id in user_ids:
+        items = [dict(snapshots[product_id], quantity=rng.randint(1, 3)) for product_id in rng.sample(list(snapshots), lines)]
+        carts.append({"user": user_id, "items": items, "subtotal": round(sum(i["quantity"] * i["price"] for i in items), 2)})
+    if carts:
+        Cart._get_collection().insert_many(carts)
+
+
+def seed_orders(user_ids, product_ids, per_user=5, days=30, seed=0, batch_size=5000):
+    """ Insert `per_user` orders per user, spread over the last `days` days """
+    rng = random.Random(seed)
+    prices = {doc["_id"]: doc["price"] for doc in Product._get_collection().find({"_id": {"$in": list(product_ids)}}, {"price": 1})}
+    now = datetime.utcnow()
+    orders = []
+    for user_id in user_ids:
+        for _ in range(per_user):
+            created = now - timedelta(seconds=rng.randint(0, days * 86400))
+            items = [
+                {"product": product_id, "quantity": rng.randint(1, 3), "price": prices[product_id]}
+                for product_id in rng.sample(list(prices), rng.randint(1, 4))
+            ]
+            orders.append({
+                "user": user_id, "items": items, "status": "Pending",
+                "total_price": round(sum(i["quantity"] * i["price"] for i in items), 2),
+                "created_at": created, "updated_at": created, "status_changed_at": created,
+            })
+    collection = Order._get_collection()
+    for start in range(0, len(orders), batch_size):
+        collection.insert_many(orders[start:start + batch_size])
+
+
+def best_of(fn, repeat):
+    """ Run `fn` `repeat` times; return (best wall time in seconds, last result) """
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of `values` (0 < pct <= 100) """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+class BenchData:
+    """ What `seed` inserted, for the endpoints to build requests from """
+
+    def __init__(self, user_ids, admin_id, product_ids, category_ids, coupon_code):
+        self.user_ids = user_ids
+        self.admin_id = admin_id
+        self.product_ids = product_ids
+        self.category_ids = category_ids
+        self.coupon_code = coupon_code
+        self._headers = {}
+
+    def user(self, i):
+        return self.user_ids[i % len(self.user_ids)]
+
+    def product(self, i):
+        return self.product_ids[(i * 7919) % len(self.product_ids)]
+
+    def headers(self, user_id):
+        """ A Bearer header for `user_id`, minted as LoginView would """
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        from .user_cache import token_claims
+
+        header = self._headers.get(user_id)
+        if header is None:
+            user = User.objects.get(id=user_id)
+            refresh = RefreshToken.for_user(user)
+            for claim, value in token_claims(user).items():
+                refresh[claim] = value
+            header = self._headers[user_id] = {"HTTP_AUTHORIZATION": f"Bearer {refresh.access_token}"}
+        return header
+
+
+def seed(users=200, products=100_000, categories=20, cart_lines=3, orders_per_user=5):
+    """ Seed a realistic data set for `bench_endpoints`; returns `BenchData` """
+    category_ids = seed_catalog(products, categories)
+    product_ids = [doc["_id"] for doc in Product._get_collection().find({}, {"_id": 1})]
+    user_ids, admin_id = seed_users(users)
+    # Carts and orders draw from a hot subset, as real traffic does.
+    hot = random.Random(1).sample(product_ids, min(len(product_ids), 1000))
+    seed_carts(user_ids, hot, lines=min(cart_lines, len(hot)))
+    seed_orders(user_ids, hot, per_user=orders_per_user)
+    coupon_code = "BENCH10"
+    Coupon._get_collection().insert_one({
+        "code": coupon_code, "discount_percentage": 10, "expiry_date": datetime.utcnow() + timedelta(days=365),
+        "usage_limit": 10 ** 9, "used_count": 0,
+    })
+    return BenchData(user_ids, admin_id, product_ids, category_ids, coupon_code)
+
+
+# Changes per "order status bulk" request; its query budget must not depend on it.
+BULK_BATCH = 50
+
+
+def _fresh_order(data, i):
+    now = datetime.utcnow()
+    product_id = data.product(i)
+    return Order._get_collection().insert_one({
+        "user": data.user(i), "items": [{"product": product_id, "quantity": 1, "price": 10.0}], "status": "Pending",
+        "total_price": 10.0, "created_at": now, "updated_at": now, "status_changed_at": now,
+    }).inserted_id
+
+
+def _stocked_cart(data, i):
+    from . import cart_ops
+
+    product_id = data.product(i)
+    Product._get_collection().update_one({"_id": product_id}, {"$set": {"stock": 10 ** 6}})
+    cart_ops.clear(data.user(i))
+    cart_ops.add_item(data.user(i), cart_ops.product_snapshot(product_id), 1)
+
+
+def _checkout(data, i):
+    _stocked_cart(data, i)
+    return "/api/order/", None
+
+
+def _cart_with_item(data, i):
+    from . import cart_ops
+
+    product_id = data.product(i)
+    cart_ops.add_item(data.user(i), cart_ops.product_snapshot(product_id), 1)
+    return product_id
+
+
+def _doomed_category(data, i, products=10):
+    category_id = Category._get_collection().insert_one({"name": f"bench-doomed-{ObjectId()}"}).inserted_id
+    Product._get_collection().insert_many([
+        {"name": f"bench-doomed-{category_id}-{n}", "category": category_id, "price": 10.0, "stock": 1}
+        for n in range(products)
+    ])
+    return f"/api/categories/{category_id}/", None
+
+
+class Endpoint:
+    """
+    One request shape to drive. `build(data, i)` does any per-request setup
+    (untimed) and returns (path, body) for the i-th request, sent as a
+    regular user, the admin, or (`auth=None`) anonymously.
+    """
+
+    def __init__(self, name, method, view, build, auth="user", expect=200, needs_server=False):
+        self.name = name
+        self.method = method
+        self.view = view
+        self.build = build
+        self.auth = auth
+        self.expect = expect
+        # mongomock lacks what this endpoint needs ($text, $mul in findAndModify).
+        self.needs_server = needs_server
+
+
+ENDPOINTS = [
+    Endpoint("product list", "GET", "product-list", lambda data, i: ("/api/products/", None)),
+    Endpoint(
+        "product list filtered", "GET", "product-list",
+        lambda data, i: (f"/api/products/?category={data.category_ids[i % len(data.category_ids)]}&min_price=10&ordering=price", None),
+    ),
+    Endpoint("product detail", "GET", "product-detail", lambda data, i: (f"/api/products/{data.product(i)}/", None)),
+    Endpoint("product search", "GET", "product-search", lambda data, i: ("/api/products/search/?q=synthetic", None), needs_server=True),
+    Endpoint("category list", "GET", "category-list", lambda data, i: ("/api/categories/", None), auth="admin"),
+    Endpoint(
+        "category detail", "GET", "category-detail",
+        lambda data, i: (f"/api/categories/{data.category_ids[i % len(data.category_ids)]}/", None), auth="admin",
+    ),
+    # Only the tombstone and the job; the purge itself is queued.
+    Endpoint("category delete", "DELETE", "category-detail", _doomed_category, auth="admin", expect=202),
+    Endpoint("cart", "GET", "cart", lambda data, i: ("/api/cart/", None)),
+    Endpoint("cart add item", "POST", "cart-item-delete", lambda data, i: ("/api/cart/item/", {"product": str(data.product(i)), "quantity": 1})),
+    Endpoint(
+        "cart remove item", "DELETE", "cart-item-delete",
+        lambda data, i: ("/api/cart/item/", {"product_id": str(_cart_with_item(data, i))}),
+    ),
+    Endpoint("checkout", "POST", "order-create", _checkout, expect=201),
+    Endpoint(
+        "order status bulk", "POST", "order-status-bulk",
+        lambda data, i: ("/api/order/status/bulk/", {"changes": [
+            {"order_id": str(_fresh_order(data, i * BULK_BATCH + n)), "status": "Cancelled" if n % 5 == 0 else "Shipped"}
+            for n in range(BULK_BATCH)
+        ]}),
+        auth="admin",
+    ),
+    Endpoint("order history", "GET", "order-list", lambda data, i: ("/api/orders/", None)),
+    Endpoint(
+        "order status", "POST", "order-status",
+        lambda data, i: ("/api/order/status/", {"order_id": str(_fresh_order(data, i)), "status": "Shipped"}), auth="admin",
+    ),
+    Endpoint(
+        "apply coupon", "POST", "apply-coupon",
+        lambda data, i: ("/api/order/apply-coupon/", {"code": data.coupon_code, "order_id": str(_fresh_order(data, i))}),
+        needs_server=True,
+    ),
+    Endpoint("analytics", "GET", "analytics", lambda data, i: ("/api/analytics/", None), auth="admin"),
+    Endpoint(
+        "login", "POST", "login",
+        lambda data, i: ("/api/login/", {"email": f"bench-user{i % len(data.user_ids)}@example.com", "password": "bench-password"}),
+        auth=None,
+    ),
+]
+
+# Most MongoDB commands one request to each endpoint may issue with every
+# cache cold (the user lookup included). Exceeding one means a new query
+# crept in; an N+1 shows up as a count that grows with the page or cart.
+QUERY_BUDGETS = {
+    "product list": 3,
+    "product list filtered": 3,
+    "product detail": 3,
+    "product search": 3,
+    "category list": 2,
+    "category detail": 2,
+    "category delete": 5,
+    "cart": 2,
+    "cart add item": 4,
+    "cart remove item": 3,
+    # One stock update per cart line without transactions; the bench cart has one.
+    "checkout": 10,
+    # The page and, when its generation moved, the summary aggregate.
+    "order history": 3,
+    "order status": 4,
+    # Independent of BULK_BATCH: the read, the outbox insert, the bulk_write,
+    # the outbox release and one rollup pass for the cancellations (whose
+    # write is one per hour the orders were placed in; two across an hour).
+    "order status bulk": 9,
+    "apply coupon": 5,
+    "analytics": 2,
+    "login": 1,
+}
+
+
+class EndpointResult:
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.latencies = []
+        self.commands = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.n_plus_one = 0
+        self.unexpected = {}
+
+    @property
+    def throughput(self):
+        return len(self.latencies) / sum(self.latencies) if self.latencies else 0.0
+
+    @property
+    def mean_commands(self):
+        return sum(self.commands) / len(self.commands) if self.commands else 0.0
+
+    @property
+    def hit_rate(self):
+        reads = self.cache_hits + self.cache_misses
+        return self.cache_hits / reads if reads else 0.0
+
+    def violations(self, budgets=QUERY_BUDGETS):
+        """ Why this endpoint fails its budget, if it does """
+        problems = []
+        budget = budgets.get(self.endpoint.name)
+        if budget is not None and self.commands and max(self.commands) > budget:
+            problems.append(f"{self.endpoint.name}: {max(self.commands)} MongoDB commands in one request (budget {budget})")
+        if self.n_plus_one:
+            problems.append(f"{self.endpoint.name}: {self.n_plus_one} requests repeated one read (likely N+1)")
+        for status_code, count in self.unexpected.items():
+            problems.append(f"{self.endpoint.name}: {count} responses with status {status_code} (expected {self.endpoint.expect})")
+        return problems
+
+
+def _view_totals(endpoint):
+    totals = metrics.snapshot().get((endpoint.view, endpoint.method))
+    if totals is None:
+        return 0, 0, 0, 0
+    return totals.mongo_commands, totals.cache_hits, totals.cache_misses, totals.n_plus_one
+
+
+def run_endpoint(client, endpoint, data, requests, cold=False):
+    """
+    Drive `requests` requests at `endpoint` through the Django test client.
+    `cold` clears the caches before each one, so every query is counted.
+    """
+    from django.core.cache import cache
+
+    from . import user_cache
+
+    result = EndpointResult(endpoint)
+    for i in range(requests):
+        path, body = endpoint.build(data, i)
+        headers = {}
+        if endpoint.auth:
+            headers = data.headers(data.admin_id if endpoint.auth == "admin" else data.user(i))
+        if cold:
+            cache.clear()
+            user_cache._local.clear()
+        before = _view_totals(endpoint)
+        started = time.perf_counter()
+        if endpoint.method == "GET":
+            response = client.get(path, **headers)
+        else:
+            response = client.generic(endpoint.method, path, json.dumps(body or {}), content_type="application/json", **headers)
+        result.latencies.append(time.perf_counter() - started)
+        commands, hits, misses, n_plus_one = (a - b for a, b in zip(_view_totals(endpoint), before))
+        result.commands.append(commands)
+        result.cache_hits += hits
+        result.cache_misses += misses
+        result.n_plus_one += n_plus_one
+        if response.status_code != endpoint.expect:
+            result.unexpected[response.status_code] = result.unexpected.get(response.status_code, 0) + 1
+    return result
+
+
+class queued_tasks:
+    """ Swap `delay` on the tasks views enqueue for a list, so no broker is needed """
+
+    def __enter__(self):
+        from . import tasks
+
+        self.tasks = [tasks.drain_outbox, tasks.refresh_cart_snapshots, tasks.send_order_status_emails, tasks.purge_category]
+        self.queued = []
+        for task in self.tasks:
+            task.delay = lambda *args, _name=task.name, **kwargs: self.queued.append(_name)
+        return self.queued
+
+    def __exit__(self, *exc):
+        for task in self.tasks:
+            del task.delay
+
+
+def bench_settings(caches=None):
+    """ Settings overrides for a benchmark run: throttles out of the way """
+    from django.conf import settings
+
+    rest_framework = dict(settings.REST_FRAMEWORK)
+    rest_framework["DEFAULT_THROTTLE_RATES"] = {
+        name: "1000000/second" for name in rest_framework.get("DEFAULT_THROTTLE_RATES", {})
+    }
+    overrides = {"REST_FRAMEWORK": rest_framework, "ALLOWED_HOSTS": ["testserver"]}
+    if caches is not None:
+        overrides["CACHES"] = caches
+    return overrides
+
+
+def run_endpoints(data, requests, cold=False, endpoints=None, server=False):
+    """
+    Run every endpoint in `endpoints` (default `ENDPOINTS`); returns their
+    `EndpointResult`s. `server` is False under mongomock, whose commands
+    are counted by wrapping it.
+    """
+    from contextlib import ExitStack
+
+    from django.test import Client
+
+    client = Client()
+    results = []
+    with ExitStack() as stack:
+        stack.enter_context(queued_tasks())
+        if not server:
+            stack.enter_context(count_mongomock_commands())
+        for endpoint in endpoints or ENDPOINTS:
+            if endpoint.needs_server and not server:
+                continue
+            results.append(run_endpoint(client, endpoint, data, requests, cold=cold))
+    return results
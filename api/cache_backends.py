@@ -0,0 +1,33 @@
+"""
+Cache backends that report hits and misses to the request's metrics
+(api/metrics.py). Drop-in replacements for the stock backends.
+"""
+from django.core.cache.backends.locmem import LocMemCache as BaseLocMemCache
+from django_redis.cache import RedisCache as BaseRedisCache
+
+from . import metrics
+
+_MISSING = object()
+
+
+class _CountedGetMixin:
+    def get(self, key, default=None, *args, **kwargs):
+        value = super().get(key, _MISSING, *args, **kwargs)
+        if value is _MISSING:
+            metrics.record_cache(0, 1)
+            return default
+        metrics.record_cache(1, 0)
+        return value
+
+
+class RedisCache(_CountedGetMixin, BaseRedisCache):
+
+    def get_many(self, keys, *args, **kwargs):
+        keys = list(keys)
+        found = super().get_many(keys, *args, **kwargs)
+        metrics.record_cache(len(found), len(keys) - len(found))
+        return found
+
+
+class LocMemCache(_CountedGetMixin, BaseLocMemCache):
+    """ `get_many` goes through `get` here, so it is already counted """
@@ -0,0 +1,254 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from .fieldsets import EXCLUDE_PARAM, FIELDS_PARAM
+
+# Generation tags. Every cached response is keyed by the current generation
+# of each tag it depends on, so bumping a tag orphans all of those entries
+# without having to find and delete them.
+PRODUCT_LIST = "product:list"
+CATEGORY_LIST = "category:list"
+# Product payloads embed the category name, so category writes bump this too.
+CATALOG = "catalog"
+
+
+# Query parameters selecting a representation of a detail resource (sparse
+# fieldsets, api/fieldsets.py).
+REPRESENTATION_PARAMS = (FIELDS_PARAM, EXCLUDE_PARAM)
+
+
+def product_tag(product_id):
+    return f"product:{product_id}"
+
+
+def category_tag(category_id):
+    return f"category:{category_id}"
+
+
+def cart_tag(user_id):
+    return f"cart:{user_id}"
+
+
+def orders_tag(user_id):
+    return f"orders:{user_id}"
+
+
+def _generation_key(tag):
+    return f"gen:{tag}"
+
+
+def _fresh_generation():
+    # Seed from the clock rather than 1 so that an evicted counter can never
+    # collide with a generation that still has live entries.
+    return int(time.time() * 1000)
+
+
+def get_generations(tags):
+    """ Return {tag: generation} for `tags` in one cache round trip """
+    keys = {_generation_key(tag): tag for tag in tags}
+    found = cache.get_many(list(keys))
+    generations = {}
+    for key, tag in keys.items():
+        if key not in found:
+            cache.add(key, _fresh_generation(), timeout=None)
+            found[key] = cache.get(key)
+        generations[tag] = found[key]
+    return generations
+
+
+async def aget_generations(tags):
+    keys = {_generation_key(tag): tag for tag in tags}
+    found = await cache.aget_many(list(keys))
+    generations = {}
+    for key, tag in keys.items():
+        if key not in found:
+            await cache.aadd(key, _fresh_generation(), timeout=None)
+            found[key] = await cache.aget(key)
+        generations[tag] = found[key]
+    return generations
+
+
+def bump(*tags):
+    """ Invalidate every cached entry that depends on any of `tags` """
+    for tag in tags:
+        key = _generation_key(tag)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_generation(), timeout=None)
+
+
+def claim(tag, generation):
+    """
+    Bump `tag` only if it is still at `generation`: False when another write
+    bumped it first. Lets a conditional write reserve the version it checked.
+    """
+    try:
+        return cache.incr(_generation_key(tag)) == generation + 1
+    except ValueError:
+        return False
+
+
+def invalidate_product(product_id):
+    bump(product_tag(product_id), PRODUCT_LIST)
+
+
+def invalidate_category(category_id):
+    bump(category_tag(category_id), CATEGORY_LIST, CATALOG)
+
+
+def invalidate_cart(user_id):
+    bump(cart_tag(user_id))
+
+
+def invalidate_orders(user_id):
+    bump(orders_tag(user_id))
+
+
+def user_role(user):
+    if not getattr(user, "is_authenticated", False):
+        return "anon"
+    return "admin" if getattr(user, "is_admin", False) else "user"
+
+
+def response_cache_key(prefix, tags, request):
+    """
+    Build a response key that varies by tag generations, user role, host,
+    path and (order-insensitive) query parameters.
+    """
+    return _response_key(prefix, get_generations(tags), request)
+
+
+async def aresponse_cache_key_and_etag(prefix, tags, request, detail=False):
+    """ The response cache key and `entity_tag`, from one read of the generations """
+    generations = await aget_generations(tags)
+    return _response_key(prefix, generations, request), entity_tag(generations, request, detail)
+
+
+def _response_key(prefix, generations, request):
+    params = sorted(request.query_params.lists())
+    material = repr((
+        sorted(generations.items()),
+        user_role(request.user),
+        request.get_host(),
+        request.path,
+        params,
+    ))
+    return f"resp:{prefix}:{hashlib.sha1(material.encode()).hexdigest()}"
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = "The resource has changed since it was fetched."
+    default_code = "precondition_failed"
+
+
+def entity_tag(generations, request, detail=False):
+    """
+    A strong ETag for the response built from data at `generations`. It
+    changes whenever any of those tags is bumped, so it can be checked
+    without reading the data. A `detail` resource is identified by its tags
+    alone, so writes (at other URLs, e.g. cart items) can check the ETag
+    its client got from a GET; a sparse fieldset of it gets the same ETag
+    with a `-<selection>` suffix, which `check_if_match` ignores.
+    """
+    renderer = getattr(request, "accepted_renderer", None)
+    material = [sorted(generations.items()), user_role(request.user), getattr(renderer, "format", "json")]
+    if not detail:
+        material += [request.path, sorted(request.query_params.lists())]
+    etag = hashlib.sha1(repr(material).encode()).hexdigest()
+    if detail:
+        selection = [(name, request.query_params.getlist(name)) for name in REPRESENTATION_PARAMS if name in request.query_params]
+        if selection:
+            etag += "-" + hashlib.sha1(repr(selection).encode()).hexdigest()[:8]
+    return '"%s"' % etag
+
+
+def _version(etag):
+    """ `etag` without its representation suffix """
+    return etag.split("-")[0] + '"' if "-" in etag else etag
+
+
+def none_match(request, etag):
+    """ True if `If-None-Match` lists `etag` (weak comparison, as for GET) """
+    header = request.headers.get("If-None-Match")
+    return bool(header) and etag in {tag[2:] if tag.startswith("W/") else tag for tag in parse_etags(header)}
+
+
+def check_if_match(request, tags):
+    """
+    Enforce `If-Match` on a write to the resource versioned by `tags` (its
+    own tag first), reserving that version so that of two writers holding
+    the same ETag only one goes ahead. Raises `PreconditionFailed`.
+    """
+    header = request.headers.get("If-Match")
+    if not header:
+        return
+    generations = get_generations(tags)
+    etags = {_version(etag) for etag in parse_etags(header)}
+    if "*" not in etags and _version(entity_tag(generations, request, detail=True)) not in etags:
+        raise PreconditionFailed()
+    if not claim(tags[0], generations[tags[0]]):
+        raise PreconditionFailed()
+
+
+def not_modified(etag):
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+
+class TagCachedViewSetMixin:
+    """
+    Read-through cache for `list` and `retrieve`.
+
+    Views declare the tags each action depends on via `get_cache_tags()`;
+    writes invalidate by bumping those tags (see `invalidate_product` and
+    `invalidate_category`). Responses carry an ETag derived from the same
+    generations: a matching `If-None-Match` gets a 304 without a query, and
+    updates and deletes honour `If-Match`.
+    """
+    cache_prefix = None
+    cache_timeout = None
+
+    def get_cache_tags(self):
+        raise NotImplementedError
+
+    def get_cache_timeout(self):
+        if self.cache_timeout is not None:
+            return self.cache_timeout
+        return getattr(settings, "CATALOG_CACHE_TIMEOUT", 300)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in ("PUT", "PATCH", "DELETE"):
+            check_if_match(request, self.get_cache_tags())
+
+    def cached_response(self, handler, request, *args, timeout=None, **kwargs):
+        generations = get_generations(self.get_cache_tags())
+        etag = entity_tag(generations, request, detail=self.detail)
+        if none_match(request, etag):
+            return not_modified(etag)
+
+        key = _response_key(f"{self.cache_prefix}:{self.action}", generations, request)
+        data = cache.get(key)
+        if data is not None:
+            response = Response(data)
+        else:
+            response = handler(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data, timeout=timeout or self.get_cache_timeout())
+        if response.status_code == 200:
+            response["ETag"] = etag
+        return response
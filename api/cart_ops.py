@@ -0,0 +1,194 @@
+"""
+Server-side atomic cart mutations.
+
+Each mutation is a conditional update on the `carts` collection, so
+concurrent requests cannot lose each other's writes and no `Product` is
+ever dereferenced. Lines carry a snapshot of the product (name, unit price,
+thumbnail) and the cart keeps a running `subtotal`, so reading a cart is a
+single document fetch. Mutations return the raw cart document as it is
+after the write (or None when nothing matched).
+"""
+from decimal import Decimal
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .models import Cart, CartItem, Product
+
+SNAPSHOT_PROJECTION = {"name": 1, "price": 1, "images": {"$slice": 1}}
+
+
+def _carts():
+    return Cart._get_collection()
+
+
+def product_snapshot(product_id):
+    """ Read the fields a cart line snapshots, or None if the product is gone """
+    doc = Product._get_collection().find_one({"_id": ObjectId(product_id)}, SNAPSHOT_PROJECTION)
+    return doc and snapshot_fields(doc)
+
+
+def snapshot_fields(product_doc):
+    images = product_doc.get("images") or []
+    return {
+        "product": product_doc["_id"],
+        "name": product_doc.get("name"),
+        "price": float(product_doc.get("price") or 0),
+        "thumbnail": images[0] if images else None,
+    }
+
+
+def line_total(line):
+    return line.get("quantity", 1) * (line.get("price") or 0)
+
+
+def _line(user_id, product_id):
+    """ The cart's line for `product_id` (quantity and unit price), or None """
+    cart = _carts().find_one(
+        {"user": user_id, "items.product": product_id},
+        {"items": {"$elemMatch": {"product": product_id}}},
+    )
+    return cart["items"][0] if cart and cart.get("items") else None
+
+
+def _increment(user_id, snapshot, quantity):
+    """ Add `quantity` to the line if it is still at the snapshot's unit price """
+    return _carts().find_one_and_update(
+        {"user": user_id, "items": {"$elemMatch": {"product": snapshot["product"], "price": snapshot["price"]}}},
+        {
+            "$inc": {"items.$.quantity": quantity, "subtotal": quantity * snapshot["price"]},
+            "$set": {"items.$.name": snapshot["name"], "items.$.thumbnail": snapshot["thumbnail"]},
+        },
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def _reprice(user_id, snapshot, quantity):
+    """
+    Add `quantity` to a line whose unit price has moved, repricing it to
+    the snapshot: the subtotal also moves by (new - old) * the quantity
+    already in the cart. Conditional on the line's price and quantity as
+    read, and retried when they changed.
+    """
+    product_id, price = snapshot["product"], snapshot["price"]
+    while True:
+        line = _line(user_id, product_id)
+        if line is None:
+            return None
+        old_quantity = line.get("quantity", 1)
+        cart = _carts().find_one_and_update(
+            {"user": user_id, "items": {"$elemMatch": {"product": product_id, "price": line.get("price"), "quantity": old_quantity}}},
+            {
+                "$inc": {
+                    "items.$.quantity": quantity,
+                    "subtotal": quantity * price + (price - (line.get("price") or 0)) * old_quantity,
+                },
+                "$set": {"items.$.name": snapshot["name"], "items.$.price": price, "items.$.thumbnail": snapshot["thumbnail"]},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+        if cart is not None:
+            return cart
+
+
+def add_item(user_id, snapshot, quantity):
+    """
+    Increment the line for the snapshotted product, or append it (creating
+    the cart on the first item) when the cart does not contain it yet.
+    """
+    user_id = ObjectId(user_id)
+    cart = _increment(user_id, snapshot, quantity)
+    if cart is not None:
+        return cart
+
+    try:
+        cart = _carts().find_one_and_update(
+            {"user": user_id, "items.product": {"$ne": snapshot["product"]}},
+            {
+                "$push": {"items": dict(snapshot, quantity=quantity)},
+                "$inc": {"subtotal": quantity * snapshot["price"]},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # The cart already holds this product, at another price or pushed by
+        # a concurrent request between our updates: the upsert collided on
+        # the unique user.
+        cart = None
+    return cart or _increment(user_id, snapshot, quantity) or _reprice(user_id, snapshot, quantity)
+
+
+def remove_item(user_id, product_id):
+    """
+    Pull the product's line and take its total off the subtotal in one
+    write, conditional on the line's price and quantity as read.
+    """
+    user_id, product_id = ObjectId(user_id), ObjectId(product_id)
+    while True:
+        line = _line(user_id, product_id)
+        if line is None:
+            return None
+        cart = _carts().find_one_and_update(
+            {"user": user_id, "items": {"$elemMatch": {"product": product_id, "price": line.get("price"), "quantity": line.get("quantity")}}},
+            {"$pull": {"items": {"product": product_id}}, "$inc": {"subtotal": -line_total(line)}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if cart is not None:
+            return cart
+
+
+def remove_products(product_ids):
+    """
+    Take `product_ids` out of every cart that holds them; returns the users
+    whose carts changed. Each cart is rewritten only if its lines are still
+    the ones read, so the subtotal stays exact; carts changed in between are
+    read again.
+    """
+    product_ids = [ObjectId(product_id) for product_id in product_ids]
+    removed = set(product_ids)
+    users = set()
+    while True:
+        held = list(_carts().find({"items.product": {"$in": product_ids}}, {"user": 1, "items": 1}))
+        if not held:
+            return users
+        writes = []
+        for cart in held:
+            kept = [item for item in cart["items"] if item["product"] not in removed]
+            writes.append(UpdateOne(
+                {"_id": cart["_id"], "items": cart["items"]},
+                {"$set": {"items": kept, "subtotal": round(sum(line_total(item) for item in kept), 2)}},
+            ))
+        _carts().bulk_write(writes, ordered=False)
+        users.update(cart["user"] for cart in held)
+
+
+def clear(user_id):
+    """ Empty the cart; returns False when the user has no cart """
+    result = _carts().update_one({"user": ObjectId(user_id)}, {"$set": {"items": [], "subtotal": 0}})
+    return result.matched_count > 0
+
+
+def get_cart(user_id, projection=None):
+    return _carts().find_one({"user": ObjectId(user_id)}, projection)
+
+
+def _to_amount(field, value):
+    # `$inc` on floats can leave -0.00 behind once rounded.
+    return field.to_python(value or 0) or Decimal("0.00")
+
+
+def as_cart_data(doc):
+    """ Shape a raw cart document for `CartSerializer` """
+    price = CartItem._fields["price"]
+    items = [
+        dict(item, price=_to_amount(price, item["price"])) if item.get("price") is not None else item
+        for item in doc.get("items", [])
+    ]
+    return {
+        "id": doc["_id"],
+        "user": doc.get("user"),
+        "items": items,
+        "subtotal": _to_amount(Cart._fields["subtotal"], doc.get("subtotal")),
+    }
@@ -0,0 +1,231 @@
+"""
+Streaming NDJSON import/export for the catalog.
+
+Imports read one JSON object per line and process them in chunks: each chunk
+is validated, categories are resolved from a single in-memory map, and the
+rows are written with one unordered upsert `bulk_write` keyed on the unique
+`name`. Errors are reported per line and never abort the rest of the file.
+Exports stream from a batched cursor, so memory stays constant.
+"""
+import json
+from itertools import islice
+
+from bson import ObjectId
+from mongoengine.errors import ValidationError as MongoValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from rest_framework.exceptions import ValidationError as DRFValidationError
+
+from . import inventory
+from .caching import CATALOG, CATEGORY_LIST, PRODUCT_LIST, bump, category_tag
+from .models import Category, Product
+from .serializers import CategorySerializer, ProductSerializer
+from .tasks import refresh_cart_snapshots
+
+IMPORT_CHUNK_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+
+    def add_error(self, line, errors):
+        self.errors.append({"line": line, "errors": errors})
+
+    def as_dict(self):
+        return {"created": self.created, "updated": self.updated, "failed": len(self.errors), "errors": self.errors}
+
+
+def _numbered_rows(lines, report):
+    """ Yield (line number, object) for each non-blank line, recording parse errors """
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            report.add_error(number, [f"Invalid JSON: {exc}"])
+            continue
+        if not isinstance(row, dict):
+            report.add_error(number, ["Expected a JSON object"])
+            continue
+        yield number, row
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _write_chunk(collection, numbered_docs, report):
+    """
+    Upsert `[(line, son)]` by name with one unordered bulk write. Returns
+    the names written if any of them updated an existing document, for the
+    caller to invalidate, else an empty list.
+    """
+    if not numbered_docs:
+        return []
+    requests = []
+    for _, son in numbered_docs:
+        son.pop("_id", None)
+        requests.append(UpdateOne({"name": son["name"]}, {"$set": son}, upsert=True))
+    try:
+        result = collection.bulk_write(requests, ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as exc:
+        details = exc.details
+        for error in details["writeErrors"]:
+            report.add_error(numbered_docs[error["index"]][0], [error["errmsg"]])
+    report.created += details["nUpserted"]
+    report.updated += details["nMatched"]
+    if not details["nMatched"]:
+        return []
+    failed = {error["index"] for error in details.get("writeErrors", [])}
+    return [son["name"] for index, (_, son) in enumerate(numbered_docs) if index not in failed]
+
+
+def _validate(serializer, number, row, report):
+    # One serializer instance is reused for the whole import; building its
+    # fields is the expensive part of DRF validation.
+    try:
+        return dict(serializer.run_validation(row))
+    except DRFValidationError as exc:
+        report.add_error(number, exc.detail)
+        return None
+
+
+def _to_son(document_class, data, row, number, report):
+    """
+    Convert validated data to its stored form, keeping only the fields the
+    row actually supplied so an update never resets omitted fields to
+    their defaults.
+    """
+    try:
+        document = document_class(**data)
+        document.validate()
+    except (MongoValidationError, TypeError, ValueError) as exc:
+        report.add_error(number, [str(exc)])
+        return None
+    son = document.to_mongo().to_dict()
+    return {key: value for key, value in son.items() if key in row or key in ("name", "category", "updated_at")}
+
+
+def _category_map():
+    """ Map both category ids and names to ids, loaded once per import """
+    mapping = {}
+    for doc in Category._get_collection().find({"deleted_at": None}, {"name": 1}):
+        mapping[str(doc["_id"])] = doc["_id"]
+        mapping[doc["name"]] = doc["_id"]
+    return mapping
+
+
+def import_products(lines, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Rows look like `ProductSerializer` input; `category` may be an id or a
+    category name.
+    """
+    report = ImportReport()
+    categories = _category_map()
+    collection = Product._get_collection()
+
+    serializer = ProductSerializer()
+
+    for chunk in _chunks(_numbered_rows(lines, report), chunk_size):
+        docs = []
+        for number, row in chunk:
+            data = _validate(serializer, number, row, report)
+            if data is None:
+                continue
+            category_id = categories.get(data.pop("category"))
+            if category_id is None:
+                report.add_error(number, {"category": ["Invalid category ID"]})
+                continue
+            son = _to_son(Product, dict(data, category=category_id), row, number, report)
+            if son is not None:
+                docs.append((number, son))
+        written = set(_write_chunk(collection, docs, report))
+        restocked = [son["name"] for _, son in docs if "stock" in son and son["name"] in written]
+        if restocked and inventory.enabled():
+            # Redis only seeds a product it does not hold yet; overwrite the
+            # stock it holds for the products this import restocked.
+            inventory.seed(
+                [doc["_id"] for doc in collection.find({"name": {"$in": restocked}}, {"_id": 1})], overwrite=True,
+            )
+
+    if report.created or report.updated:
+        bump(PRODUCT_LIST, CATALOG)
+    if report.updated:
+        # Existing products may have changed price/name/images.
+        refresh_cart_snapshots.delay()
+    return report
+
+
+def import_categories(lines, chunk_size=IMPORT_CHUNK_SIZE):
+    report = ImportReport()
+    collection = Category._get_collection()
+
+    serializer = CategorySerializer()
+
+    for chunk in _chunks(_numbered_rows(lines, report), chunk_size):
+        docs = []
+        for number, row in chunk:
+            data = _validate(serializer, number, row, report)
+            if data is None:
+                continue
+            son = _to_son(Category, data, row, number, report)
+            if son is not None:
+                docs.append((number, son))
+        written = _write_chunk(collection, docs, report)
+        if written:
+            # Cached category details are keyed on the category's own tag.
+            bump(*(category_tag(doc["_id"]) for doc in collection.find({"name": {"$in": written}}, {"_id": 1})))
+
+    if report.created or report.updated:
+        bump(CATEGORY_LIST, CATALOG)
+    return report
+
+
+def _dumps(obj):
+    return (json.dumps(obj, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def export_products(batch_size=EXPORT_BATCH_SIZE):
+    """ Yield one NDJSON line (bytes) per product, in `_id` order """
+    to_price = Product._fields["price"].to_python
+    cursor = Product._get_collection().find(
+        {},
+        {"name": 1, "description": 1, "category": 1, "price": 1, "stock": 1, "images": 1},
+        batch_size=batch_size,
+    ).sort("_id", 1)
+    for doc in cursor:
+        yield _dumps({
+            "id": str(doc["_id"]),
+            "name": doc.get("name"),
+            "description": doc.get("description"),
+            "category": str(doc["category"]) if isinstance(doc.get("category"), ObjectId) else doc.get("category"),
+            "price": str(to_price(doc["price"])) if doc.get("price") is not None else None,
+            "stock": doc.get("stock", 0),
+            "images": doc.get("images", []),
+        })
+
+
+def export_categories(batch_size=EXPORT_BATCH_SIZE):
+    cursor = Category._get_collection().find(
+        {"deleted_at": None}, {"name": 1, "description": 1}, batch_size=batch_size,
+    ).sort("_id", 1)
+    for doc in cursor:
+        yield _dumps({"id": str(doc["_id"]), "name": doc.get("name"), "description": doc.get("description")})
+
+
+IMPORTERS = {"products": import_products, "categories": import_categories}
+EXPORTERS = {"products": export_products, "categories": export_categories}
@@ -0,0 +1,351 @@
+"""
+Per-process catalog snapshot.
+
+With `CATALOG_SNAPSHOT["ENABLED"]`, every worker process holds the catalog
+in memory as compact read-only entries (`__slots__`, only the fields the
+serializers render), indexed by id and by category and pre-sorted in each
+product ordering, and `ProductViewSet` / `CategoryViewSet` answer `list`
+and `retrieve` from it without a MongoDB query or a response-cache hit.
+
+At most every `CHECK_INTERVAL` seconds a request reads the catalog version:
+the generations of the product list, category list and catalog cache tags,
+which every catalog write bumps (one cache round trip). Checkout moves it
+too: it invalidates the products it sold (or, with Redis inventory, the
+reconciler does when it writes stock back), so under steady sales it moves
+about every check. When it has moved, or the snapshot is older than
+`MAX_AGE`, only the products whose `updated_at` is past the previous load
+are fetched; categories, being few, are read whole. A product count that no
+longer matches means deletions, settled with an id-only scan. The changed
+products are taken out of and put back into the previous snapshot's sorted
+sequences with `bisect`, copying only the sequences they are in, so a
+refresh costs the changes rather than a sort of the catalog; past
+`PATCH_LIMIT` changes everything is sorted again. The new snapshot is built
+by the one thread that refreshes while the others keep serving the
+previous one.
+
+A catalog larger than `MAX_PRODUCTS` is not loaded, and its reads go to
+MongoDB as before. Conditional requests (`If-None-Match`) take the regular
+path too, since validating an ETag needs the current generations anyway;
+snapshot responses carry no ETag.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+
+from bson import Decimal128, ObjectId
+from django.conf import settings
+from rest_framework.response import Response
+
+from .caching import CATALOG, CATEGORY_LIST, PRODUCT_LIST, get_generations
+from .fast_render import CATEGORY_ROWS, PRODUCT_ROWS
+from .filters import parse_product_filters
+from .models import Category, Product
+from .pagination import ProductKeysetPagination
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": False,
+    "CHECK_INTERVAL": 1.0,
+    "MAX_AGE": 300,
+    "MAX_PRODUCTS": 200_000,
+}
+
+# Changes stamped this long before the previous load are read again: writers
+# stamp `updated_at` with their own clock, before their write commits.
+OVERLAP = timedelta(seconds=5)
+# Product orderings kept pre-sorted (None is `_id` order).
+SORT_FIELDS = tuple(dict.fromkeys([None, *ProductKeysetPagination.orderings.values()]))
+# Changed products a refresh patches into the previous sorted sequences;
+# each one shifts them, so past this many a full sort is cheaper.
+PATCH_LIMIT = 1000
+
+_snapshot = None
+_checked_at = None
+_lock = threading.Lock()
+
+
+def get_setting(name):
+    return getattr(settings, "CATALOG_SNAPSHOT", {}).get(name, DEFAULTS[name])
+
+
+def enabled():
+    return get_setting("ENABLED")
+
+
+class Entry:
+    """ A read-only row with the dict-style `get()` that `RowConverter` reads """
+    __slots__ = ()
+
+    def __init__(self, doc):
+        for name in self.__slots__:
+            if name in doc:
+                value = doc[name]
+                # Decimal128 does not order, and prices are sorted and bisected.
+                object.__setattr__(self, name, float(value.to_decimal()) if isinstance(value, Decimal128) else value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    @property
+    def id(self):
+        return self._id
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+def _same(entry, other):
+    return all(getattr(entry, name, None) == getattr(other, name, None) for name in entry.__slots__)
+
+
+class ProductEntry(Entry):
+    __slots__ = ("_id", *PRODUCT_ROWS.fields)
+
+
+class CategoryEntry(Entry):
+    __slots__ = ("_id", "deleted_at", *CATEGORY_ROWS.fields)
+
+
+PRODUCT_PROJECTION = {field: 1 for field in ProductEntry.__slots__}
+CATEGORY_PROJECTION = {field: 1 for field in CategoryEntry.__slots__}
+
+
+def _sort_key(field):
+    if field is None:
+        return lambda entry: entry._id
+    return lambda entry: (entry.get(field), entry._id)
+
+
+def _sort(products):
+    """ {(category, or None for all, field): entries sorted by (field, _id)} """
+    by_id = sorted(products.values(), key=_sort_key(None))
+    groups = {None: by_id}
+    for entry in by_id:
+        if entry.get("category") is not None:
+            groups.setdefault(entry.get("category"), []).append(entry)
+    return {
+        (category, field): tuple(rows if field is None else sorted(rows, key=_sort_key(field)))
+        for category, rows in groups.items()
+        for field in SORT_FIELDS
+    }
+
+
+def _patch(sorted_rows, removed, added):
+    """
+    `_sort()` output with the `removed` entries taken out and the `added`
+    ones put in. Sequences no change touches are shared, not copied.
+    """
+    touched = {}
+    # An entry read and then found deleted in the same refresh is in both.
+    gone = {id(entry) for entry in removed}
+    added = [entry for entry in added if id(entry) not in gone]
+    for entries, put in ((removed, False), (added, True)):
+        for entry in entries:
+            for category in {None, entry.get("category")}:
+                for field in SORT_FIELDS:
+                    key = (category, field)
+                    if key not in touched:
+                        touched[key] = list(sorted_rows.get(key, ()))
+                    rows, sort_key = touched[key], _sort_key(field)
+                    if put:
+                        insort(rows, entry, key=sort_key)
+                    else:
+                        i = bisect_left(rows, sort_key(entry), key=sort_key)
+                        if i < len(rows) and rows[i] is entry:
+                            del rows[i]
+    patched = dict(sorted_rows)
+    for (category, field), rows in touched.items():
+        if rows or category is None:
+            patched[(category, field)] = tuple(rows)
+        else:
+            patched.pop((category, field), None)
+    return patched
+
+
+class Snapshot:
+    """ One load of the catalog. Replaced by the next load, never modified. """
+    __slots__ = ("version", "loaded_at", "high_water", "products", "sorted", "categories", "category_by_id", "category_names")
+
+    def __init__(self, version, high_water, products, categories, sorted_rows=None):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        # Products stamped from here on are fetched by the next refresh.
+        self.high_water = high_water
+        self.products = products
+        # (category, or None for all, field) -> entries sorted by (field, _id)
+        self.sorted = _sort(products) if sorted_rows is None else sorted_rows
+
+        self.categories = tuple(sorted(
+            (entry for entry in categories if entry.get("deleted_at") is None), key=_sort_key(None),
+        ))
+        self.category_by_id = {entry._id: entry for entry in self.categories}
+        # Tombstoned categories still name their products until the purge.
+        self.category_names = {entry._id: entry.get("name") for entry in categories}
+
+    def products_in(self, field, category=None, min_price=None, max_price=None):
+        """
+        Products (in `category`) sorted by (field, _id). A price range is
+        only applied in price order (`field == "price"`).
+        """
+        rows = self.sorted.get((category, field), ())
+        if field != "price" or (min_price is None and max_price is None):
+            return rows
+
+        def price(entry):
+            return entry.get("price")
+
+        # Bounds compare as floats, as they do in the MongoDB query.
+        start = 0 if min_price is None else bisect_left(rows, float(min_price), key=price)
+        end = len(rows) if max_price is None else bisect_right(rows, float(max_price), key=price)
+        return rows[start:end]
+
+
+def load(version, previous=None):
+    """
+    A snapshot at `version`, reading only what changed since `previous`.
+    None when the catalog has more than `MAX_PRODUCTS` products.
+    """
+    collection = Product._get_collection()
+    started = datetime.utcnow()
+    total = collection.count_documents({})
+    if total > get_setting("MAX_PRODUCTS"):
+        if previous is not None:
+            logger.warning("Catalog snapshot dropped: %d products exceed MAX_PRODUCTS", total)
+        return None
+
+    categories = [CategoryEntry(doc) for doc in Category._get_collection().find({}, CATEGORY_PROJECTION)]
+    if previous is None:
+        products = {doc["_id"]: ProductEntry(doc) for doc in collection.find({}, PRODUCT_PROJECTION)}
+        return Snapshot(version, started, products, categories)
+
+    products = dict(previous.products)
+    removed, added = [], []
+
+    def put(entry):
+        old = products.get(entry._id)
+        # The overlap re-reads recent products whether or not they changed.
+        if old is not None and _same(old, entry):
+            return
+        if old is not None:
+            removed.append(old)
+        products[entry._id] = entry
+        added.append(entry)
+
+    for doc in collection.find({"updated_at": {"$gte": previous.high_water - OVERLAP}}, PRODUCT_PROJECTION):
+        put(ProductEntry(doc))
+    if len(products) != total:
+        # Deleted (or unstamped) products: settle membership by id.
+        ids = {doc["_id"] for doc in collection.find({}, {"_id": 1})}
+        for product_id in products.keys() - ids:
+            removed.append(products.pop(product_id))
+        missing = list(ids - products.keys())
+        if missing:
+            for doc in collection.find({"_id": {"$in": missing}}, PRODUCT_PROJECTION):
+                put(ProductEntry(doc))
+
+    if len(removed) + len(added) > PATCH_LIMIT:
+        return Snapshot(version, started, products, categories)
+    return Snapshot(version, started, products, categories, _patch(previous.sorted, removed, added))
+
+
+def current_version():
+    generations = get_generations([PRODUCT_LIST, CATEGORY_LIST, CATALOG])
+    return generations[PRODUCT_LIST], generations[CATEGORY_LIST], generations[CATALOG]
+
+
+def refresh(previous):
+    """ `previous` while it is current, else the next load """
+    version = current_version()
+    if previous is not None and previous.version == version \
+            and time.monotonic() - previous.loaded_at < get_setting("MAX_AGE"):
+        return previous
+    return load(version, previous)
+
+
+def get_snapshot():
+    """ This process's snapshot, refreshed first when due; None when disabled or too large """
+    global _snapshot, _checked_at
+    if not enabled():
+        return None
+    if _checked_at is not None and time.monotonic() - _checked_at < get_setting("CHECK_INTERVAL"):
+        return _snapshot
+
+    # One thread refreshes while the rest keep reading the previous snapshot;
+    # only the very first load makes them wait.
+    snapshot = _snapshot
+    if not _lock.acquire(blocking=snapshot is None):
+        return snapshot
+    try:
+        if _checked_at is None or time.monotonic() - _checked_at >= get_setting("CHECK_INTERVAL"):
+            _snapshot = refresh(_snapshot)
+            _checked_at = time.monotonic()
+        return _snapshot
+    finally:
+        _lock.release()
+
+
+def reset():
+    """ Forget this process's snapshot (tests, benchmarks) """
+    global _snapshot, _checked_at
+    with _lock:
+        _snapshot = _checked_at = None
+
+
+def servable(request):
+    """ The snapshot, if it may answer `request` """
+    if request.META.get("HTTP_IF_NONE_MATCH"):
+        return None
+    return get_snapshot()
+
+
+def _object_id(value):
+    return ObjectId(value) if ObjectId.is_valid(value) else None
+
+
+class ProductSnapshotMixin:
+    """ `ProductViewSet` list and retrieve from the snapshot when it can answer them """
+
+    def list(self, request, *args, **kwargs):
+        snapshot = servable(request)
+        if snapshot is not None:
+            category, min_price, max_price = parse_product_filters(request.query_params)
+            # A price range in another order would need a scan; the indexes do that better.
+            if (min_price is None and max_price is None) or self.paginator.get_ordering(request)[0] == "price":
+                page = self.paginator.paginate_sequence(
+                    request, lambda field: snapshot.products_in(field, category, min_price, max_price),
+                )
+                converter = PRODUCT_ROWS.subset(self.get_fieldset())
+                return self.paginator.get_paginated_response(converter.build(page, snapshot.category_names))
+        return super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        snapshot = servable(request)
+        entry = None
+        if snapshot is not None:
+            entry = snapshot.products.get(_object_id(self.kwargs[self.lookup_url_kwarg or self.lookup_field]))
+        if entry is None:
+            # Possibly created since the last refresh: ask MongoDB.
+            return super().retrieve(request, *args, **kwargs)
+        return Response(PRODUCT_ROWS.subset(self.get_fieldset()).build([entry], snapshot.category_names)[0])
+
+
+class CategorySnapshotMixin:
+    """ `CategoryViewSet` list and retrieve from the snapshot """
+
+    def list(self, request, *args, **kwargs):
+        snapshot = servable(request)
+        if snapshot is None:
+            return super().list(request, *args, **kwargs)
+        return Response(CATEGORY_ROWS.subset(self.get_fieldset()).build(snapshot.categories, None))
+
+    def retrieve(self, request, *args, **kwargs):
+        snapshot = servable(request)
+        entry = None
+        if snapshot is not None:
+            entry = snapshot.category_by_id.get(_object_id(self.kwargs[self.lookup_url_kwarg or self.lookup_field]))
+        if entry is None:
+            return super().retrieve(request, *args, **kwargs)
+        return Response(CATEGORY_ROWS.subset(self.get_fieldset()).build([entry], None)[0])
@@ -0,0 +1,95 @@
+"""
+Category deletion in the background.
+
+Deleting a category only tombstones it (`Category.deleted_at`) and records a
+`CategoryDeletion` job: the category drops out of category reads and can no
+longer take new products straight away. `purge_batch` then handles up to
+`PURGE_BATCH_SIZE` of its products at a time, taking them out of carts and
+deleting them with one `delete_many` (or moving them to `reassign_to` with
+one `update_many`), and retires the cached responses that showed them. Each
+batch re-reads what is left in the category, so a job interrupted anywhere
+simply carries on from there when it runs again (see
+`tasks.purge_category`). The category document goes after its last product.
+"""
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from . import cart_ops
+from .caching import CATALOG, PRODUCT_LIST, bump, cart_tag, invalidate_category, product_tag
+from .models import Category, CategoryDeletion, Product
+
+PURGE_BATCH_SIZE = 500
+# A running job whose progress is older than this is assumed to have lost
+# its task (`tasks.resume_category_deletions` queues it again).
+STALE_AFTER = timedelta(minutes=5)
+
+
+def start(category_id, reassign_to=None):
+    """
+    Tombstone the category and record its deletion job. Returns the job, or
+    None when the category is missing or already being deleted.
+    """
+    category = Category._get_collection().find_one_and_update(
+        {"_id": ObjectId(category_id), "deleted_at": None},
+        {"$set": {"deleted_at": datetime.utcnow()}},
+        projection={"name": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if category is None:
+        return None
+    deletion = CategoryDeletion(
+        category=category["_id"],
+        name=category.get("name"),
+        reassign_to=reassign_to,
+        products_total=Product._get_collection().count_documents({"category": category["_id"]}),
+    ).save()
+    invalidate_category(category["_id"])
+    return deletion
+
+
+def purge_batch(deletion, batch_size=PURGE_BATCH_SIZE):
+    """ Purge up to `batch_size` of the category's products; returns how many were left to purge """
+    products = Product._get_collection()
+    in_category = {"category": deletion.category}
+    product_ids = [doc["_id"] for doc in products.find(in_category, {"_id": 1}).limit(batch_size)]
+    if not product_ids:
+        return 0
+
+    users = set()
+    batch = dict(in_category, _id={"$in": product_ids})
+    if deletion.reassign_to:
+        done = products.update_many(
+            batch, {"$set": {"category": deletion.reassign_to, "updated_at": datetime.utcnow()}},
+        ).modified_count
+    else:
+        # Carts first: once the products are gone nothing finds their lines.
+        users = cart_ops.remove_products(product_ids)
+        done = products.delete_many(batch).deleted_count
+    bump(PRODUCT_LIST, CATALOG, *[product_tag(product_id) for product_id in product_ids], *[cart_tag(user_id) for user_id in users])
+
+    CategoryDeletion._get_collection().update_one(
+        {"_id": deletion.id},
+        {"$inc": {"products_done": done, "carts_updated": len(users)}, "$set": {"updated_at": datetime.utcnow()}},
+    )
+    return len(product_ids)
+
+
+def finish(deletion):
+    """ Remove the emptied category and mark the job done """
+    Category._get_collection().delete_one({"_id": deletion.category, "deleted_at": {"$ne": None}})
+    now = datetime.utcnow()
+    CategoryDeletion._get_collection().update_one(
+        {"_id": deletion.id}, {"$set": {"status": "Done", "updated_at": now, "finished_at": now}},
+    )
+    invalidate_category(deletion.category)
+
+
+def stale_deletions():
+    """ Ids of running jobs that have not made progress for `STALE_AFTER` """
+    cutoff = datetime.utcnow() - STALE_AFTER
+    return [
+        str(doc["_id"])
+        for doc in CategoryDeletion._get_collection().find({"status": "Running", "updated_at": {"$lt": cutoff}}, {"_id": 1})
+    ]
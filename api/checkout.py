@@ -0,0 +1,283 @@
+"""
+Checkout pipeline: turn the user's cart into an order in a constant number
+of round trips, however many lines the cart has.
+
+1. read the cart lines
+2. fetch every product with one `$in`, projected to price and stock
+3. decrement stock with a conditional `bulk_write` (only where enough is left)
+4. insert the order and remove the checked-out lines from the cart
+
+Steps 1-4 share a transaction when the deployment supports one, together
+with the order's first `order.status_changed` outbox event. Without one,
+a failure after step 3 deletes the order if it was written and puts the
+stock back. With Redis inventory enabled, step 3 instead commits the cart's
+stock reservation (api/inventory.py), and the sale is put back the same way.
+
+Without a transaction (or Redis inventory), each decrement also records
+`{order, quantity}` in the product's `checkout_holds`, and a held
+`checkout.stock_taken` outbox event is written with the order. If the
+process dies mid-checkout that event surfaces after the outbox's
+`UNCONFIRMED_DELAY` and `settle_stock_holds` puts back what the missing
+order took; once the order is confirmed, it just clears the holds.
+"""
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from rest_framework import status
+
+from . import inventory, outbox
+from .caching import PRODUCT_LIST, bump, product_tag
+from .cart_ops import line_total
+from .models import Cart, Order, OrderItem, Product
+from .order_status import status_changed_event
+from .transactions import supports_transactions
+
+STOCK_TAKEN = "checkout.stock_taken"
+
+
+class CheckoutError(Exception):
+    status_code = status.HTTP_400_BAD_REQUEST
+
+    def __init__(self, message, products=None):
+        super().__init__(message)
+        self.message = message
+        self.products = products or []
+
+    def as_response_data(self):
+        data = {"error": self.message}
+        if self.products:
+            data["products"] = [str(product_id) for product_id in self.products]
+        return data
+
+
+class EmptyCart(CheckoutError):
+    def __init__(self):
+        super().__init__("Cart is empty")
+
+
+class UnavailableProducts(CheckoutError):
+    status_code = status.HTTP_409_CONFLICT
+
+    def __init__(self, products):
+        super().__init__("Some products are no longer available", products)
+
+
+class InsufficientStock(CheckoutError):
+    status_code = status.HTTP_409_CONFLICT
+
+    def __init__(self, products):
+        super().__init__("Insufficient stock", products)
+
+
+def _cart_lines(cart):
+    lines = OrderedDict()
+    for item in cart.get("items", []):
+        lines[item["product"]] = lines.get(item["product"], 0) + item.get("quantity", 1)
+    return lines
+
+
+def _decrement_stock(products, lines, session):
+    requests = [
+        UpdateOne(
+            {"_id": product_id, "stock": {"$gte": quantity}},
+            {"$inc": {"stock": -quantity}, "$set": {"updated_at": datetime.utcnow()}},
+        )
+        for product_id, quantity in lines.items()
+    ]
+    result = products.bulk_write(requests, ordered=False, session=session)
+    if result.modified_count != len(requests):
+        # Inside a transaction raising aborts every decrement above.
+        raise InsufficientStock(list(lines))
+
+
+def _restock(products, order_id, lines):
+    """
+    Put back stock `order_id` took without a transaction. Each line only
+    matches while its hold is there, so it is never put back twice.
+    """
+    now = datetime.utcnow()
+    products.bulk_write(
+        [
+            UpdateOne(
+                {"_id": product_id, "checkout_holds": {"order": order_id, "quantity": quantity}},
+                {"$inc": {"stock": quantity}, "$pull": {"checkout_holds": {"order": order_id}}, "$set": {"updated_at": now}},
+            )
+            for product_id, quantity in lines.items()
+        ],
+        ordered=False,
+    )
+
+
+def _decrement_stock_without_transaction(products, order_id, lines, decremented):
+    """
+    A standalone server cannot roll back part of a bulk write, and a bulk
+    result does not say which updates matched, so apply lines one at a time
+    and put back what was taken if any line falls short. `decremented` keeps
+    what was taken, for the caller to put back if the order is not written;
+    the holds keep it for `settle_stock_holds` if the caller dies first.
+    """
+    for product_id, quantity in lines.items():
+        result = products.update_one(
+            {"_id": product_id, "stock": {"$gte": quantity}},
+            {
+                "$inc": {"stock": -quantity},
+                "$push": {"checkout_holds": {"order": order_id, "quantity": quantity}},
+                "$set": {"updated_at": datetime.utcnow()},
+            },
+        )
+        if not result.modified_count:
+            if decremented:
+                _restock(products, order_id, decremented)
+                decremented.clear()
+            raise InsufficientStock([product_id])
+        decremented[product_id] = quantity
+
+
+def _commit_reserved(reservation_id, lines, committed):
+    """
+    Sell `lines` from the cart's reservation. `committed` remembers the sale
+    across a retried transaction, so it is not taken twice.
+    """
+    if committed == lines:
+        return
+    if committed:
+        inventory.restock(committed)
+        committed.clear()
+    try:
+        inventory.commit(reservation_id, lines)
+    except inventory.OutOfStock as exc:
+        raise InsufficientStock([ObjectId(exc.product_id)])
+    committed.update(lines)
+
+
+def place_order(user):
+    """
+    Check out `user`'s cart. Returns the created order as a dict suitable for
+    `OrderSerializer`; raises `CheckoutError` subclasses on failure.
+    """
+    user_id = ObjectId(user.id)
+    carts = Cart._get_collection()
+    products = Product._get_collection()
+    orders = Order._get_collection()
+    db = orders.database
+    to_price = Product._fields["price"].to_python
+    order_id = ObjectId()
+    reservation_id = inventory.cart_reservation(user_id) if inventory.enabled() else None
+    committed = {}
+    decremented = {}
+
+    def place(session):
+        cart = carts.find_one({"user": user_id}, {"items.product": 1, "items.quantity": 1, "items.price": 1}, session=session)
+        lines = _cart_lines(cart or {})
+        if not lines:
+            raise EmptyCart()
+
+        found = {
+            doc["_id"]: doc
+            for doc in products.find(
+                {"_id": {"$in": list(lines)}}, {"price": 1, "stock": 1}, session=session
+            )
+        }
+        missing = [product_id for product_id in lines if product_id not in found]
+        if missing:
+            raise UnavailableProducts(missing)
+
+        if reservation_id is not None:
+            _commit_reserved(reservation_id, lines, committed)
+        else:
+            short = [product_id for product_id, quantity in lines.items() if found[product_id].get("stock", 0) < quantity]
+            if short:
+                raise InsufficientStock(short)
+
+            if session is not None:
+                _decrement_stock(products, lines, session)
+            else:
+                _decrement_stock_without_transaction(products, order_id, lines, decremented)
+
+        # Built from plain values: reading `OrderItem.product` back would
+        # dereference it.
+        items = [
+            {"product": product_id, "quantity": quantity, "price": to_price(found[product_id]["price"])}
+            for product_id, quantity in lines.items()
+        ]
+        now = datetime.utcnow()
+        order = Order(
+            id=order_id,
+            user=user_id,
+            items=[OrderItem(**item) for item in items],
+            total_price=sum(item["quantity"] * item["price"] for item in items),
+            created_at=now,
+            updated_at=now,
+            status_changed_at=now,
+        )
+        order.validate()
+        orders.insert_one(order.to_mongo(), session=session)
+
+        checked_out = sum(line_total(item) for item in cart["items"] if item["product"] in lines)
+        carts.update_one(
+            {"_id": cart["_id"]},
+            {
+                "$pull": {"items": {"product": {"$in": list(lines)}}},
+                "$inc": {"subtotal": -checked_out},
+            },
+            session=session,
+        )
+
+        return {
+            "id": order_id,
+            "user": user_id,
+            "items": items,
+            "total_price": order.total_price,
+            "status": order.status,
+            "created_at": order.created_at,
+        }
+
+    events = [status_changed_event(order_id, Order._fields["status"].default)]
+    if reservation_id is None and not supports_transactions(db):
+        events.append(stock_taken_event(order_id))
+    try:
+        return outbox.write_with_events(db, place, events)
+    except Exception:
+        if committed or decremented:
+            # Without a transaction the order may already be written (e.g.
+            # the cart update failed): take it back before the stock.
+            orders.delete_one({"_id": order_id})
+        if committed:
+            inventory.restock(committed)
+        if decremented:
+            _restock(products, order_id, decremented)
+        raise
+
+
+def stock_taken_event(order_id):
+    return STOCK_TAKEN, {"order_id": order_id}
+
+
+@outbox.handler(STOCK_TAKEN)
+def settle_stock_holds(events):
+    """
+    Clear the stock holds of checkouts without a transaction: an order that
+    was written keeps its stock, one that never was (the process died
+    mid-checkout) gets it back.
+    """
+    products = Product._get_collection()
+    order_ids = [event["payload"]["order_id"] for event in events]
+    placed = {doc["_id"] for doc in Order._get_collection().find({"_id": {"$in": order_ids}}, {"_id": 1})}
+    if placed:
+        products.update_many({"checkout_holds.order": {"$in": list(placed)}}, {"$pull": {"checkout_holds": {"order": {"$in": list(placed)}}}})
+    lost = set(order_ids) - placed
+    if not lost:
+        return
+    taken = defaultdict(dict)
+    for doc in products.find({"checkout_holds.order": {"$in": list(lost)}}, {"checkout_holds": 1}):
+        for hold in doc["checkout_holds"]:
+            if hold["order"] in lost:
+                taken[hold["order"]][doc["_id"]] = hold["quantity"]
+    for order_id, lines in taken.items():
+        _restock(products, order_id, lines)
+    if taken:
+        # Stock is part of the product payload.
+        bump(*{product_tag(product_id) for lines in taken.values() for product_id in lines}, PRODUCT_LIST)
+
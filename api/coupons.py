@@ -0,0 +1,201 @@
+"""
+Coupon redemption.
+
+A use is claimed with one conditional `find_one_and_update` on the coupon
+(`used_count < usage_limit` and not expired) and the discount is recorded
+on the order with a second one (`$mul`) that only matches an order without
+a coupon; if that fails the claimed use is released. The two writes are not
+wrapped in a transaction on purpose: every redemption of a popular code
+touches the same coupon document, and transactions on it would abort each
+other under load.
+
+The definition is cached briefly, and the cache also holds an admission
+counter and an "exhausted" marker so that, during a promo launch, requests
+beyond the usage limit are turned away without reaching MongoDB.
+"""
+from datetime import datetime
+
+from bson import ObjectId
+from django.core.cache import cache
+from pymongo import ReturnDocument
+from rest_framework import status
+
+from .models import Coupon, Order
+
+DEFINITION_TIMEOUT = 30
+# Unknown codes are cached too, briefly, so guessing does not hit MongoDB.
+MISSING_TIMEOUT = 5
+# The admission counter is re-seeded from `used_count` when it expires.
+ADMISSION_TIMEOUT = 60
+
+
+class RedemptionError(Exception):
+    status_code = status.HTTP_400_BAD_REQUEST
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+    def as_response_data(self):
+        return {"error": self.message}
+
+
+class InvalidCoupon(RedemptionError):
+    def __init__(self):
+        super().__init__("Invalid coupon code")
+
+
+class CouponExpired(RedemptionError):
+    def __init__(self):
+        super().__init__("Coupon has expired")
+
+
+class CouponExhausted(RedemptionError):
+    status_code = status.HTTP_409_CONFLICT
+
+    def __init__(self):
+        super().__init__("Coupon usage limit reached")
+
+
+class OrderNotFound(RedemptionError):
+    status_code = status.HTTP_404_NOT_FOUND
+
+    def __init__(self):
+        super().__init__("Order not found")
+
+
+class CouponAlreadyApplied(RedemptionError):
+    status_code = status.HTTP_409_CONFLICT
+
+    def __init__(self):
+        super().__init__("A coupon has already been applied to this order")
+
+
+def _definition_key(code):
+    return f"coupon:def:{code}"
+
+
+def _admission_key(coupon_id):
+    return f"coupon:admitted:{coupon_id}"
+
+
+def _exhausted_key(coupon_id):
+    return f"coupon:exhausted:{coupon_id}"
+
+
+def get_definition(code):
+    """ The coupon's immutable fields, or None; cached for DEFINITION_TIMEOUT """
+    key = _definition_key(code)
+    definition = cache.get(key)
+    if definition is None:
+        doc = Coupon._get_collection().find_one(
+            {"code": code}, {"discount_percentage": 1, "expiry_date": 1, "usage_limit": 1, "used_count": 1}
+        )
+        if doc is None:
+            cache.set(key, {}, timeout=MISSING_TIMEOUT)
+            return None
+        definition = {
+            "id": str(doc["_id"]),
+            "code": code,
+            "discount_percentage": doc["discount_percentage"],
+            "expiry_date": doc["expiry_date"],
+            "usage_limit": doc.get("usage_limit", 1),
+        }
+        cache.set(key, definition, timeout=DEFINITION_TIMEOUT)
+        cache.add(_admission_key(definition["id"]), doc.get("used_count", 0), timeout=ADMISSION_TIMEOUT)
+    return definition or None
+
+
+def invalidate(code):
+    cache.delete(_definition_key(code))
+
+
+def _admit(definition):
+    """ Cheap cache-side gate in front of the authoritative claim """
+    coupon_id = definition["id"]
+    if cache.get(_exhausted_key(coupon_id)):
+        return False
+    try:
+        admitted = cache.incr(_admission_key(coupon_id))
+    except ValueError:
+        # Expired or evicted; let MongoDB decide and re-seed next time.
+        return True
+    return admitted <= definition["usage_limit"]
+
+
+def _unadmit(definition):
+    try:
+        cache.decr(_admission_key(definition["id"]))
+    except ValueError:
+        pass
+
+
+def claim(definition, now):
+    """ Take one use of the coupon; False if none is left (or it expired) """
+    coupon = Coupon._get_collection().find_one_and_update(
+        {
+            "_id": ObjectId(definition["id"]),
+            "expiry_date": {"$gt": now},
+            "$expr": {"$lt": [{"$ifNull": ["$used_count", 0]}, "$usage_limit"]},
+        },
+        {"$inc": {"used_count": 1}},
+        projection={"used_count": 1, "usage_limit": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if coupon is None or coupon["used_count"] >= coupon["usage_limit"]:
+        cache.set(_exhausted_key(definition["id"]), True, timeout=DEFINITION_TIMEOUT)
+    return coupon is not None
+
+
+def release(definition):
+    Coupon._get_collection().update_one(
+        {"_id": ObjectId(definition["id"]), "used_count": {"$gt": 0}}, {"$inc": {"used_count": -1}}
+    )
+    _unadmit(definition)
+    cache.delete(_exhausted_key(definition["id"]))
+
+
+def redeem(code, order_id, user):
+    """
+    Apply coupon `code` to the order. Non-admins can only discount their own
+    orders. Returns (order before the discount, new total); raises
+    `RedemptionError` subclasses.
+    """
+    definition = get_definition(code) if code else None
+    if definition is None:
+        raise InvalidCoupon()
+    now = datetime.utcnow()
+    if definition["expiry_date"] <= now:
+        raise CouponExpired()
+    if not ObjectId.is_valid(order_id):
+        raise OrderNotFound()
+
+    if not _admit(definition):
+        raise CouponExhausted()
+    if not claim(definition, now):
+        _unadmit(definition)
+        raise CouponExhausted()
+
+    match = {"_id": ObjectId(order_id), "coupon_code": None, "status": {"$ne": "Cancelled"}}
+    if not user.is_admin:
+        match["user"] = ObjectId(user.id)
+    factor = (100 - definition["discount_percentage"]) / 100
+    order = Order._get_collection().find_one_and_update(
+        match,
+        {"$mul": {"total_price": factor}, "$set": {"coupon_code": code, "updated_at": now}},
+        projection={"total_price": 1, "created_at": 1, "status": 1, "user": 1},
+        # A 100% coupon leaves nothing to derive the old total from.
+        return_document=ReturnDocument.AFTER if factor else ReturnDocument.BEFORE,
+    )
+    if order is None:
+        release(definition)
+        if Order._get_collection().find_one({k: v for k, v in match.items() if k != "coupon_code"}, {"_id": 1}):
+            raise CouponAlreadyApplied()
+        raise OrderNotFound()
+
+    field = Order._fields["total_price"]
+    if not factor:
+        return dict(order, total_price=field.to_python(order["total_price"])), field.to_python(0)
+    # The caller gets the order as it was: the total before the discount is
+    # worked back out of the stored one (exact once rounded to cents).
+    return dict(order, total_price=field.to_python(order["total_price"] / factor)), field.to_python(order["total_price"])
@@ -0,0 +1,107 @@
+"""
+Sparse fieldsets: `?fields=name,price` or `?exclude=images,description` on
+the read endpoints.
+
+A selection names top-level fields of the endpoint's serializer. It is
+pushed down as a projection, so unselected fields are never read from
+MongoDB, and rendered by a serializer (or, on the list fast path, a
+`RowConverter`) built once per distinct selection and cached.
+"""
+from functools import lru_cache
+
+from rest_framework.exceptions import ValidationError
+
+FIELDS_PARAM = "fields"
+EXCLUDE_PARAM = "exclude"
+
+
+@lru_cache(maxsize=None)
+def readable_fields(serializer_class):
+    """ {field name: source} of the fields `serializer_class` renders """
+    return {name: field.source for name, field in serializer_class().fields.items() if not field.write_only}
+
+
+def _names(value):
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+def parse(params, serializer_class):
+    """
+    The field names selected by `params` as a frozenset, or None when the
+    request selects nothing (every field). Unknown names are a 400.
+    """
+    fields, exclude = params.get(FIELDS_PARAM), params.get(EXCLUDE_PARAM)
+    if not fields and not exclude:
+        return None
+
+    available = readable_fields(serializer_class)
+    errors = {}
+    for param, value in ((FIELDS_PARAM, fields), (EXCLUDE_PARAM, exclude)):
+        unknown = [name for name in _names(value or "") if name not in available]
+        if unknown:
+            errors[param] = f"Unknown field(s): {', '.join(unknown)}. Choose from: {', '.join(available)}."
+    if errors:
+        raise ValidationError(errors)
+
+    selected = set(_names(fields)) if fields else set(available)
+    selected.difference_update(_names(exclude or ""))
+    if not selected:
+        raise ValidationError({EXCLUDE_PARAM: "At least one field must remain."})
+    return frozenset(selected)
+
+
+def document_fields(serializer_class, fields):
+    """ The document fields to project for `fields` (`id` is always read) """
+    available = readable_fields(serializer_class)
+    return sorted({available[name] for name in fields if available[name] != "id"})
+
+
+def projection(serializer_class, fields):
+    """ A pymongo projection for `fields`, or None to read whole documents """
+    if fields is None:
+        return None
+    # An empty projection would read everything.
+    return {field: 1 for field in document_fields(serializer_class, fields)} or {"_id": 1}
+
+
+@lru_cache(maxsize=None)
+def serializer_for(serializer_class, fields):
+    """ `serializer_class` rendering only `fields`; one class per selection """
+    if fields is None:
+        return serializer_class
+
+    class SparseSerializer(serializer_class):
+        def get_fields(self):
+            return {name: field for name, field in super().get_fields().items() if name in fields}
+
+    SparseSerializer.__name__ = SparseSerializer.__qualname__ = f"Sparse{serializer_class.__name__}"
+    return SparseSerializer
+
+
+class SparseFieldsetMixin:
+    """
+    `?fields=`/`?exclude=` for a viewset's `sparse_actions`: the queryset is
+    projected to the selection (plus whatever the paginator's cursor is
+    built from) and the serializer renders only the selected fields.
+    """
+    sparse_actions = ("list", "retrieve")
+
+    def get_fieldset(self):
+        if self.action not in self.sparse_actions:
+            return None
+        if not hasattr(self, "_fieldset"):
+            self._fieldset = parse(self.request.query_params, super().get_serializer_class())
+        return self._fieldset
+
+    def get_serializer_class(self):
+        return serializer_for(super().get_serializer_class(), self.get_fieldset())
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields = self.get_fieldset()
+        if fields is None:
+            return queryset
+        only = document_fields(super().get_serializer_class(), fields)
+        if self.action == "list" and self.paginator is not None and hasattr(self.paginator, "get_sort_fields"):
+            only += self.paginator.get_sort_fields(self.request)
+        return queryset.only("id", *only)
@@ -0,0 +1,65 @@
+from datetime import datetime, time, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_aware, make_naive
+from rest_framework.exceptions import ValidationError
+
+
+def parse_product_filters(params):
+    """
+    Parse the catalog filter query parameters shared by the product list and
+    search endpoints. Returns (category id or None, min price, max price).
+    """
+    category = params.get("category")
+    if category:
+        try:
+            category = ObjectId(category)
+        except (InvalidId, TypeError):
+            raise ValidationError({"category": "Invalid category ID"})
+    else:
+        category = None
+
+    prices = []
+    for param in ("min_price", "max_price"):
+        value = params.get(param)
+        if value:
+            try:
+                value = Decimal(value)
+            except InvalidOperation:
+                raise ValidationError({param: "A valid number is required."})
+        prices.append(value or None)
+    return (category, *prices)
+
+
+def _parse_bound(params, param, inclusive):
+    value = params.get(param)
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is not None:
+        if is_aware(moment):
+            moment = make_naive(moment, timezone.utc)
+        return moment
+    day = parse_date(value)
+    if day is None:
+        raise ValidationError({param: "Use an ISO date (YYYY-MM-DD) or datetime."})
+    moment = datetime.combine(day, time.min)
+    return moment + timedelta(days=1) if inclusive else moment
+
+
+def parse_date_range(params, default_days=30):
+    """
+    Parse `start`/`end` (ISO dates or datetimes, UTC) into a naive UTC
+    [start, end) range. A date `end` includes that whole day; without
+    `end` the range runs to the end of today.
+    """
+    end = _parse_bound(params, "end", inclusive=True)
+    if end is None:
+        end = datetime.combine(datetime.utcnow().date(), time.min) + timedelta(days=1)
+    start = _parse_bound(params, "start", inclusive=False) or end - timedelta(days=default_days)
+    if start >= end:
+        raise ValidationError({"start": "Must be before end."})
+    return start, end
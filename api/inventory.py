@@ -0,0 +1,395 @@
+"""
+Redis-backed stock reservations.
+
+With `INVENTORY["ENABLED"]`, stock is claimed in Redis rather than on the
+product documents, so a flash sale never queues writes on one hot document:
+
+* `reserve()` holds stock for a cart (or any reservation id) until it
+  expires; adding to a cart extends its reservation.
+* `commit()` turns held stock (or, if the hold expired, whatever is still
+  available) into a sale at checkout; `restock()` reverses one.
+* `reconcile()` (the `reconcile_inventory` task) releases expired
+  reservations and flushes committed decrements to `Product.stock` in
+  batches.
+
+Every check-and-update is a single Lua script, so concurrent clients can
+never oversell. Redis holds, per product, the stock Mongo will have once
+pending decrements are flushed (`stock`) and the quantity held by live
+reservations (`reserved`); available = stock - reserved. A product is
+seeded from Mongo the first time it is touched. These keys have no TTL:
+run Redis with an eviction policy that leaves them alone (e.g. noeviction
+or volatile-*).
+"""
+import time
+import uuid
+from datetime import datetime
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+
+from .caching import PRODUCT_LIST, bump, product_tag
+from .models import Product
+
+DEFAULTS = {
+    "ENABLED": False,
+    # django-redis cache alias whose connection holds the inventory keys.
+    "REDIS_ALIAS": "default",
+    # Seconds stock stays held after the last cart change.
+    "CART_RESERVATION_TTL": 15 * 60,
+    "FLUSH_BATCH_SIZE": 500,
+    "SWEEP_BATCH_SIZE": 1000,
+}
+
+# One hash tag, so every script's keys live in the same Redis Cluster slot.
+STOCK = "{inv}:stock"
+RESERVED = "{inv}:reserved"
+PENDING = "{inv}:pending"
+FLUSHING = "{inv}:flushing"
+EXPIRY = "{inv}:expiry"
+RESERVATION_PREFIX = "{inv}:res:"
+
+# KEYS: stock, reserved, expiry, reservation. ARGV: id, expires at, then
+# product/quantity pairs. All-or-nothing.
+RESERVE = """
+for i = 3, #ARGV, 2 do
+    local stock = redis.call('HGET', KEYS[1], ARGV[i])
+    if not stock then return {'missing', ARGV[i]} end
+    local reserved = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+    if tonumber(stock) - reserved < tonumber(ARGV[i + 1]) then return {'short', ARGV[i]} end
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[i + 1])
+    redis.call('HINCRBY', KEYS[4], ARGV[i], ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+return {'ok'}
+"""
+
+# KEYS: reserved, expiry, reservation. ARGV: id, then optional product
+# ids (default: everything held).
+RELEASE = """
+local products = {}
+if #ARGV > 1 then
+    for i = 2, #ARGV do products[#products + 1] = ARGV[i] end
+else
+    local held = redis.call('HKEYS', KEYS[3])
+    for i = 1, #held do products[#products + 1] = held[i] end
+end
+local released = 0
+for _, product in ipairs(products) do
+    local held = tonumber(redis.call('HGET', KEYS[3], product) or '0')
+    if held > 0 then
+        redis.call('HINCRBY', KEYS[1], product, -held)
+        released = released + held
+    end
+    redis.call('HDEL', KEYS[3], product)
+end
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return released
+"""
+
+# KEYS: reserved, expiry, reservation. ARGV: id, then product/quantity
+# pairs. Gives back at most what the reservation holds of each.
+UNRESERVE = """
+for i = 2, #ARGV, 2 do
+    local held = tonumber(redis.call('HGET', KEYS[3], ARGV[i]) or '0')
+    local quantity = math.min(held, tonumber(ARGV[i + 1]))
+    if quantity > 0 then
+        redis.call('HINCRBY', KEYS[1], ARGV[i], -quantity)
+    end
+    if held - quantity <= 0 then
+        redis.call('HDEL', KEYS[3], ARGV[i])
+    else
+        redis.call('HINCRBY', KEYS[3], ARGV[i], -quantity)
+    end
+end
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+# KEYS: stock, reserved, pending, expiry, reservation. ARGV: id, then
+# product/quantity pairs. Uses the reservation's hold first, then any
+# unreserved stock. All-or-nothing.
+COMMIT = """
+for i = 2, #ARGV, 2 do
+    local stock = redis.call('HGET', KEYS[1], ARGV[i])
+    if not stock then return {'missing', ARGV[i]} end
+    local held = tonumber(redis.call('HGET', KEYS[5], ARGV[i]) or '0')
+    local extra = tonumber(ARGV[i + 1]) - math.min(held, tonumber(ARGV[i + 1]))
+    local reserved = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+    if tonumber(stock) - reserved < extra then return {'short', ARGV[i]} end
+end
+for i = 2, #ARGV, 2 do
+    local quantity = tonumber(ARGV[i + 1])
+    local held = tonumber(redis.call('HGET', KEYS[5], ARGV[i]) or '0')
+    local used = math.min(held, quantity)
+    if used > 0 then
+        redis.call('HINCRBY', KEYS[2], ARGV[i], -used)
+    end
+    if held - used <= 0 then
+        redis.call('HDEL', KEYS[5], ARGV[i])
+    else
+        redis.call('HINCRBY', KEYS[5], ARGV[i], -used)
+    end
+    redis.call('HINCRBY', KEYS[1], ARGV[i], -quantity)
+    redis.call('HINCRBY', KEYS[3], ARGV[i], quantity)
+end
+if redis.call('HLEN', KEYS[5]) == 0 then
+    redis.call('DEL', KEYS[5])
+    redis.call('ZREM', KEYS[4], ARGV[1])
+end
+return {'ok'}
+"""
+
+# KEYS: stock, pending. ARGV: product/quantity pairs.
+RESTOCK = """
+for i = 1, #ARGV, 2 do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('HINCRBY', KEYS[2], ARGV[i], -tonumber(ARGV[i + 1]))
+end
+return 1
+"""
+
+# KEYS: stock, pending, flushing. ARGV: product/Mongo stock pairs, and
+# whether to overwrite (an admin edit) rather than only fill in.
+SEED = """
+local overwrite = ARGV[#ARGV] == '1'
+for i = 1, #ARGV - 1, 2 do
+    local unflushed = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+        + tonumber(redis.call('HGET', KEYS[3], ARGV[i]) or '0')
+    local stock = tonumber(ARGV[i + 1]) - unflushed
+    if overwrite then
+        redis.call('HSET', KEYS[1], ARGV[i], stock)
+    else
+        redis.call('HSETNX', KEYS[1], ARGV[i], stock)
+    end
+end
+return 1
+"""
+
+# KEYS: reserved, expiry. ARGV: now, limit, reservation key prefix. The
+# reservation keys are derived, but share the hash tag (same slot).
+SWEEP = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, id in ipairs(expired) do
+    local key = ARGV[3] .. id
+    local held = redis.call('HGETALL', key)
+    for i = 1, #held, 2 do
+        redis.call('HINCRBY', KEYS[1], held[i], -tonumber(held[i + 1]))
+    end
+    redis.call('DEL', key)
+    redis.call('ZREM', KEYS[2], id)
+end
+return #expired
+"""
+
+# KEYS: pending, flushing. ARGV: batch token. Resumes an unfinished batch.
+FLUSH_START = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then return {} end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('HSET', KEYS[2], '_token', ARGV[1])
+end
+return redis.call('HGETALL', KEYS[2])
+"""
+
+_client = None
+_scripts = {}
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_id):
+        super().__init__(f"Insufficient stock for product {product_id}")
+        self.product_id = product_id
+
+
+def get_setting(name):
+    return getattr(settings, "INVENTORY", {}).get(name, DEFAULTS[name])
+
+
+def enabled():
+    return get_setting("ENABLED")
+
+
+def get_client():
+    if _client is not None:
+        return _client
+    from django_redis import get_redis_connection
+    return get_redis_connection(get_setting("REDIS_ALIAS"))
+
+
+def set_client(client):
+    """ Use `client` instead of the django-redis connection (benchmarks) """
+    global _client
+    _client = client
+    _scripts.clear()
+
+
+def _script(source):
+    client = get_client()
+    key = (id(client), source)
+    if key not in _scripts:
+        _scripts[key] = client.register_script(source)
+    return _scripts[key]
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _pairs(items):
+    args = []
+    for product_id, quantity in items.items():
+        args += [str(product_id), int(quantity)]
+    return args
+
+
+def _reservation_key(reservation_id):
+    return f"{RESERVATION_PREFIX}{reservation_id}"
+
+
+def cart_reservation(user_id):
+    return f"cart:{user_id}"
+
+
+def seed(product_ids, overwrite=False):
+    """ Load Mongo stock for `product_ids` into Redis (one `$in`) """
+    stock = {
+        doc["_id"]: doc.get("stock", 0)
+        for doc in Product._get_collection().find({"_id": {"$in": [ObjectId(pid) for pid in product_ids]}}, {"stock": 1})
+    }
+    if stock:
+        _script(SEED)(keys=[STOCK, PENDING, FLUSHING], args=_pairs(stock) + ["1" if overwrite else "0"])
+    return stock
+
+
+def set_stock(product_id, stock):
+    """ An admin set `Product.stock`; make Redis agree, keeping unflushed sales """
+    _script(SEED)(keys=[STOCK, PENDING, FLUSHING], args=[str(product_id), int(stock), "1"])
+
+
+def _run_seeded(source, keys, args, product_ids):
+    outcome = [_text(part) for part in _script(source)(keys=keys, args=args)]
+    if outcome[0] == "missing":
+        missing = seed(product_ids)
+        outcome = [_text(part) for part in _script(source)(keys=keys, args=args)]
+        if outcome[0] == "missing" and ObjectId(outcome[1]) not in missing:
+            raise Product.DoesNotExist(outcome[1])
+    if outcome[0] == "short":
+        raise OutOfStock(outcome[1])
+
+
+def reserve(reservation_id, items, ttl=None):
+    """
+    Hold {product id: quantity} for `reservation_id`, on top of what it
+    already holds, and push its expiry out by `ttl` seconds. Raises
+    `OutOfStock` (holding nothing) if any product falls short.
+    """
+    ttl = ttl or get_setting("CART_RESERVATION_TTL")
+    _run_seeded(
+        RESERVE,
+        [STOCK, RESERVED, EXPIRY, _reservation_key(reservation_id)],
+        [reservation_id, time.time() + ttl] + _pairs(items),
+        list(items),
+    )
+
+
+def release(reservation_id, product_ids=None):
+    """ Give back what is held for `product_ids` (default: everything) """
+    args = [reservation_id] + [str(product_id) for product_id in product_ids or []]
+    return _script(RELEASE)(keys=[RESERVED, EXPIRY, _reservation_key(reservation_id)], args=args)
+
+
+def unreserve(reservation_id, items):
+    """
+    Undo a `reserve()` of {product id: quantity} (e.g. the cart write
+    failed), leaving what was held before it
+    """
+    _script(UNRESERVE)(keys=[RESERVED, EXPIRY, _reservation_key(reservation_id)], args=[reservation_id] + _pairs(items))
+
+
+def commit(reservation_id, items):
+    """
+    Sell {product id: quantity}, from the reservation's hold where it has
+    one. Raises `OutOfStock` (selling nothing) if any product falls short.
+    """
+    _run_seeded(
+        COMMIT,
+        [STOCK, RESERVED, PENDING, EXPIRY, _reservation_key(reservation_id)],
+        [reservation_id] + _pairs(items),
+        list(items),
+    )
+
+
+def restock(items):
+    """ Undo a `commit()` (e.g. the order could not be written) """
+    _script(RESTOCK)(keys=[STOCK, PENDING], args=_pairs(items))
+
+
+def sweep():
+    """ Release expired reservations; returns how many """
+    released = 0
+    limit = get_setting("SWEEP_BATCH_SIZE")
+    while True:
+        count = _script(SWEEP)(keys=[RESERVED, EXPIRY], args=[time.time(), limit, RESERVATION_PREFIX])
+        released += count
+        if count < limit:
+            return released
+
+
+def flush():
+    """
+    Apply committed decrements to `Product.stock`. A batch is moved aside
+    atomically and stamped with a token; each product update is guarded by
+    that token, so a batch retried after a crash is not applied twice.
+    Returns the number of products updated.
+    """
+    client = get_client()
+    raw = _script(FLUSH_START)(keys=[PENDING, FLUSHING], args=[uuid.uuid4().hex])
+    entries = {_text(raw[i]): _text(raw[i + 1]) for i in range(0, len(raw), 2)}
+    token = entries.pop("_token", None)
+    if token is None:
+        return 0
+
+    products = Product._get_collection()
+    flushed_at = datetime.utcnow()
+    updates = [
+        UpdateOne(
+            {"_id": ObjectId(product_id), "inventory_flushes": {"$ne": token}},
+            {
+                "$inc": {"stock": -int(quantity)},
+                "$push": {"inventory_flushes": {"$each": [token], "$slice": -10}},
+                "$set": {"updated_at": flushed_at},
+            },
+        )
+        for product_id, quantity in entries.items()
+        if int(quantity)
+    ]
+    batch_size = get_setting("FLUSH_BATCH_SIZE")
+    for start in range(0, len(updates), batch_size):
+        products.bulk_write(updates[start:start + batch_size], ordered=False)
+    client.delete(FLUSHING)
+
+    if updates:
+        bump(*[product_tag(product_id) for product_id in entries], PRODUCT_LIST)
+    return len(updates)
+
+
+def reconcile():
+    return sweep(), flush()
+
+
+def available(product_id):
+    """ Stock that can still be reserved, or None if not seeded yet """
+    client = get_client()
+    stock = client.hget(STOCK, str(product_id))
+    if stock is None:
+        return None
+    return int(stock) - int(client.hget(RESERVED, str(product_id)) or 0)
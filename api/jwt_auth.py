@@ -1,6 +1,6 @@
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from bson import ObjectId
-from api.models import User  
+from api import user_cache
+
 
 class MongoDBJWTAuthentication(JWTAuthentication):
     def get_user(self, validated_token):
@@ -9,7 +9,28 @@ class MongoDBJWTAuthentication(JWTAuthentication):
         if not user_id:
             return None
 
-        try:
-            return User.objects.get(id=ObjectId(user_id))
-        except User.DoesNotExist:
+        if user_cache.get_setting("FROM_CLAIMS"):
+            return user_cache.user_from_claims(validated_token)
+
+        return user_cache.get_user(user_id)
+
+
+    async def aauthenticate(self, request):
+        """
+        `authenticate()` for async views. Token validation is CPU-only; the
+        user lookup goes through `user_cache.aget_user`.
+        """
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+
+        user_id = validated_token.get("user_id")
+        if not user_id:
             return None
+        if user_cache.get_setting("FROM_CLAIMS"):
+            return user_cache.user_from_claims(validated_token), validated_token
+        return await user_cache.aget_user(user_id), validated_token
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from api import rollups
+from api.models import Order
+
+
+class Command(BaseCommand):
+    help = (
+        "Set created_at on orders that have none (written before it had a default) "
+        "from the time in their ObjectId. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        orders = Order._get_collection()
+        batch_size = max(1, options["batch_size"])
+        updated, batch = 0, []
+        # Matches a missing field as well as an explicit null.
+        for doc in orders.find({"created_at": None}, {"_id": 1}):
+            batch.append(UpdateOne(
+                {"_id": doc["_id"], "created_at": None}, {"$set": {"created_at": rollups.placed_at(doc)}},
+            ))
+            if len(batch) == batch_size:
+                updated += orders.bulk_write(batch, ordered=False).modified_count
+                batch = []
+        if batch:
+            updated += orders.bulk_write(batch, ordered=False).modified_count
+        self.stdout.write(self.style.SUCCESS(f"Set created_at on {updated} orders."))
@@ -0,0 +1,106 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from api import bench, catalog_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a realistic data set and drive every endpoint through the Django test client, reporting "
+        "throughput, p50/p99 latency, MongoDB commands and cache hit rate per request. Fails if an endpoint "
+        "exceeds its query budget (api.bench.QUERY_BUDGETS) or repeats a read. Uses mongomock and fakeredis "
+        "unless --mongo-url / --redis-url are given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument(
+            "--products", type=int, default=None,
+            help="Default 100000 on a mongod, 2000 under mongomock (whose unique-index checks make seeding quadratic).",
+        )
+        parser.add_argument("--categories", type=int, default=20)
+        parser.add_argument("--cart-lines", type=int, default=3, help="Lines in every seeded cart.")
+        parser.add_argument("--orders-per-user", type=int, default=5)
+        parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint.")
+        parser.add_argument("--cold", action="store_true", help="Clear the cache before every request.")
+        parser.add_argument(
+            "--catalog-snapshot", action="store_true",
+            help="Serve product and category reads from the per-process snapshot (CATALOG_SNAPSHOT).",
+        )
+        parser.add_argument(
+            "--endpoint", action="append", default=[],
+            help="Only run this endpoint (by name, e.g. 'product list'); repeatable.",
+        )
+        parser.add_argument(
+            "--mongo-url", default=None,
+            help="Benchmark a real mongod (e.g. mongodb://127.0.0.1:27017). Its bench_db database is emptied first.",
+        )
+        parser.add_argument("--redis-url", default=None, help="Use this Redis for the cache instead of fakeredis.")
+
+    def handle(self, *args, **options):
+        if options["cold"] and options["catalog_snapshot"]:
+            # Clearing the cache moves the catalog version, so every read would reload the snapshot.
+            raise CommandError("--cold and --catalog-snapshot cannot be combined.")
+        endpoints = bench.ENDPOINTS
+        if options["endpoint"]:
+            names = {endpoint.name for endpoint in endpoints}
+            unknown = set(options["endpoint"]) - names
+            if unknown:
+                raise CommandError(f"Unknown endpoint(s): {', '.join(sorted(unknown))}. Choose from: {', '.join(sorted(names))}.")
+            endpoints = [endpoint for endpoint in endpoints if endpoint.name in options["endpoint"]]
+
+        if options["mongo_url"]:
+            bench.use_mongod(options["mongo_url"])
+        else:
+            bench.use_mongomock()
+        if options["products"] is None:
+            options["products"] = 100_000 if options["mongo_url"] else 2000
+        caches = bench.fakeredis_caches()
+        if options["redis_url"]:
+            caches = {"default": {"BACKEND": "api.cache_backends.RedisCache", "LOCATION": options["redis_url"]}}
+
+        overrides = bench.bench_settings(caches)
+        if options["catalog_snapshot"]:
+            overrides["CATALOG_SNAPSHOT"] = {"ENABLED": True}
+        catalog_snapshot.reset()
+
+        with override_settings(**overrides):
+            from django.core.cache import cache
+            cache.clear()
+
+            started = time.perf_counter()
+            data = bench.seed(
+                users=options["users"], products=options["products"], categories=options["categories"],
+                cart_lines=options["cart_lines"], orders_per_user=options["orders_per_user"],
+            )
+            self.stdout.write(
+                f"Seeded {options['users']} users, {options['products']} products, {options['users']} carts and "
+                f"{options['users'] * options['orders_per_user']} orders in {time.perf_counter() - started:.1f}s"
+            )
+            if options["catalog_snapshot"]:
+                # A worker loads it once, on its first catalog read; keep that out of the budgets.
+                catalog_snapshot.get_snapshot()
+            results = bench.run_endpoints(
+                data, options["requests"], cold=options["cold"], endpoints=endpoints, server=bool(options["mongo_url"]),
+            )
+
+        self.stdout.write(
+            f"{'endpoint':24} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8} {'max':>4} {'budget':>6} {'hit rate':>8}"
+        )
+        problems = []
+        for result in results:
+            budget = bench.QUERY_BUDGETS.get(result.endpoint.name)
+            self.stdout.write(
+                f"{result.endpoint.name:24} {result.throughput:8.0f} "
+                f"{bench.percentile(result.latencies, 50) * 1000:8.2f} {bench.percentile(result.latencies, 99) * 1000:8.2f} "
+                f"{result.mean_commands:8.2f} {max(result.commands, default=0):4} {'-' if budget is None else budget:>6} "
+                f"{result.hit_rate:8.0%}"
+            )
+            problems += result.violations()
+        skipped = [endpoint.name for endpoint in endpoints if endpoint.needs_server and not options["mongo_url"]]
+        if skipped:
+            self.stdout.write(f"Skipped under mongomock: {', '.join(skipped)}")
+        if problems:
+            raise CommandError("Query budget check failed:\n  " + "\n  ".join(problems))
@@ -0,0 +1,116 @@
+import random
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import bench, inventory
+from api.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer Redis stock reservations from concurrent clients, then flush to MongoDB and check "
+        "that nothing was oversold. Uses mongomock, and fakeredis unless --redis-url is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=20)
+        parser.add_argument("--stock", type=int, default=100, help="Initial stock of every product.")
+        parser.add_argument("--clients", type=int, default=16, help="Concurrent client threads.")
+        parser.add_argument("--operations", type=int, default=500, help="Reservations attempted per client.")
+        parser.add_argument("--max-quantity", type=int, default=3)
+        parser.add_argument("--commit-ratio", type=float, default=0.5, help="Share of reservations that are checked out.")
+        parser.add_argument(
+            "--redis-url", default=None,
+            help="Benchmark a real Redis (e.g. redis://127.0.0.1:6379/15). Its inventory keys are deleted first.",
+        )
+
+    def handle(self, *args, **options):
+        client = self.redis_client(options["redis_url"])
+        for key in client.scan_iter(match="{inv}:*"):
+            client.delete(key)
+        inventory.set_client(client)
+
+        bench.use_mongomock()
+        bench.seed_catalog(options["products"], categories=1)
+        Product._get_collection().update_many({}, {"$set": {"stock": options["stock"]}})
+        product_ids = [str(doc["_id"]) for doc in Product._get_collection().find({}, {"_id": 1})]
+        inventory.seed(product_ids)
+
+        sold = Counter()
+        outcomes = Counter()
+        latencies = []
+        lock = threading.Lock()
+
+        def run_client(number):
+            rng = random.Random(number)
+            mine, counts, timings = Counter(), Counter(), []
+            for i in range(options["operations"]):
+                reservation_id = f"bench:{number}:{i}"
+                items = {
+                    product_id: rng.randint(1, options["max_quantity"])
+                    for product_id in rng.sample(product_ids, rng.randint(1, min(3, len(product_ids))))
+                }
+                started = time.perf_counter()
+                try:
+                    inventory.reserve(reservation_id, items, ttl=60)
+                except inventory.OutOfStock:
+                    counts["short"] += 1
+                    continue
+                finally:
+                    timings.append(time.perf_counter() - started)
+                counts["reserved"] += 1
+                if rng.random() < options["commit_ratio"]:
+                    inventory.commit(reservation_id, items)
+                    mine.update(items)
+                    counts["committed"] += 1
+                else:
+                    inventory.release(reservation_id)
+                    counts["released"] += 1
+            with lock:
+                sold.update(mine)
+                outcomes.update(counts)
+                latencies.extend(timings)
+
+        threads = [threading.Thread(target=run_client, args=(n,)) for n in range(options["clients"])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        inventory.reconcile()
+        mongo_stock = {str(doc["_id"]): doc["stock"] for doc in Product._get_collection().find({}, {"stock": 1})}
+        oversold = {pid: -stock for pid, stock in mongo_stock.items() if stock < 0}
+        drift = {
+            pid: stock for pid, stock in mongo_stock.items()
+            if stock != options["stock"] - sold[pid] or inventory.available(pid) != stock
+        }
+
+        attempts = outcomes["reserved"] + outcomes["short"]
+        self.stdout.write(f"clients: {options['clients']}, products: {len(product_ids)}, stock each: {options['stock']}")
+        self.stdout.write(
+            f"reservation attempts: {attempts} ({outcomes['reserved']} held, {outcomes['short']} out of stock) "
+            f"in {elapsed:.2f}s = {attempts / elapsed:.0f} reservations/s"
+        )
+        self.stdout.write(
+            f"reserve latency: p50 {bench.percentile(latencies, 50) * 1000:.2f} ms, "
+            f"p99 {bench.percentile(latencies, 99) * 1000:.2f} ms"
+        )
+        self.stdout.write(f"checked out: {outcomes['committed']}, released: {outcomes['released']}, units sold: {sum(sold.values())}")
+        if oversold or drift:
+            raise CommandError(f"Inventory mismatch: oversold {oversold}, drift {drift}")
+        self.stdout.write(self.style.SUCCESS("zero oversell; MongoDB stock matches Redis after the flush"))
+
+    def redis_client(self, url):
+        if url:
+            import redis
+            return redis.Redis.from_url(url)
+        try:
+            import fakeredis
+        except ImportError:
+            raise CommandError("fakeredis is not installed; pass --redis-url to use a Redis server (pip install fakeredis lupa).")
+        return fakeredis.FakeStrictRedis()
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from api import bench
+from api.fast_render import PRODUCT_ROWS
+from api.models import Product
+from api.renderers import MongoJSONRenderer
+from api.serializers import ProductSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare rows/sec of the serializer list path against the as_pymongo() fast path."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=200, help="Rows per list response (page size).")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--mongomock", type=int, default=0, metavar="PRODUCTS",
+            help="Seed this many products into an in-memory mongomock database instead of using the configured one.",
+        )
+
+    def handle(self, *args, **options):
+        if options["mongomock"]:
+            bench.use_mongomock()
+            bench.seed_catalog(options["mongomock"])
+
+        rows = options["rows"]
+
+        def serializer_path():
+            documents = list(Product.objects.order_by("id").limit(rows))
+            return JSONRenderer().render(ProductSerializer(documents, many=True).data)
+
+        def fast_path():
+            raw = list(Product.objects.order_by("id").limit(rows).only(*PRODUCT_ROWS.fields).as_pymongo())
+            return MongoJSONRenderer().render(PRODUCT_ROWS.convert(raw))
+
+        slow_time, slow_body = bench.best_of(serializer_path, options["repeat"])
+        fast_time, fast_body = bench.best_of(fast_path, options["repeat"])
+        if slow_body != fast_body:
+            raise CommandError("Fast path output differs from the serializer output.")
+
+        count = len(Product.objects.order_by("id").limit(rows).only("id").as_pymongo())
+        if not count:
+            raise CommandError("No products to render; seed some or pass --mongomock N.")
+        self.stdout.write(f"rows per response: {count}")
+        self.stdout.write(f"serializer path:   {count / slow_time:12.0f} rows/s  ({slow_time * 1000:.1f} ms)")
+        self.stdout.write(f"fast path:         {count / fast_time:12.0f} rows/s  ({fast_time * 1000:.1f} ms)")
+        self.stdout.write(self.style.SUCCESS(f"speedup: {slow_time / fast_time:.1f}x, output byte-identical"))
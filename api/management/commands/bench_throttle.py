@@ -0,0 +1,85 @@
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django_redis.cache import RedisCache
+from rest_framework.request import Request
+from rest_framework.throttling import UserRateThrottle
+
+from api import bench, throttling
+
+
+class Command(BaseCommand):
+    help = (
+        "Per-request overhead and Redis round trips of DRF's UserRateThrottle versus the GCRA throttle, "
+        "both on the same Redis (fakeredis unless --redis-url is given)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=5000)
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument("--rate", default="100/hour", help="Rate under test; most requests end up over it.")
+        parser.add_argument(
+            "--redis-url", default=None,
+            help="Benchmark a real Redis (e.g. redis://127.0.0.1:6379/15). Its throttle keys are deleted first.",
+        )
+
+    def handle(self, *args, **options):
+        client = self.redis_client(options["redis_url"])
+        round_trips = [0]
+        execute_command = client.execute_command
+
+        def counted(*args, **kwargs):
+            round_trips[0] += 1
+            return execute_command(*args, **kwargs)
+
+        client.execute_command = counted
+
+        drf_cache = RedisCache(options["redis_url"] or "redis://127.0.0.1:6379/0", {})
+        drf_cache.client._clients = [client]
+        throttling.set_client(client)
+        rate = options["rate"]
+
+        class DRFThrottle(UserRateThrottle):
+            cache = drf_cache
+            THROTTLE_RATES = {"user": rate}
+
+        class GCRA(throttling.GCRAThrottle):
+            def get_rate_name(self, request, view):
+                return "bench", rate
+
+        view = SimpleNamespace()
+        factory = RequestFactory()
+        requests = []
+        for i in range(options["requests"]):
+            request = Request(factory.get("/api/products/"))
+            request.user = SimpleNamespace(is_authenticated=True, pk=f"user{i % options['users']}")
+            requests.append(request)
+
+        self.stdout.write(f"{options['requests']} requests from {options['users']} users at {rate}")
+        for label, throttle_class in (("DRF UserRateThrottle", DRFThrottle), ("GCRA throttle", GCRA)):
+            for key in client.scan_iter(match="*throttle*"):
+                client.delete(key)
+            throttling._denied.clear()
+            round_trips[0] = 0
+            allowed, latencies = 0, []
+            for request in requests:
+                started = time.perf_counter()
+                allowed += throttle_class().allow_request(request, view)
+                latencies.append(time.perf_counter() - started)
+            self.stdout.write(
+                f"{label:22} {sum(latencies) / len(latencies) * 1e6:8.1f} us/request "
+                f"(p50 {bench.percentile(latencies, 50) * 1e6:.1f}, p99 {bench.percentile(latencies, 99) * 1e6:.1f})  "
+                f"{round_trips[0] / len(requests):.2f} round trips/request  {allowed} allowed"
+            )
+
+    def redis_client(self, url):
+        if url:
+            import redis
+            return redis.Redis.from_url(url)
+        try:
+            import fakeredis
+        except ImportError:
+            raise CommandError("fakeredis is not installed; pass --redis-url to use a Redis server (pip install fakeredis lupa).")
+        return fakeredis.FakeStrictRedis()
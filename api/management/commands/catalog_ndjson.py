@@ -0,0 +1,54 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import catalog_io
+
+
+class Command(BaseCommand):
+    help = "Stream the catalog to or from NDJSON (one JSON object per line)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("direction", choices=["import", "export"])
+        parser.add_argument("kind", choices=sorted(catalog_io.IMPORTERS))
+        parser.add_argument("path", nargs="?", default="-", help="File to read or write; '-' for stdin/stdout.")
+        parser.add_argument("--chunk-size", type=int, default=catalog_io.IMPORT_CHUNK_SIZE)
+        parser.add_argument("--max-errors", type=int, default=50, help="Number of row errors to print.")
+
+    def handle(self, *args, **options):
+        if options["direction"] == "import":
+            self.do_import(options)
+        else:
+            self.do_export(options)
+
+    def do_import(self, options):
+        importer = catalog_io.IMPORTERS[options["kind"]]
+        if options["path"] == "-":
+            report = importer(sys.stdin.buffer, chunk_size=options["chunk_size"])
+        else:
+            try:
+                with open(options["path"], "rb") as source:
+                    report = importer(source, chunk_size=options["chunk_size"])
+            except OSError as exc:
+                raise CommandError(exc)
+
+        for error in report.errors[:options["max_errors"]]:
+            self.stderr.write(f"line {error['line']}: {json.dumps(error['errors'])}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{report.created} created, {report.updated} updated, {len(report.errors)} failed."
+        ))
+
+    def do_export(self, options):
+        lines = catalog_io.EXPORTERS[options["kind"]]()
+        if options["path"] == "-":
+            for line in lines:
+                sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+            return
+        count = 0
+        with open(options["path"], "wb") as target:
+            for line in lines:
+                target.write(line)
+                count += 1
+        self.stderr.write(f"Exported {count} {options['kind']}.")
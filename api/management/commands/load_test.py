@@ -0,0 +1,87 @@
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import bench
+
+
+def run_load(url, concurrency, duration, headers):
+    """
+    Keep `concurrency` keep-alive connections busy against `url` for
+    `duration` seconds; returns (completed, errors, latencies in seconds).
+    """
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    target = parts.path + (f"?{parts.query}" if parts.query else "")
+    deadline = time.perf_counter() + duration
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def worker():
+        connection = connection_class(parts.netloc, timeout=30)
+        local_latencies, local_errors = [], 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                connection.request("GET", target, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    local_errors += 1
+                else:
+                    local_latencies.append(time.perf_counter() - started)
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+                connection = connection_class(parts.netloc, timeout=30)
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), sum(errors), latencies
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive concurrent GETs at an ASGI deployment (async routes) and a WSGI "
+        "deployment (sync routes) and report throughput and latency per worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("asgi_url", help="e.g. http://127.0.0.1:8001/api/async/products/")
+        parser.add_argument("wsgi_url", nargs="?", help="e.g. http://127.0.0.1:8000/api/products/")
+        parser.add_argument("--token", help="JWT access token sent as a Bearer Authorization header.")
+        parser.add_argument("--concurrency", default="1,8,32,128", help="Comma-separated concurrency levels.")
+        parser.add_argument("--duration", type=float, default=10.0, help="Seconds per level.")
+        parser.add_argument("--asgi-workers", type=int, default=1, help="Worker processes behind asgi_url.")
+        parser.add_argument("--wsgi-workers", type=int, default=1, help="Worker processes behind wsgi_url.")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options["concurrency"].split(",")]
+        except ValueError:
+            raise CommandError("--concurrency must be a comma-separated list of integers.")
+        headers = {"Authorization": f"Bearer {options['token']}"} if options["token"] else {}
+
+        targets = [("asgi", options["asgi_url"], options["asgi_workers"])]
+        if options["wsgi_url"]:
+            targets.append(("wsgi", options["wsgi_url"], options["wsgi_workers"]))
+
+        self.stdout.write(f"{'server':<6} {'conc':>5} {'req/s':>9} {'req/s/worker':>13} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for concurrency in levels:
+            for name, url, workers in targets:
+                completed, errors, latencies = run_load(url, concurrency, options["duration"], headers)
+                throughput = completed / options["duration"]
+                self.stdout.write(
+                    f"{name:<6} {concurrency:>5} {throughput:>9.1f} {throughput / workers:>13.1f} "
+                    f"{bench.percentile(latencies, 50) * 1000:>8.1f} {bench.percentile(latencies, 99) * 1000:>8.1f} {errors:>7}"
+                )
@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+from api.models import Cart, Category, CategoryDeletion, Coupon, Order, OutboxEvent, Product, SalesRollup, TaskCheckpoint, User
+from api.query_shapes import QUERY_SHAPES
+
+DOCUMENTS = [User, Category, Product, Cart, Order, Coupon, TaskCheckpoint, OutboxEvent, SalesRollup, CategoryDeletion]
+
+
+def _raw_collection(document):
+    # Document._get_collection() would run ensure_indexes() (a foreground
+    # build on old servers) the first time it is called; go around it.
+    return document._get_db()[document._get_collection_name()]
+
+
+def _stages(plan):
+    """ Yield every `stage` name of the winning plan(s) in an explain document """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the indexes declared in api/models.py without blocking, then run "
+        "explain() on every query shape in api/query_shapes.py and flag COLLSCANs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--no-sync", action="store_true", help="Do not create missing indexes.")
+        parser.add_argument("--no-explain", action="store_true", help="Do not explain query shapes.")
+        parser.add_argument(
+            "--warn-only", action="store_true", help="Report COLLSCANs without failing (exit status 0)."
+        )
+
+    def handle(self, *args, **options):
+        if not options["no_sync"]:
+            self.sync_indexes()
+        if not options["no_explain"]:
+            failures = self.explain_shapes()
+            if failures and not options["warn_only"]:
+                raise CommandError(f"{len(failures)} query shape(s) use a collection scan: {', '.join(failures)}")
+
+    def sync_indexes(self):
+        for document in DOCUMENTS:
+            collection = _raw_collection(document)
+            models = []
+            for spec in document._meta["index_specs"]:
+                options = {key: value for key, value in spec.items() if key != "fields"}
+                # Ignored (and harmless) on 4.2+, where every build only locks
+                # the collection briefly at the start and end.
+                options.setdefault("background", True)
+                models.append(IndexModel(spec["fields"], **options))
+            if models:
+                created = collection.create_indexes(models)
+                self.stdout.write(f"{collection.name}: {', '.join(created)}")
+
+            extra = document.compare_indexes()["extra"]
+            if extra:
+                self.stdout.write(self.style.WARNING(f"{collection.name}: undeclared indexes {extra}"))
+
+    def explain_shapes(self):
+        failures = []
+        for shape in QUERY_SHAPES:
+            collection = _raw_collection(shape.document)
+            try:
+                if shape.pipeline is not None:
+                    plan = collection.database.command(
+                        "explain",
+                        {"aggregate": collection.name, "pipeline": shape.pipeline, "cursor": {}},
+                        verbosity="queryPlanner",
+                    )
+                else:
+                    cursor = collection.find(shape.filter)
+                    if shape.sort:
+                        cursor = cursor.sort(shape.sort)
+                    plan = cursor.explain()
+            except OperationFailure as exc:
+                failures.append(shape.name)
+                self.stdout.write(self.style.ERROR(f"ERROR     {shape.name}: {exc}"))
+                continue
+
+            stages = set(_stages(plan.get("queryPlanner", plan)))
+            if "COLLSCAN" in stages:
+                failures.append(shape.name)
+                self.stdout.write(self.style.ERROR(f"COLLSCAN  {shape.name}"))
+            elif "SORT" in stages:
+                self.stdout.write(self.style.WARNING(f"SORT      {shape.name} (in-memory sort)"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"ok        {shape.name}"))
+        return failures
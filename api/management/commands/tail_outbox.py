@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand
+from pymongo.errors import OperationFailure, PyMongoError
+
+from api import outbox
+from api.models import OutboxEvent
+
+
+class Command(BaseCommand):
+    help = (
+        "Deliver outbox events as they are written by tailing a change stream on "
+        "the outbox collection, polling instead where change streams are unavailable."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll", type=float, default=5.0,
+            help="Seconds between drains when idle (picks up retries and held events).",
+        )
+        parser.add_argument("--batch-size", type=int, default=outbox.OUTBOX_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.drain()
+        try:
+            self.tail()
+        except OperationFailure as exc:
+            # Standalone servers have no oplog to stream from.
+            self.stderr.write(self.style.WARNING(f"Change streams unavailable ({exc}); polling every {options['poll']}s."))
+            self.poll()
+
+    def drain(self):
+        processed = outbox.drain(self.options["batch_size"])
+        if processed:
+            self.stdout.write(f"processed {processed} event(s)")
+
+    def tail(self):
+        # Inserts cover transactional writes; updates that move available_at
+        # without taking a lease are events released by a confirmed write
+        # outside a transaction. The consumers' own claim/ack updates are
+        # left out so that a drain does not trigger another one.
+        pipeline = [{"$match": {"$or": [
+            {"operationType": "insert"},
+            {
+                "operationType": "update",
+                "updateDescription.updatedFields.available_at": {"$exists": True},
+                "updateDescription.updatedFields.lease": {"$exists": False},
+            },
+        ]}}]
+        max_await_ms = int(self.options["poll"] * 1000)
+        while True:
+            try:
+                with OutboxEvent._get_collection().watch(pipeline, max_await_time_ms=max_await_ms) as stream:
+                    self.stdout.write("tailing the outbox change stream")
+                    while stream.alive:
+                        # Each drain handles everything due, so a burst of
+                        # changes costs one drain rather than one per event.
+                        stream.try_next()
+                        self.drain()
+            except OperationFailure:
+                raise
+            except PyMongoError as exc:
+                self.stderr.write(self.style.WARNING(f"Change stream interrupted ({exc}); reopening."))
+                time.sleep(1)
+                self.drain()
+
+    def poll(self):
+        while True:
+            self.drain()
+            time.sleep(self.options["poll"])
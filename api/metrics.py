@@ -0,0 +1,272 @@
+"""
+Per-view request metrics, cheap enough to leave on in production.
+
+`MetricsMiddleware` (api/middleware.py) opens a `RequestStats` for each
+request; the MongoDB command listener, the instrumented cache backends
+(api/cache_backends.py) and the JSON renderer add to it. When the response
+leaves, the request is folded into per-view counters and a latency
+histogram. Those aggregates are per thread (each thread only writes its
+own, so no locks are taken on the request path) and are summed when
+`/api/metrics/` is scraped, in the Prometheus text format.
+
+A request that repeats one read on one collection N_PLUS_ONE_THRESHOLD
+times or more is counted (and logged, once per view) as a likely N+1.
+
+This module is imported by the settings (for the command listener), so it
+must not import models or anything that reads settings at import time.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import Counter
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    # Add a Server-Timing header with the request's breakdown.
+    "SERVER_TIMING_HEADER": False,
+    "N_PLUS_ONE_THRESHOLD": 5,
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+READ_COMMANDS = frozenset({"find", "aggregate", "count", "distinct", "getMore"})
+# Any other method (the client picks it) is counted as "OTHER", so the
+# aggregates and label sets stay bounded by the URLconf.
+METHODS = frozenset({"GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"})
+
+_current = contextvars.ContextVar("request_stats", default=None)
+
+
+def get_setting(name):
+    from django.conf import settings
+    return getattr(settings, "METRICS", {}).get(name, DEFAULTS[name])
+
+
+class RequestStats:
+    """ What one request spent, filled in while it runs """
+    __slots__ = ("started", "mongo_commands", "mongo_seconds", "cache_hits", "cache_misses", "render_seconds", "reads")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.render_seconds = 0.0
+        self.reads = Counter()
+
+    def repeated_reads(self, threshold):
+        """ (command, collection) pairs issued at least `threshold` times """
+        return [shape for shape, count in self.reads.items() if count >= threshold]
+
+    def server_timing(self, elapsed):
+        return ", ".join([
+            f"total;dur={elapsed * 1000:.1f}",
+            f'mongo;dur={self.mongo_seconds * 1000:.1f};desc="{self.mongo_commands} commands"',
+            f'cache;desc="{self.cache_hits} hits {self.cache_misses} misses"',
+            f"render;dur={self.render_seconds * 1000:.1f}",
+        ])
+
+
+def begin():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def record_cache(hits, misses):
+    stats = _current.get()
+    if stats is not None:
+        stats.cache_hits += hits
+        stats.cache_misses += misses
+
+
+class render_timer:
+    """ Context manager adding its duration to the request's render time """
+    __slots__ = ("stats", "started")
+
+    def __enter__(self):
+        self.stats = _current.get()
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.stats is not None:
+            self.stats.render_seconds += time.perf_counter() - self.started
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Counts commands (and their server round-trip time) against the request
+    that issued them. Commands run outside a request, e.g. by Celery tasks
+    or by motor's worker threads, are not counted.
+    """
+
+    def started(self, event):
+        stats = _current.get()
+        if stats is not None and event.command_name in READ_COMMANDS:
+            stats.reads[(event.command_name, event.command.get(event.command_name))] += 1
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        stats = _current.get()
+        if stats is not None:
+            stats.mongo_commands += 1
+            stats.mongo_seconds += event.duration_micros / 1e6
+
+
+class ViewStats:
+    __slots__ = (
+        "requests", "latency_sum", "latency_buckets", "statuses", "mongo_commands", "mongo_seconds",
+        "cache_hits", "cache_misses", "render_seconds", "n_plus_one",
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.statuses = Counter()
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.render_seconds = 0.0
+        self.n_plus_one = 0
+
+
+_local = threading.local()
+_registry_lock = threading.Lock()
+# Every thread's {(view, method): ViewStats}; only its own thread writes one.
+_aggregates = []
+# Views whose N+1 has been logged, under _registry_lock. Capped as a
+# backstop; unmatched paths all share one view name already.
+_reported_n_plus_one = set()
+MAX_REPORTED_N_PLUS_ONE = 1000
+
+
+def _thread_aggregate():
+    aggregate = getattr(_local, "aggregate", None)
+    if aggregate is None:
+        aggregate = _local.aggregate = {}
+        with _registry_lock:
+            _aggregates.append(aggregate)
+    return aggregate
+
+
+def record(view, method, status_code, elapsed, stats):
+    """ Fold a finished request into this thread's aggregate """
+    aggregate = _thread_aggregate()
+    if method not in METHODS:
+        method = "OTHER"
+    key = (view, method)
+    totals = aggregate.get(key)
+    if totals is None:
+        totals = aggregate[key] = ViewStats()
+    totals.requests += 1
+    totals.latency_sum += elapsed
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if elapsed <= bound:
+            totals.latency_buckets[i] += 1
+            break
+    totals.statuses[f"{status_code // 100}xx"] += 1
+    totals.mongo_commands += stats.mongo_commands
+    totals.mongo_seconds += stats.mongo_seconds
+    totals.cache_hits += stats.cache_hits
+    totals.cache_misses += stats.cache_misses
+    totals.render_seconds += stats.render_seconds
+
+    repeated = stats.repeated_reads(get_setting("N_PLUS_ONE_THRESHOLD"))
+    if repeated:
+        totals.n_plus_one += 1
+        # Only requests with an N+1 get here, so the lock stays off the hot path.
+        with _registry_lock:
+            first = key not in _reported_n_plus_one and len(_reported_n_plus_one) < MAX_REPORTED_N_PLUS_ONE
+            if first:
+                _reported_n_plus_one.add(key)
+        if first:
+            logger.warning("Likely N+1 in %s %s: repeated %s", method, view, ", ".join(f"{c} on {coll}" for c, coll in repeated))
+    return repeated
+
+
+def snapshot():
+    """ {(view, method): ViewStats} summed over every thread """
+    with _registry_lock:
+        aggregates = list(_aggregates)
+    merged = {}
+    for aggregate in aggregates:
+        for key, stats in list(aggregate.items()):
+            total = merged.get(key)
+            if total is None:
+                total = merged[key] = ViewStats()
+            total.requests += stats.requests
+            total.latency_sum += stats.latency_sum
+            total.latency_buckets = [a + b for a, b in zip(total.latency_buckets, stats.latency_buckets)]
+            total.statuses.update(stats.statuses)
+            for name in ("mongo_commands", "mongo_seconds", "cache_hits", "cache_misses", "render_seconds", "n_plus_one"):
+                setattr(total, name, getattr(total, name) + getattr(stats, name))
+    return merged
+
+
+def reset():
+    with _registry_lock:
+        for aggregate in _aggregates:
+            aggregate.clear()
+        _reported_n_plus_one.clear()
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+COUNTERS = (
+    ("api_mongo_commands_total", "MongoDB commands issued.", "mongo_commands"),
+    ("api_mongo_command_seconds_total", "Time spent in MongoDB commands.", "mongo_seconds"),
+    ("api_cache_hits_total", "Cache reads that found a value.", "cache_hits"),
+    ("api_cache_misses_total", "Cache reads that found nothing.", "cache_misses"),
+    ("api_render_seconds_total", "Time spent rendering response bodies.", "render_seconds"),
+    ("api_n_plus_one_requests_total", "Requests that repeated one read on one collection N_PLUS_ONE_THRESHOLD times or more.", "n_plus_one"),
+)
+
+
+def render_prometheus(stats=None):
+    """ The Prometheus text exposition (format 0.0.4) of `snapshot()` """
+    stats = snapshot() if stats is None else stats
+    views = sorted(stats.items())
+    lines = [
+        "# HELP api_request_duration_seconds Request latency by view.",
+        "# TYPE api_request_duration_seconds histogram",
+    ]
+    for (view, method), totals in views:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, totals.latency_buckets):
+            cumulative += count
+            lines.append(f"api_request_duration_seconds_bucket{{{_labels(view=view, method=method, le=bound)}}} {cumulative}")
+        lines.append(f'api_request_duration_seconds_bucket{{{_labels(view=view, method=method, le="+Inf")}}} {totals.requests}')
+        lines.append(f"api_request_duration_seconds_sum{{{_labels(view=view, method=method)}}} {totals.latency_sum}")
+        lines.append(f"api_request_duration_seconds_count{{{_labels(view=view, method=method)}}} {totals.requests}")
+
+    lines += ["# HELP api_responses_total Responses by status class.", "# TYPE api_responses_total counter"]
+    for (view, method), totals in views:
+        for status_class, count in sorted(totals.statuses.items()):
+            lines.append(f"api_responses_total{{{_labels(view=view, method=method, status=status_class)}}} {count}")
+
+    for name, help_text, field in COUNTERS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for (view, method), totals in views:
+            lines.append(f"{name}{{{_labels(view=view, method=method)}}} {getattr(totals, field)}")
+    return "\n".join(lines) + "\n"
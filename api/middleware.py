@@ -0,0 +1,54 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+
+class MetricsMiddleware:
+    """
+    Records each request's latency, MongoDB commands, cache hits and misses
+    and render time against its view (see api/metrics.py). Works under WSGI
+    and ASGI without a thread hop.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not metrics.get_setting("ENABLED"):
+            return self.get_response(request)
+        stats, token = metrics.begin()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end(token)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        if not metrics.get_setting("ENABLED"):
+            return await self.get_response(request)
+        stats, token = metrics.begin()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.end(token)
+        return self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        elapsed = time.perf_counter() - stats.started
+        match = getattr(request, "resolver_match", None)
+        view = (match.view_name or match.route) if match else "unmatched"
+        repeated = metrics.record(view, request.method, response.status_code, elapsed, stats)
+        if metrics.get_setting("SERVER_TIMING_HEADER"):
+            response["Server-Timing"] = stats.server_timing(elapsed)
+            if repeated:
+                response["X-N-Plus-One"] = ", ".join(f"{command} {collection}" for command, collection in repeated)
+        return response
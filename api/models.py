@@ -1,10 +1,11 @@
 from mongoengine import (
     Document, EmbeddedDocument, StringField, EmailField, ReferenceField, 
     ListField, BooleanField, IntField, DecimalField, DateTimeField, 
-    EmbeddedDocumentListField, URLField, CASCADE, ObjectIdField
+    EmbeddedDocumentListField, URLField, ObjectIdField, DictField
 )
 from django.contrib.auth.hashers import make_password, check_password
 from bson import ObjectId
+from datetime import datetime
 
 
 class User(Document):
@@ -19,6 +20,19 @@ class User(Document):
 
     def check_password(self, raw_password):
         return check_password(raw_password, self.password)
+
+    def save(self, *args, **kwargs):
+        from .user_cache import invalidate_user
+
+        result = super().save(*args, **kwargs)
+        invalidate_user(self.id)
+        return result
+
+    def delete(self, *args, **kwargs):
+        from .user_cache import invalidate_user
+
+        super().delete(*args, **kwargs)
+        invalidate_user(self.id)
     
     @property
     def is_authenticated(self):
@@ -40,6 +54,9 @@ class Category(Document):
     # id = ObjectIdField(primary_key=True)
     name = StringField(required=True, unique=True)
     description = StringField()
+    # Set when the category is deleted; the document itself goes once its
+    # products have been purged in the background (api/category_purge.py).
+    deleted_at = DateTimeField()
     
     meta = {'collection': 'categories'}
 
@@ -50,24 +67,67 @@ class Product(Document):
     # id = ObjectIdField(primary_key=True)
     name = StringField(required=True, unique=True)
     description = StringField()
-    category = ReferenceField(Category, required=True, reverse_delete_rule=CASCADE)
+    # No reverse_delete_rule: api/category_purge.py removes a deleted
+    # category's products in batches rather than one by one in the request.
+    category = ReferenceField(Category, required=True)
     price = DecimalField(required=True, precision=2)
     stock = IntField(default=0)
     images = ListField(URLField())
+    # Recent inventory flush batches applied to `stock` (api/inventory.py)
+    inventory_flushes = ListField(StringField())
+    # {order, quantity} for stock taken by a checkout without a transaction
+    # that has not been confirmed yet (api/checkout.py)
+    checkout_holds = ListField(DictField())
+    # The catalog snapshot refreshes from this (api/catalog_snapshot.py).
+    updated_at = DateTimeField(default=datetime.utcnow)
     
-    meta = {'collection': 'products'}
+    meta = {
+        'collection': 'products',
+        # Keyset pagination sorts on (field, _id); see api/pagination.py
+        'indexes': [
+            ('price', 'id'),
+            ('name', 'id'),
+            ('category', 'id'),
+            ('category', 'price', 'id'),
+            ('category', 'name', 'id'),
+            'updated_at',
+            {'fields': ['checkout_holds.order'], 'sparse': True},
+            # Product search; see api/search.py
+            {
+                'fields': ['$name', '$description'],
+                'default_language': 'english',
+                'weights': {'name': 10, 'description': 2},
+            },
+        ],
+    }
+
+    def save(self, *args, **kwargs):
+        # Raw updates elsewhere must stamp `updated_at` themselves.
+        self.updated_at = datetime.utcnow()
+        return super().save(*args, **kwargs)
 
 class CartItem(EmbeddedDocument):
     # id = ObjectIdField(primary_key=True)
     product = ReferenceField(Product, required=True)
     quantity = IntField(default=1)
+    # Snapshot of the product taken when it was added, so reading a cart never
+    # dereferences products. Kept fresh by tasks.refresh_cart_snapshots.
+    name = StringField()
+    price = DecimalField(precision=2)
+    thumbnail = StringField()
 
 class Cart(Document):
     # id = ObjectIdField(primary_key=True)
     user = ReferenceField(User, required=True, unique=True)
     items = EmbeddedDocumentListField(CartItem)
+    # Sum of quantity * snapshot price, maintained with $inc on every mutation.
+    subtotal = DecimalField(precision=2, default=0)
     
-    meta = {'collection': 'carts'}
+    meta = {
+        'collection': 'carts',
+        # Snapshot refreshes find every cart holding a product.
+        'indexes': ['items.product'],
+    }
 
 class OrderItem(EmbeddedDocument):
     # id = ObjectIdField(primary_key=True)
@@ -83,9 +143,105 @@ class Order(Document):
     items = EmbeddedDocumentListField(OrderItem)
     total_price = DecimalField(required=True, precision=2)
     status = StringField(choices=STATUS_CHOICES, default='Pending')
-    created_at = DateTimeField(auto_now_add=True)
+    created_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)
+    status_changed_at = DateTimeField(default=datetime.utcnow)
+    coupon_code = StringField()
     
-    meta = {'collection': 'orders'}
+    meta = {
+        'collection': 'orders',
+        'indexes': [
+            # Order history pages: (created_at, _id) within one user.
+            ('user', '-created_at', '-id'),
+            ('user', 'status', '-created_at', '-id'),
+            ('status', 'created_at'),
+            'created_at',
+            'status_changed_at',
+        ],
+    }
+
+    def save(self, *args, **kwargs):
+        # Raw updates elsewhere must maintain these two fields themselves.
+        now = datetime.utcnow()
+        if self.pk is None or "status" in self._get_changed_fields():
+            self.status_changed_at = now
+        self.updated_at = now
+        return super().save(*args, **kwargs)
+
+class TaskCheckpoint(Document):
+    """ High-water mark of an incremental periodic task, keyed by task name """
+    name = StringField(primary_key=True)
+    position = DateTimeField()
+
+    meta = {'collection': 'task_checkpoints'}
+
+class OutboxEvent(Document):
+    """
+    An event written together with the change it describes and delivered
+    by `api.outbox.drain` (see that module).
+    """
+    topic = StringField(required=True)
+    payload = DictField()
+    created_at = DateTimeField(default=datetime.utcnow)
+    # Not claimable before this: lease expiry, or a not yet confirmed write.
+    available_at = DateTimeField(default=datetime.utcnow)
+    lease = StringField()
+    attempts = IntField(default=0)
+    # Handlers that already succeeded, so a redelivery skips them.
+    handled = ListField(StringField())
+    processed_at = DateTimeField()
+
+    meta = {
+        'collection': 'outbox',
+        'indexes': [
+            ('processed_at', 'available_at'),
+            {'fields': ['processed_at'], 'expireAfterSeconds': 7 * 24 * 3600},
+        ],
+    }
+
+class CategoryDeletion(Document):
+    """ Progress of one category's background purge (see api/category_purge.py) """
+    STATUS_CHOICES = ('Running', 'Done')
+
+    category = ObjectIdField(required=True)
+    name = StringField()
+    # Move the products here instead of deleting them.
+    reassign_to = ObjectIdField()
+    status = StringField(choices=STATUS_CHOICES, default='Running')
+    # Products in the category when the deletion started.
+    products_total = IntField(default=0)
+    products_done = IntField(default=0)
+    carts_updated = IntField(default=0)
+    created_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)
+    finished_at = DateTimeField()
+
+    meta = {
+        'collection': 'category_deletions',
+        'indexes': [
+            ('status', 'updated_at'),
+        ],
+    }
+
+class SalesRollup(Document):
+    """ Sales for one hour or one day, maintained incrementally by `api.rollups` """
+    GRANULARITIES = ('hour', 'day')
+
+    granularity = StringField(choices=GRANULARITIES, required=True)
+    period = DateTimeField(required=True)
+    revenue_cents = IntField(default=0)
+    orders = IntField(default=0)
+    units = IntField(default=0)
+    # Units sold, keyed by product / category id.
+    products = DictField()
+    categories = DictField()
+
+    meta = {
+        'collection': 'sales_rollups',
+        'indexes': [
+            {'fields': ('granularity', 'period'), 'unique': True},
+        ],
+    }
 
 class Coupon(Document):
     # id = ObjectIdField(primary_key=True)
@@ -93,5 +249,7 @@ class Coupon(Document):
     discount_percentage = IntField(required=True, min_value=1, max_value=100)
     expiry_date = DateTimeField(required=True)
     usage_limit = IntField(default=1)
+    # Claimed atomically by api.coupons.claim().
+    used_count = IntField(default=0)
     
     meta = {'collection': 'coupons'}
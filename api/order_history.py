@@ -0,0 +1,44 @@
+"""
+The summary block of a user's order history (`GET /api/orders/`).
+
+Order count, lifetime spend and orders by status come from one aggregation
+over the `user` prefix of the orders indexes, cached per user under the
+user's `orders_tag` generation. New orders, status changes and coupons bump
+that tag, so the cached summary never outlives the orders it counts.
+"""
+from bson import ObjectId
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Order
+
+# Spend leaves out orders that never went through.
+UNPAID_STATUSES = ("Cancelled",)
+
+
+def summary_pipeline(user_id):
+    return [
+        {"$match": {"user": ObjectId(user_id)}},
+        {"$group": {"_id": "$status", "orders": {"$sum": 1}, "spend": {"$sum": "$total_price"}}},
+    ]
+
+
+def compute_summary(user_id):
+    to_amount = Order._fields["total_price"].to_python
+    by_status = dict.fromkeys(Order.STATUS_CHOICES, 0)
+    spend = to_amount(0)
+    for group in Order._get_collection().aggregate(summary_pipeline(user_id)):
+        by_status[group["_id"]] = group["orders"]
+        if group["_id"] not in UNPAID_STATUSES:
+            spend += to_amount(group["spend"] or 0)
+    return {"order_count": sum(by_status.values()), "lifetime_spend": spend, "by_status": by_status}
+
+
+def get_summary(user_id, generation):
+    """ The user's summary at `generation` of their `orders_tag` """
+    key = f"orders:summary:{user_id}:{generation}"
+    summary = cache.get(key)
+    if summary is None:
+        summary = compute_summary(user_id)
+        cache.set(key, summary, timeout=getattr(settings, "ORDER_SUMMARY_CACHE_TIMEOUT", 3600))
+    return summary
@@ -0,0 +1,209 @@
+"""
+Order status changes and the notifications they trigger.
+
+`set_status` (one order) and `set_statuses` (a batch, one unordered
+`bulk_write`) record an `order.status_changed` outbox event with every
+change; `notify_status_change` turns drained events into emails. Orders only
+move forward through `Order.STATUS_CHOICES`, and the rule is part of each
+update's filter, so a concurrent change can never be walked back.
+"""
+from datetime import datetime
+
+from bson import ObjectId
+from django.core.mail import EmailMessage, get_connection
+from pymongo import ReturnDocument, UpdateOne
+
+from . import outbox
+from .caching import bump, invalidate_orders, orders_tag
+from .models import Order, User
+
+STATUS_CHANGED = "order.status_changed"
+NOTIFICATION_SENDER = "noreply@yourstore.com"
+
+MAX_BULK_CHANGES = 1000
+
+# Per-item outcomes of `set_statuses`
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+NOT_FOUND = "not_found"
+REJECTED = "rejected"
+CONFLICT = "conflict"
+INVALID = "invalid"
+
+
+class InvalidTransition(Exception):
+    def __init__(self, current, status):
+        super().__init__(f"An order cannot go from {current} to {status}")
+        self.current = current
+        self.status = status
+
+
+def allowed_previous(status):
+    """ The statuses an order may move to `status` from (every earlier one) """
+    return list(Order.STATUS_CHOICES[:Order.STATUS_CHOICES.index(status)])
+
+
+def status_changed_event(order_id, status):
+    return STATUS_CHANGED, {"order_id": ObjectId(order_id), "status": status}
+
+
+def set_status(order_id, status):
+    """
+    Set the order's status and record the change in the outbox. Returns the
+    previous status, or None if there is no such order. Raises
+    `InvalidTransition` if `status` comes before the order's current one.
+    """
+    orders = Order._get_collection()
+    order_id = ObjectId(order_id)
+
+    def write(session):
+        now = datetime.utcnow()
+        return orders.find_one_and_update(
+            {"_id": order_id, "status": {"$in": allowed_previous(status)}},
+            {"$set": {"status": status, "status_changed_at": now, "updated_at": now}},
+            projection={"status": 1, "user": 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session,
+        )
+
+    before = outbox.write_with_events(orders.database, write, [status_changed_event(order_id, status)])
+    if before is not None:
+        invalidate_orders(before["user"])
+        return before.get("status")
+    # Missing, already in that status or past it; nothing was written.
+    unchanged = orders.find_one({"_id": order_id}, {"status": 1})
+    if unchanged is None:
+        return None
+    if unchanged.get("status") != status:
+        raise InvalidTransition(unchanged.get("status"), status)
+    return status
+
+
+def set_statuses(changes):
+    """
+    Apply (order id, status) pairs with one read, one unordered `bulk_write`
+    and one outbox write, whatever the batch size. Returns a report per pair,
+    in order: `order_id`, `status`, `result` (one of the outcomes above),
+    `previous` once the order was read and `error` when it was not updated.
+    """
+    report, pending = [], {}
+    for order_id, status in changes:
+        item = {"order_id": None if order_id is None else str(order_id), "status": status}
+        report.append(item)
+        if status not in Order.STATUS_CHOICES:
+            item.update(result=INVALID, error=f"Status must be one of: {', '.join(Order.STATUS_CHOICES)}")
+        elif not ObjectId.is_valid(order_id):
+            item.update(result=INVALID, error="Invalid order ID")
+        elif ObjectId(order_id) in pending:
+            # Unordered writes would apply repeats in no particular order.
+            item.update(result=INVALID, error="Order appears more than once in the batch")
+        else:
+            pending[ObjectId(order_id)] = item
+    if not pending:
+        return report
+
+    orders = Order._get_collection()
+    current = {doc["_id"]: doc for doc in orders.find({"_id": {"$in": list(pending)}}, {"status": 1, "user": 1})}
+    writes = {}
+    for order_id, item in pending.items():
+        order = current.get(order_id)
+        if order is None:
+            item.update(result=NOT_FOUND, error="Order not found")
+            continue
+        item["previous"] = order.get("status")
+        if item["previous"] == item["status"]:
+            item["result"] = UNCHANGED
+        elif item["previous"] not in allowed_previous(item["status"]):
+            item.update(result=REJECTED, error=str(InvalidTransition(item["previous"], item["status"])))
+        else:
+            writes[order_id] = item
+    if not writes:
+        return report
+
+    def write(session):
+        """ {order id: status} once the batch is applied """
+        now = datetime.utcnow()
+        matched = orders.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": order_id, "status": {"$in": allowed_previous(item["status"])}},
+                    {"$set": {"status": item["status"], "status_changed_at": now, "updated_at": now}},
+                )
+                for order_id, item in writes.items()
+            ],
+            ordered=False,
+            session=session,
+        ).matched_count
+        if matched == len(writes):
+            return {order_id: item["status"] for order_id, item in writes.items()}
+        # Another change got to some of these orders between the read and the write.
+        return {
+            doc["_id"]: doc.get("status")
+            for doc in orders.find({"_id": {"$in": list(writes)}}, {"status": 1}, session=session)
+        }
+
+    # Conflicted orders get no event: only the changes that landed are announced.
+    events = [status_changed_event(order_id, item["status"]) for order_id, item in writes.items()]
+    after = outbox.write_with_events(
+        orders.database, write, events,
+        keep=lambda after, event: after.get(event[1]["order_id"]) == event[1]["status"],
+    )
+    for order_id, item in list(writes.items()):
+        if after.get(order_id) != item["status"]:
+            item.update(result=CONFLICT, error=f"Order changed to {after.get(order_id)} while the batch was applied")
+            del writes[order_id]
+
+    for item in writes.values():
+        item["result"] = UPDATED
+    bump(*{orders_tag(current[order_id]["user"]) for order_id in writes})
+    return report
+
+
+def status_update_messages(orders):
+    """ Email messages for (order id, user id, status) triples, with one user lookup """
+    user_ids = list({user_id for _, user_id, _ in orders})
+    emails = {
+        doc["_id"]: doc.get("email")
+        for doc in User._get_collection().find({"_id": {"$in": user_ids}}, {"email": 1})
+    }
+    return [
+        {
+            "subject": f"Order #{order_id} Status Update",
+            "body": f"Your order (ID: {order_id}) status is now: {status}.",
+            "to": [emails[user_id]],
+        }
+        for order_id, user_id, status in orders
+        if emails.get(user_id)
+    ]
+
+
+def send_status_emails(messages):
+    """ Send `status_update_messages()` output over a single mail connection """
+    connection = get_connection()
+    emails = [
+        EmailMessage(message["subject"], message["body"], NOTIFICATION_SENDER, message["to"], connection=connection)
+        for message in messages
+    ]
+    return connection.send_messages(emails)
+
+
+@outbox.handler(STATUS_CHANGED)
+def notify_status_change(events):
+    """
+    Email the current status of each order in `events`. Events whose order
+    has since moved on, or whose write never landed, are superseded and
+    dropped, as are repeats for the same order within the batch.
+    """
+    order_ids = list({event["payload"]["order_id"] for event in events})
+    current = {
+        doc["_id"]: doc
+        for doc in Order._get_collection().find({"_id": {"$in": order_ids}}, {"user": 1, "status": 1})
+    }
+    changes = {}
+    for event in events:
+        order = current.get(event["payload"]["order_id"])
+        if order is not None and order.get("status") == event["payload"]["status"]:
+            changes[order["_id"]] = (str(order["_id"]), order["user"], order["status"])
+    messages = status_update_messages(list(changes.values()))
+    if messages:
+        send_status_emails(messages)
@@ -0,0 +1,159 @@
+"""
+Transactional outbox.
+
+Events are inserted into the `outbox` collection in the same operation as
+the write they describe (`write_with_events`) and delivered by `drain()`:
+batches are claimed under a lease, so a crashed consumer's batch is picked
+up again once the lease expires (at-least-once delivery). Handlers register
+per topic with `@handler(topic)` and receive lists of events; a handler's
+success is recorded on each event so that a redelivery skips it.
+"""
+import logging
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from .models import OutboxEvent
+from .transactions import run_in_transaction, supports_transactions
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 100
+LEASE = timedelta(seconds=60)
+# Without transactions events are inserted before the write and only made
+# available once it succeeds; if the process dies in between they surface
+# after this delay and handlers find the state unchanged.
+UNCONFIRMED_DELAY = timedelta(seconds=60)
+MAX_ATTEMPTS = 10
+
+_handlers = defaultdict(list)
+
+
+def handler(topic):
+    """ Register `fn(events)` for `topic` """
+    def register(fn):
+        _handlers[topic].append(fn)
+        return fn
+    return register
+
+
+def _handler_name(fn):
+    return f"{fn.__module__}.{fn.__qualname__}"
+
+
+def _outbox():
+    return OutboxEvent._get_collection()
+
+
+def _new_event(topic, payload, available_at):
+    return {
+        "topic": topic,
+        "payload": payload,
+        "created_at": datetime.utcnow(),
+        "available_at": available_at,
+        "attempts": 0,
+        "handled": [],
+        "processed_at": None,
+    }
+
+
+def write_with_events(db, write, events, keep=None):
+    """
+    Run `write(session)` and insert `events` ((topic, payload) pairs) with
+    it. The events are kept only if `write` returns a truthy value and, for a
+    write that may only partly apply, `keep(result, event)` is true.
+    """
+    def kept(result):
+        return [bool(result) and (keep is None or keep(result, event)) for event in events]
+
+    outbox = _outbox()
+    if supports_transactions(db):
+        def callback(session):
+            result = write(session)
+            confirmed = [event for event, confirm in zip(events, kept(result)) if confirm]
+            if confirmed:
+                now = datetime.utcnow()
+                outbox.insert_many([_new_event(topic, payload, now) for topic, payload in confirmed], session=session)
+            return result
+        return run_in_transaction(db, callback)
+
+    if not events:
+        return write(None)
+    held = datetime.utcnow() + UNCONFIRMED_DELAY
+    ids = outbox.insert_many([_new_event(topic, payload, held) for topic, payload in events]).inserted_ids
+    try:
+        result = write(None)
+    except Exception:
+        outbox.delete_many({"_id": {"$in": ids}})
+        raise
+    confirmed = kept(result)
+    if any(confirmed):
+        outbox.update_many(
+            {"_id": {"$in": [event_id for event_id, confirm in zip(ids, confirmed) if confirm]}},
+            {"$set": {"available_at": datetime.utcnow()}},
+        )
+    if not all(confirmed):
+        outbox.delete_many({"_id": {"$in": [event_id for event_id, confirm in zip(ids, confirmed) if not confirm]}})
+    return result
+
+
+def claim(batch_size=OUTBOX_BATCH_SIZE, lease=LEASE):
+    """ Lease up to `batch_size` due events; three round trips per batch """
+    outbox = _outbox()
+    now = datetime.utcnow()
+    due = {"processed_at": None, "available_at": {"$lte": now}, "attempts": {"$lt": MAX_ATTEMPTS}}
+    ids = [doc["_id"] for doc in outbox.find(due, {"_id": 1}).sort("available_at", 1).limit(batch_size)]
+    if not ids:
+        return []
+
+    token = uuid.uuid4().hex
+    outbox.update_many(
+        dict(due, _id={"$in": ids}),
+        {"$set": {"lease": token, "available_at": now + lease}, "$inc": {"attempts": 1}},
+    )
+    # Another consumer may have won some of them between the two calls.
+    return list(outbox.find({"_id": {"$in": ids}, "lease": token}))
+
+
+def dispatch(events):
+    """ Run the handlers for a claimed batch; returns the number processed """
+    outbox = _outbox()
+    by_topic = defaultdict(list)
+    for event in events:
+        by_topic[event["topic"]].append(event)
+
+    failed = set()
+    for topic, batch in by_topic.items():
+        for fn in _handlers.get(topic, []):
+            name = _handler_name(fn)
+            pending = [event for event in batch if name not in event.get("handled", [])]
+            if not pending:
+                continue
+            try:
+                fn(pending)
+            except Exception:
+                logger.exception("Outbox handler %s failed for %d %s event(s)", name, len(pending), topic)
+                failed.update(event["_id"] for event in batch)
+                break
+            outbox.update_many({"_id": {"$in": [event["_id"] for event in pending]}}, {"$addToSet": {"handled": name}})
+
+    # Failed events keep their lease and are retried once it expires.
+    done = [event["_id"] for event in events if event["_id"] not in failed]
+    if done:
+        outbox.update_many(
+            {"_id": {"$in": done}},
+            {"$set": {"processed_at": datetime.utcnow()}, "$unset": {"lease": ""}},
+        )
+    return len(done)
+
+
+def drain(batch_size=OUTBOX_BATCH_SIZE, max_batches=None):
+    """ Claim and dispatch batches until nothing is due; returns the number processed """
+    processed = batches = 0
+    while max_batches is None or batches < max_batches:
+        events = claim(batch_size)
+        if not events:
+            break
+        processed += dispatch(events)
+        batches += 1
+    return processed
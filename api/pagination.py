@@ -0,0 +1,253 @@
+import base64
+import json
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from bson import Decimal128, ObjectId
+from bson.errors import InvalidId
+from mongoengine.queryset.visitor import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opaque-cursor keyset pagination for MongoEngine querysets.
+
+    Pages are fetched with a range filter on the sort key plus `_id` as a
+    tiebreaker instead of `skip()`, so every page costs one indexed range scan
+    regardless of how deep the client is.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = "page_size"
+    cursor_query_param = "cursor"
+    ordering_query_param = "ordering"
+    # Public ordering name -> document field (None means `_id` only).
+    orderings = {"id": None}
+    default_ordering = "id"
+    default_descending = False
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering, self.descending = self.get_ordering(request)
+        field = self.orderings[self.ordering]
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.get_cursor_filter(field, cursor))
+
+        prefix = "-" if self.descending else ""
+        sort_keys = [prefix + "id"] if field is None else [prefix + field, prefix + "id"]
+        return self.set_page(list(queryset.order_by(*sort_keys).limit(self.page_size + 1)))
+
+    def get_raw_query(self, request, filter):
+        """
+        Same pagination for callers querying a pymongo/motor collection
+        directly: returns (filter, sort, limit) for the current page. Pass
+        the fetched rows to `set_page()`.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering, self.descending = self.get_ordering(request)
+        field = self.orderings[self.ordering]
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            position = self.get_raw_position(field, cursor)
+            filter = {"$and": [filter, position]} if filter else position
+
+        direction = -1 if self.descending else 1
+        sort = [("_id", direction)] if field is None else [(field, direction), ("_id", direction)]
+        return filter, sort, self.page_size + 1
+
+    def get_raw_position(self, field, cursor):
+        """ `(field, _id) > (value, id)` (or `<` when descending) as a MongoDB filter """
+        op = "$lt" if self.descending else "$gt"
+        if field is None:
+            return {"_id": {op: cursor["id"]}}
+        value = float(cursor["v"]) if isinstance(cursor["v"], Decimal) else cursor["v"]
+        return {"$or": [{field: {op: value}}, {field: value, "_id": {op: cursor["id"]}}]}
+
+    def paginate_sequence(self, request, rows_for):
+        """
+        Same pagination over rows held in memory (the catalog snapshot):
+        `rows_for(field)` returns a sequence sorted ascending by (field, _id),
+        or by `_id` when `field` is None, whose rows have a dict-like `get()`.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering, self.descending = self.get_ordering(request)
+        field = self.orderings[self.ordering]
+        rows = rows_for(field)
+
+        if field is None:
+            def key(row):
+                return row.get("_id")
+        else:
+            def key(row):
+                return row.get(field), row.get("_id")
+
+        cursor = self.decode_cursor(request)
+        position = None
+        if cursor is not None:
+            # Compared with stored values the way MongoDB compares them, as in `get_raw_query`.
+            value = float(cursor["v"]) if isinstance(cursor.get("v"), Decimal) else cursor.get("v")
+            position = cursor["id"] if field is None else (value, cursor["id"])
+        if self.descending:
+            end = len(rows) if position is None else bisect_left(rows, position, key=key)
+            page = rows[max(0, end - self.page_size - 1):end][::-1]
+        else:
+            start = 0 if position is None else bisect_right(rows, position, key=key)
+            page = rows[start:start + self.page_size + 1]
+        return self.set_page(page)
+
+    def set_page(self, rows):
+        self.has_next = len(rows) > self.page_size
+        page = rows[:self.page_size]
+        self.last = page[-1] if page else None
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_next_link(),
+            "results": data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_ordering(self, request):
+        ordering = request.query_params.get(self.ordering_query_param)
+        if ordering is None:
+            return self.default_ordering, self.default_descending
+        descending = ordering.startswith("-")
+        ordering = ordering.lstrip("-")
+        if ordering not in self.orderings:
+            ordering, descending = self.default_ordering, self.default_descending
+        return ordering, descending
+
+    def get_sort_fields(self, request):
+        """ Document fields the cursor is built from, to keep in a projection """
+        field = self.orderings[self.get_ordering(request)[0]]
+        return [] if field is None else [field]
+
+    def get_cursor_filter(self, field, cursor):
+        """
+        Build `(field, _id) > (value, id)` (or `<` when descending) as a
+        MongoEngine Q expression.
+        """
+        op = "lt" if self.descending else "gt"
+        last_id = cursor["id"]
+        if field is None:
+            return Q(**{f"id__{op}": last_id})
+        value = cursor["v"]
+        return Q(**{f"{field}__{op}": value}) | Q(**{field: value, f"id__{op}": last_id})
+
+    def get_sort_value(self, obj, field):
+        # Pages hold documents, or raw dicts on the `as_pymongo()` fast path.
+        if isinstance(obj, dict):
+            value = obj.get("_id" if field == "id" else field)
+        else:
+            value = getattr(obj, field)
+        if isinstance(value, Decimal128):
+            value = value.to_decimal()
+        if isinstance(value, (Decimal, float)):
+            # Stored and compared as a double; documents and raw rows then
+            # encode the same cursor.
+            value = repr(float(value))
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        return value
+
+    def encode_cursor(self, obj):
+        field = self.orderings[self.ordering]
+        position = {"o": ("-" if self.descending else "") + self.ordering, "id": str(self.get_sort_value(obj, "id"))}
+        if field is not None:
+            position["v"] = self.get_sort_value(obj, field)
+        raw = json.dumps(position, separators=(",", ":")).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+            position = json.loads(raw)
+            position["id"] = ObjectId(position["id"])
+            field = self.orderings[self.ordering]
+            if field is not None:
+                position["v"] = self.parse_sort_value(field, position["v"])
+        except (TypeError, ValueError, KeyError, InvalidId, InvalidOperation):
+            raise NotFound(self.invalid_cursor_message)
+
+        expected = ("-" if self.descending else "") + self.ordering
+        if position.get("o") != expected:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def parse_sort_value(self, field, value):
+        return value
+
+    def get_next_link(self):
+        if not self.has_next or self.last is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.cursor_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last))
+
+
+class ProductKeysetPagination(KeysetPagination):
+    """ Keyset pagination for products ordered by `_id`, price or name """
+    orderings = {"id": None, "price": "price", "name": "name"}
+
+    def parse_sort_value(self, field, value):
+        if field == "price":
+            return Decimal(value)
+        if not isinstance(value, str):
+            raise ValueError("Invalid cursor value")
+        return value
+
+
+class OrderKeysetPagination(KeysetPagination):
+    """ One user's orders, newest first, keyed on (created_at, _id) """
+    page_size = 20
+    max_page_size = 100
+    orderings = {"created_at": "created_at"}
+    default_ordering = "created_at"
+    default_descending = True
+
+    def get_raw_position(self, field, cursor):
+        # Orders from before `created_at` had a default have none (until
+        # `backfill_order_dates` runs). MongoDB sorts them before every date,
+        # but a range on dates never matches them, so place them explicitly.
+        if cursor["v"] is None:
+            undated = {field: None, "_id": {"$lt" if self.descending else "$gt": cursor["id"]}}
+            return undated if self.descending else {"$or": [undated, {field: {"$ne": None}}]}
+        position = super().get_raw_position(field, cursor)
+        if self.descending:
+            position["$or"].append({field: None})
+        return position
+
+    def parse_sort_value(self, field, value):
+        return None if value is None else datetime.fromisoformat(value)
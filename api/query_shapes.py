@@ -0,0 +1,78 @@
+"""
+The query shapes the API issues, for `manage.py mongo_indexes --explain`.
+
+Keep this in step with the views: whenever a view, task or helper starts
+filtering or sorting on a new combination of fields, add its shape here so
+CI catches a missing index before production does. Values only need the
+right type; the planner picks a plan from the shape.
+"""
+from datetime import datetime
+
+from bson import ObjectId
+
+from .models import Cart, Category, CategoryDeletion, Coupon, Order, OutboxEvent, Product, SalesRollup, User
+
+_ID = ObjectId()
+
+
+class QueryShape:
+    def __init__(self, name, document, filter, sort=None, pipeline=None):
+        self.name = name
+        self.document = document
+        self.filter = filter
+        self.sort = sort
+        self.pipeline = pipeline
+
+
+QUERY_SHAPES = [
+    QueryShape("login by email", User, {"email": "user@example.com"}),
+    QueryShape("user by id", User, {"_id": _ID}),
+    QueryShape("category by id", Category, {"_id": _ID}),
+    QueryShape("category by name", Category, {"name": "Books"}),
+    QueryShape("product by id", Product, {"_id": _ID}),
+    QueryShape("products in _id order", Product, {"_id": {"$gt": _ID}}, [("_id", 1)]),
+    QueryShape("products by price", Product, {}, [("price", 1), ("_id", 1)]),
+    QueryShape("products by name", Product, {}, [("name", 1), ("_id", 1)]),
+    QueryShape("products in price range", Product, {"price": {"$gte": 1.0, "$lte": 10.0}}, [("price", 1), ("_id", 1)]),
+    QueryShape("products in category", Product, {"category": _ID}, [("_id", 1)]),
+    QueryShape("products in category by price", Product, {"category": _ID, "price": {"$gte": 1.0}}, [("price", 1), ("_id", 1)]),
+    QueryShape("products in category by name", Product, {"category": _ID}, [("name", 1), ("_id", 1)]),
+    QueryShape("products after a name cursor", Product, {
+        "$or": [{"name": {"$gt": "Lamp"}}, {"name": "Lamp", "_id": {"$gt": _ID}}],
+    }, [("name", 1), ("_id", 1)]),
+    QueryShape("products in category after a name cursor", Product, {
+        "category": _ID, "$or": [{"name": {"$lt": "Lamp"}}, {"name": "Lamp", "_id": {"$lt": _ID}}],
+    }, [("name", -1), ("_id", -1)]),
+    QueryShape("product search", Product, None, pipeline=[
+        {"$match": {"$text": {"$search": "phone"}, "category": _ID}},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+        {"$facet": {"results": [{"$sort": {"score": -1, "_id": 1}}, {"$limit": 21}]}},
+    ]),
+    QueryShape("products changed since", Product, {"updated_at": {"$gte": datetime(2024, 1, 1)}}),
+    QueryShape("products for checkout", Product, {"_id": {"$in": [_ID]}}),
+    QueryShape("products held by a checkout", Product, {"checkout_holds.order": _ID}),
+    QueryShape("cart by user", Cart, {"user": _ID}),
+    QueryShape("cart line", Cart, {"user": _ID, "items.product": _ID}),
+    QueryShape("carts holding products", Cart, {"items.product": {"$in": [_ID]}}),
+    QueryShape("order by id", Order, {"_id": _ID}),
+    QueryShape("orders by id", Order, {"_id": {"$in": [_ID]}}),
+    QueryShape("order status transition", Order, {"_id": _ID, "status": {"$in": ["Pending"]}}),
+    QueryShape("orders by user", Order, {"user": _ID, "created_at": {"$lt": datetime(2024, 1, 1)}}, [("created_at", -1), ("_id", -1)]),
+    QueryShape("orders by user past the dated ones", Order, {"user": _ID, "created_at": None, "_id": {"$lt": _ID}}, [("created_at", -1), ("_id", -1)]),
+    QueryShape("orders by user and status", Order, {"user": _ID, "status": "Shipped"}, [("created_at", -1), ("_id", -1)]),
+    QueryShape("order summary", Order, None, pipeline=[
+        {"$match": {"user": _ID}},
+        {"$group": {"_id": "$status", "orders": {"$sum": 1}, "spend": {"$sum": "$total_price"}}},
+    ]),
+    QueryShape("orders by status", Order, {"status": "Pending"}, [("created_at", 1)]),
+    QueryShape("orders created since", Order, {"created_at": {"$gte": datetime(2024, 1, 1)}}),
+    QueryShape("orders with status changes since", Order, {"status_changed_at": {"$gt": datetime(2024, 1, 1), "$lte": datetime(2024, 1, 2)}}, [("status_changed_at", 1)]),
+    QueryShape("due outbox events", OutboxEvent, {"processed_at": None, "available_at": {"$lte": datetime(2024, 1, 1)}}, [("available_at", 1)]),
+    QueryShape("sales rollup period", SalesRollup, {"granularity": "hour", "period": datetime(2024, 1, 1)}),
+    QueryShape("sales rollups in range", SalesRollup, {"granularity": "day", "period": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 2, 1)}}, [("period", 1)]),
+    QueryShape("stale category deletions", CategoryDeletion, {"status": "Running", "updated_at": {"$lt": datetime(2024, 1, 1)}}),
+    QueryShape("coupon by code", Coupon, {"code": "SAVE10"}),
+    QueryShape("coupon claim", Coupon, {"_id": _ID, "expiry_date": {"$gt": datetime(2024, 1, 1)}, "$expr": {"$lt": ["$used_count", "$usage_limit"]}}),
+    QueryShape("order without coupon", Order, {"_id": _ID, "coupon_code": None, "status": {"$ne": "Cancelled"}}),
+    QueryShape("inventory flush", Product, {"_id": _ID, "inventory_flushes": {"$ne": "token"}}),
+]
@@ -0,0 +1,24 @@
+from bson import Decimal128, ObjectId
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .metrics import render_timer
+
+
+class MongoJSONEncoder(JSONEncoder):
+    """ DRF's encoder plus the BSON types raw `as_pymongo()` rows carry """
+
+    def default(self, obj):
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        if isinstance(obj, Decimal128):
+            return super().default(obj.to_decimal())
+        return super().default(obj)
+
+
+class MongoJSONRenderer(JSONRenderer):
+    encoder_class = MongoJSONEncoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with render_timer():
+            return super().render(data, accepted_media_type, renderer_context)
@@ -0,0 +1,239 @@
+"""
+Hourly and daily sales rollups (`SalesRollup`).
+
+Each order write applies its delta with `$inc` upserts, one per
+granularity in a single `bulk_write`, so reports never scan `orders`.
+Orders count towards the period they were placed in; a cancellation takes
+its revenue and units back out of that period. Deltas are applied after the
+order write commits, outside its transaction, so a crash in between loses
+one. `rebuild` recomputes a range from `orders` to repair that: the
+`rebuild_recent_rollups` task does the last closed days every night, and the
+`rebuild_rollups` command any other range. Orders without `created_at`
+(older than its default) count at their ObjectId's time, and are only
+rebuilt once `backfill_order_dates` has stored it.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from bson import ObjectId
+from pymongo import ReadPreference, UpdateOne
+
+from .models import Order, Product, SalesRollup
+
+CANCELLED = "Cancelled"
+
+# Reporting reads can lag the primary a little.
+READ_PREFERENCE = ReadPreference.SECONDARY_PREFERRED
+
+
+def truncate(moment, granularity):
+    if granularity == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def to_cents(amount):
+    return int(Decimal(str(amount or 0)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP) * 100)
+
+
+def placed_at(order):
+    """
+    When a raw order document was placed. Orders written before `created_at`
+    had a default have none (see the `backfill_order_dates` command); their
+    ObjectId carries the time instead.
+    """
+    return order.get("created_at") or order["_id"].generation_time.replace(tzinfo=None)
+
+
+def product_categories(product_ids):
+    """ {product id: category id} with one `$in` """
+    return {
+        doc["_id"]: doc.get("category")
+        for doc in Product._get_collection().find({"_id": {"$in": list(product_ids)}}, {"category": 1})
+    }
+
+
+def order_delta(items, total_price, sign=1, product_category=None):
+    """
+    The rollup delta of one order; `sign=-1` takes it back out. Pass
+    `product_categories()` of the order's products to skip looking them up.
+    """
+    products = Counter()
+    for item in items:
+        products[item["product"]] += item["quantity"]
+    if product_category is None:
+        product_category = product_categories(products)
+    categories = Counter()
+    for product_id, units in products.items():
+        category_id = product_category.get(product_id)
+        if category_id is not None:
+            categories[category_id] += units
+    return {
+        "revenue_cents": sign * to_cents(total_price),
+        "orders": sign,
+        "units": sign * sum(products.values()),
+        "products": {str(key): sign * units for key, units in products.items()},
+        "categories": {str(key): sign * units for key, units in categories.items()},
+    }
+
+
+def apply(placed_at, delta, session=None):
+    """ Add `delta` to the hour and the day `placed_at` falls in """
+    inc = {name: delta[name] for name in ("revenue_cents", "orders", "units") if delta.get(name)}
+    for name in ("products", "categories"):
+        inc.update({f"{name}.{key}": units for key, units in delta.get(name, {}).items() if units})
+    if not inc:
+        return
+    SalesRollup._get_collection().bulk_write(
+        [
+            UpdateOne({"granularity": granularity, "period": truncate(placed_at, granularity)}, {"$inc": inc}, upsert=True)
+            for granularity in SalesRollup.GRANULARITIES
+        ],
+        ordered=False,
+        session=session,
+    )
+
+
+def record_order(order):
+    """ Count a newly placed order (the dict `checkout.place_order` returns) """
+    apply(order["created_at"], order_delta(order["items"], order["total_price"]))
+
+
+def add_delta(total, delta):
+    """ Add one `order_delta()` into `total` """
+    for name in ("revenue_cents", "orders", "units"):
+        total[name] = total.get(name, 0) + delta[name]
+    for name in ("products", "categories"):
+        total.setdefault(name, Counter()).update(delta[name])
+    return total
+
+
+def record_status_change(order_id, previous, status):
+    """ Take a cancelled order out of its period, or put a reinstated one back """
+    record_status_changes([(order_id, previous, status)])
+
+
+def record_status_changes(changes):
+    """
+    `record_status_change` for (order id, previous, status) triples: one
+    order read, one product read and one rollup write per hour affected.
+    """
+    signs = {
+        ObjectId(order_id): -1 if status == CANCELLED else 1
+        for order_id, previous, status in changes
+        if (previous == CANCELLED) != (status == CANCELLED)
+    }
+    if not signs:
+        return
+    orders = list(Order._get_collection().find(
+        {"_id": {"$in": list(signs)}}, {"items.product": 1, "items.quantity": 1, "total_price": 1, "created_at": 1}
+    ))
+    if not orders:
+        return
+    product_category = product_categories({item["product"] for order in orders for item in order.get("items", [])})
+    hours = defaultdict(dict)
+    for order in orders:
+        delta = order_delta(order.get("items", []), order["total_price"], signs[order["_id"]], product_category)
+        add_delta(hours[truncate(placed_at(order), "hour")], delta)
+    for hour, delta in hours.items():
+        apply(hour, delta)
+
+
+def record_revenue_change(placed_at, status, old_total, new_total):
+    """ A price adjustment (e.g. a coupon) on an order placed at `placed_at` """
+    if status == CANCELLED:
+        return
+    apply(placed_at, {"revenue_cents": to_cents(new_total) - to_cents(old_total)})
+
+
+def rollup_range(start, end):
+    """ Rollup documents for [start, end) recomputed from `orders`, not written """
+    orders = Order._get_collection().with_options(read_preference=READ_PREFERENCE)
+    match = {"$match": {"created_at": {"$gte": start, "$lt": end}, "status": {"$ne": CANCELLED}}}
+    hour = {"$dateToString": {"format": "%Y-%m-%dT%H", "date": "$created_at"}}
+
+    hours = defaultdict(lambda: {
+        "revenue_cents": 0, "orders": 0, "units": 0, "products": Counter(), "categories": Counter(),
+    })
+    for row in orders.aggregate([match, {"$group": {"_id": hour, "revenue": {"$sum": "$total_price"}, "orders": {"$sum": 1}}}]):
+        bucket = hours[datetime.strptime(row["_id"], "%Y-%m-%dT%H")]
+        bucket["revenue_cents"] = to_cents(row["revenue"])
+        bucket["orders"] = row["orders"]
+
+    units = list(orders.aggregate([
+        match,
+        {"$unwind": "$items"},
+        {"$group": {"_id": {"hour": hour, "product": "$items.product"}, "units": {"$sum": "$items.quantity"}}},
+    ]))
+    categories = product_categories({row["_id"]["product"] for row in units})
+    for row in units:
+        bucket = hours[datetime.strptime(row["_id"]["hour"], "%Y-%m-%dT%H")]
+        bucket["units"] += row["units"]
+        bucket["products"][str(row["_id"]["product"])] += row["units"]
+        category_id = categories.get(row["_id"]["product"])
+        if category_id is not None:
+            bucket["categories"][str(category_id)] += row["units"]
+
+    days = defaultdict(lambda: {
+        "revenue_cents": 0, "orders": 0, "units": 0, "products": Counter(), "categories": Counter(),
+    })
+    for period, bucket in hours.items():
+        day = days[truncate(period, "day")]
+        for name in ("revenue_cents", "orders", "units"):
+            day[name] += bucket[name]
+        day["products"].update(bucket["products"])
+        day["categories"].update(bucket["categories"])
+
+    return [
+        dict(bucket, granularity=granularity, period=period, products=dict(bucket["products"]), categories=dict(bucket["categories"]))
+        for granularity, buckets in (("hour", hours), ("day", days))
+        for period, bucket in sorted(buckets.items())
+    ]
+
+
+def rebuild(start, end):
+    """
+    Replace the rollups of the whole days in [start, end) with values
+    recomputed from `orders`. Returns the number of documents written.
+    Increments applied while a day is being rebuilt are lost, so prefer
+    closed periods or re-run the current day afterwards.
+    """
+    start, end = truncate(start, "day"), truncate(end - timedelta(microseconds=1), "day") + timedelta(days=1)
+    documents = rollup_range(start, end)
+    rollups = SalesRollup._get_collection()
+    rollups.delete_many({"granularity": {"$in": list(SalesRollup.GRANULARITIES)}, "period": {"$gte": start, "$lt": end}})
+    if documents:
+        rollups.insert_many(documents, ordered=False)
+    return len(documents)
+
+
+def summarize(granularity, start, end):
+    """ Per-period rollups in [start, end) plus their totals, for the analytics endpoint """
+    cursor = SalesRollup._get_collection().with_options(read_preference=READ_PREFERENCE).find(
+        {"granularity": granularity, "period": {"$gte": start, "$lt": end}}, {"_id": 0, "granularity": 0}
+    ).sort("period", 1)
+
+    periods = []
+    totals = {"revenue_cents": 0, "orders": 0, "units": 0, "products": Counter(), "categories": Counter()}
+    for doc in cursor:
+        for name in ("revenue_cents", "orders", "units"):
+            totals[name] += doc.get(name, 0)
+        totals["products"].update(doc.get("products", {}))
+        totals["categories"].update(doc.get("categories", {}))
+        periods.append(_as_report(doc))
+    return {"granularity": granularity, "start": start, "end": end, "totals": _as_report(totals), "periods": periods}
+
+
+def _as_report(doc):
+    report = {"period": doc["period"]} if "period" in doc else {}
+    report.update({
+        # A string, like the serializers render DecimalFields.
+        "revenue": str((Decimal(doc.get("revenue_cents", 0)) / 100).quantize(Decimal("0.01"))),
+        "orders": doc.get("orders", 0),
+        "units": doc.get("units", 0),
+    })
+    # Cancellations can leave zeroed entries behind.
+    for name in ("products", "categories"):
+        report[name] = {key: units for key, units in doc.get(name, {}).items() if units}
+    return report
@@ -0,0 +1,137 @@
+"""
+Relevance-ranked product search over the `name`/`description` text index.
+
+A single aggregation returns the page of results and, on the first page,
+the category and price-range facet counts through `$facet`. Pages are keyed
+on (text score, _id) rather than skipped.
+"""
+import base64
+import json
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from rest_framework.exceptions import NotFound
+
+from .models import Category, Product
+
+# Lower bounds of the price-range facet buckets; the last one is open-ended.
+PRICE_BUCKETS = [0, 10, 25, 50, 100, 250, 500, 1000]
+
+RESULT_FIELDS = ("name", "description", "category", "price", "stock", "images")
+
+
+def encode_cursor(doc):
+    raw = json.dumps({"s": doc["score"], "id": str(doc["_id"])}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(encoded):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)))
+        return float(position["s"]), ObjectId(position["id"])
+    except (TypeError, ValueError, KeyError, InvalidId):
+        raise NotFound("Invalid cursor")
+
+
+def build_pipeline(query, category=None, min_price=None, max_price=None, cursor=None, page_size=20, fields=RESULT_FIELDS):
+    match = {"$text": {"$search": query}}
+    if category is not None:
+        match["category"] = category
+    price = {}
+    if min_price is not None:
+        price["$gte"] = float(min_price)
+    if max_price is not None:
+        price["$lte"] = float(max_price)
+    if price:
+        match["price"] = price
+
+    results = []
+    if cursor is not None:
+        score, last_id = cursor
+        results.append({"$match": {"$or": [
+            {"score": {"$lt": score}},
+            {"score": score, "_id": {"$gt": last_id}},
+        ]}})
+    results += [
+        {"$sort": {"score": -1, "_id": 1}},
+        {"$limit": page_size + 1},
+        {"$project": {field: 1 for field in (*fields, "score")}},
+    ]
+
+    facets = {"results": results}
+    if cursor is None:
+        # Facet counts do not change from page to page; only pay for them once.
+        facets["total"] = [{"$count": "count"}]
+        facets["categories"] = [
+            {"$group": {"_id": "$category", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1, "_id": 1}},
+        ]
+        facets["price_ranges"] = [
+            {"$bucket": {
+                "groupBy": "$price",
+                "boundaries": PRICE_BUCKETS,
+                "default": PRICE_BUCKETS[-1],
+                "output": {"count": {"$sum": 1}},
+            }},
+        ]
+
+    return [
+        {"$match": match},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+        {"$facet": facets},
+    ]
+
+
+def search_products(query, category=None, min_price=None, max_price=None, cursor=None, page_size=20, fields=None):
+    """
+    Returns (results, next position or None, facets or None). `results` are
+    plain dicts in `ProductSerializer` shape, with `category` holding the
+    category name like the serializer renders it. `fields` limits the
+    result fields read (a sparse fieldset); the rest come back empty.
+    """
+    pipeline = build_pipeline(query, category, min_price, max_price, cursor, page_size, RESULT_FIELDS if fields is None else fields)
+    outcome = next(Product._get_collection().aggregate(pipeline), {})
+
+    docs = outcome.get("results", [])
+    has_next = len(docs) > page_size
+    docs = docs[:page_size]
+
+    category_ids = {doc.get("category") for doc in docs}
+    category_ids.update(bucket["_id"] for bucket in outcome.get("categories", []))
+    names = {
+        doc["_id"]: doc.get("name")
+        for doc in Category._get_collection().find({"_id": {"$in": list(category_ids)}}, {"name": 1})
+    } if category_ids else {}
+
+    results = [
+        {
+            "id": doc["_id"],
+            "name": doc.get("name"),
+            "description": doc.get("description"),
+            "category": names.get(doc.get("category")),
+            "price": doc.get("price"),
+            "stock": doc.get("stock", 0),
+            "images": doc.get("images", []),
+        }
+        for doc in docs
+    ]
+
+    facets = None
+    if "total" in outcome:
+        facets = {
+            "total": outcome["total"][0]["count"] if outcome["total"] else 0,
+            "categories": [
+                {"id": str(bucket["_id"]), "name": names.get(bucket["_id"]), "count": bucket["count"]}
+                for bucket in outcome["categories"]
+            ],
+            "price_ranges": [
+                {
+                    "min": bucket["_id"],
+                    "max": PRICE_BUCKETS[PRICE_BUCKETS.index(bucket["_id"]) + 1] if bucket["_id"] != PRICE_BUCKETS[-1] else None,
+                    "count": bucket["count"],
+                }
+                for bucket in outcome["price_ranges"]
+            ],
+        }
+
+    return results, (encode_cursor(docs[-1]) if has_next else None), facets
@@ -1,6 +1,13 @@
 from rest_framework import serializers
 from bson import ObjectId
+from . import inventory
+from .caching import invalidate_category, invalidate_product
+from .coupons import invalidate as invalidate_coupon
 from .models import User, Product, Category, Order, Coupon
+from .tasks import refresh_cart_snapshots
+
+# Product fields copied onto cart lines (see api/cart_ops.py)
+CART_SNAPSHOT_FIELDS = {"name", "price", "images"}
 
 
 class ObjectIdField(serializers.Field):
@@ -41,18 +48,19 @@ class ProductSerializer(serializers.Serializer):
 
     def create(self, validated_data):
         category_id = validated_data.pop('category')
-        category = Category.objects(id=category_id).first() 
+        category = Category.objects(id=category_id, deleted_at=None).first()
         if not category:
             raise serializers.ValidationError("Invalid category ID")
 
         product = Product(**validated_data, category=category)
         product.save()
+        invalidate_product(product.id)
         return product
 
     def update(self, instance, validated_data):
         if "category" in validated_data:
             category_id = validated_data.pop("category")
-            category = Category.objects(id=category_id).first()
+            category = Category.objects(id=category_id, deleted_at=None).first()
             if not category:
                 raise serializers.ValidationError("Invalid category ID")
             instance.category = category 
@@ -61,6 +69,11 @@ class ProductSerializer(serializers.Serializer):
             setattr(instance, attr, value)
             
         instance.save()
+        invalidate_product(instance.id)
+        if "stock" in validated_data and inventory.enabled():
+            inventory.set_stock(instance.id, instance.stock)
+        if CART_SNAPSHOT_FIELDS.intersection(validated_data):
+            refresh_cart_snapshots.delay([str(instance.id)])
         return instance
 
 class CategorySerializer(serializers.Serializer):
@@ -71,20 +84,26 @@ class CategorySerializer(serializers.Serializer):
     def create(self, validated_data):
         category = Category(**validated_data)
         category.save()
+        invalidate_category(category.id)
         return category
 
     def update(self, instance, validated_data):
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
         instance.save()
+        invalidate_category(instance.id)
         return instance
 
 class CartItemSerializer(serializers.Serializer):
     product = serializers.CharField()  
     quantity = serializers.IntegerField(min_value=1)
+    name = serializers.CharField(read_only=True)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    thumbnail = serializers.CharField(read_only=True)
 
     def validate_product(self, value):
-        if not Product.objects(id=value).first():
+        # Existence is checked by the view when it reads the product snapshot.
+        if not ObjectId.is_valid(value):
             raise serializers.ValidationError("Invalid product ID.")
         return value
 
@@ -92,6 +111,7 @@ class CartSerializer(serializers.Serializer):
     id = serializers.CharField(read_only=True)
     user = serializers.CharField(read_only=True)
     items = CartItemSerializer(many=True)
+    subtotal = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
 
 class OrderItemSerializer(serializers.Serializer):
     product = serializers.CharField()  
@@ -114,6 +134,24 @@ class OrderSerializer(serializers.Serializer):
         order.save()
         return order
 
+class OrderSummarySerializer(serializers.Serializer):
+    order_count = serializers.IntegerField()
+    lifetime_spend = serializers.DecimalField(max_digits=14, decimal_places=2)
+    by_status = serializers.DictField(child=serializers.IntegerField())
+
+class CategoryDeletionSerializer(serializers.Serializer):
+    id = serializers.CharField(read_only=True)
+    category = ObjectIdField(read_only=True)
+    name = serializers.CharField(read_only=True)
+    reassign_to = ObjectIdField(read_only=True)
+    status = serializers.CharField(read_only=True)
+    products_total = serializers.IntegerField(read_only=True)
+    products_done = serializers.IntegerField(read_only=True)
+    carts_updated = serializers.IntegerField(read_only=True)
+    created_at = serializers.DateTimeField(read_only=True)
+    updated_at = serializers.DateTimeField(read_only=True)
+    finished_at = serializers.DateTimeField(read_only=True)
+
 class CouponSerializer(serializers.Serializer):
     code = serializers.CharField()
     discount_percentage = serializers.IntegerField()
@@ -132,4 +170,7 @@ class CouponSerializer(serializers.Serializer):
     usage_limit = serializers.IntegerField(default=1)
 
     def create(self, validated_data):
-        return Coupon.objects.create(**validated_data)
+        coupon = Coupon.objects.create(**validated_data)
+        # The code may have been cached as unknown.
+        invalidate_coupon(coupon.code)
+        return coupon
@@ -1,20 +1,182 @@
+from datetime import datetime, timedelta
+
+from bson import ObjectId
 from celery import shared_task
-from django.core.mail import send_mail
-from .models import Order
-from django.utils.timezone import now, timedelta
+from pymongo import UpdateMany, UpdateOne
+
+from . import category_purge, checkout, inventory, outbox, rollups  # noqa: F401 (checkout registers an outbox handler)
+from .caching import bump, cart_tag
+from .cart_ops import SNAPSHOT_PROJECTION, line_total, snapshot_fields
+from .models import Cart, CategoryDeletion, Order, Product, TaskCheckpoint
+from .order_status import send_status_emails, status_update_messages
+
+SNAPSHOT_BATCH_SIZE = 500
+
+# Purge batches per purge_category run before it re-queues itself, so one
+# large category does not hold a worker for its whole deletion.
+PURGE_BATCHES_PER_TASK = 20
+
+NOTIFICATION_CHUNK_SIZE = 100
+# Only scan status changes at least this old, so a write stamped just before
+# a run but committed just after it is not skipped by the high-water mark.
+NOTIFICATION_SETTLE_DELAY = timedelta(seconds=30)
+# How far back the very first run looks.
+NOTIFICATION_INITIAL_WINDOW = timedelta(hours=1)
+
+# Closed days rebuild_recent_rollups recomputes, so one missed run is covered
+# by the next.
+ROLLUP_RECONCILE_DAYS = 2
+
+
+def _queue_status_updates(orders):
+    """ Resolve the chunk's emails with one query and hand it to a mail task """
+    messages = status_update_messages([(str(order["_id"]), order["user"], order["status"]) for order in orders])
+    if messages:
+        send_order_status_emails.delay(messages)
+    return len(messages)
 
 @shared_task
 def send_periodic_order_status_updates():
     """
-    Checks for order status changes every hour and notifies users.
+    Notifies users of order status changes made since the previous run.
+    Each run resumes from the checkpointed high-water mark, so only new
+    changes are scanned.
+
+    No longer scheduled: changes are delivered through the outbox (see
+    `drain_outbox`). Run it by hand to cover a period the outbox missed.
+    """
+    checkpoint = TaskCheckpoint.objects(name="order_status_notifications").first()
+    until = datetime.utcnow() - NOTIFICATION_SETTLE_DELAY
+    since = checkpoint.position if checkpoint else until - NOTIFICATION_INITIAL_WINDOW
+    if since >= until:
+        return "Sent status updates for 0 orders."
+
+    changed = Order._get_collection().find(
+        {"status_changed_at": {"$gt": since, "$lte": until}},
+        {"user": 1, "status": 1},
+    ).sort("status_changed_at", 1)
+
+    queued, chunk = 0, []
+    for order in changed:
+        chunk.append(order)
+        if len(chunk) == NOTIFICATION_CHUNK_SIZE:
+            queued += _queue_status_updates(chunk)
+            chunk = []
+    if chunk:
+        queued += _queue_status_updates(chunk)
+
+    TaskCheckpoint.objects(name="order_status_notifications").update_one(set__position=until, upsert=True)
+    return f"Sent status updates for {queued} orders."
+
+@shared_task
+def send_order_status_emails(messages):
+    """ Sends a chunk of status update emails over a single mail connection """
+    return send_status_emails(messages)
+
+@shared_task
+def drain_outbox():
+    """
+    Delivers pending outbox events. Queued right after each write that emits
+    one, and on a short beat as a safety net for lost or failed deliveries.
     """
-    one_hour_ago = now() - timedelta(hours=1)
-    orders = Order.objects.filter(updated_at__gte=one_hour_ago)
+    return f"Processed {outbox.drain()} outbox events."
 
-    for order in orders:
-        subject = f"Order #{order.id} Status Update"
-        message = f"Your order (ID: {order.id}) status is now: {order.status}."
-        
-        send_mail(subject, message, "noreply@yourstore.com", [order.user.email])
-    
-    return f"Sent status updates for {orders.count()} orders."
+@shared_task
+def reconcile_inventory():
+    """
+    Releases expired stock reservations and writes committed sales back to
+    `Product.stock` (see api/inventory.py).
+    """
+    if not inventory.enabled():
+        return "Inventory reservations are disabled."
+    released, flushed = inventory.reconcile()
+    return f"Released {released} expired reservations, flushed stock of {flushed} products."
+
+@shared_task
+def refresh_cart_snapshots(product_ids=None):
+    """
+    Refreshes the product snapshot stored on cart lines for `product_ids`
+    (or every product currently in a cart) and re-derives the subtotal of
+    the carts that hold them.
+    """
+    carts = Cart._get_collection()
+    products = Product._get_collection()
+    if product_ids is None:
+        product_ids = carts.distinct("items.product")
+    else:
+        product_ids = [ObjectId(product_id) for product_id in product_ids]
+
+    refreshed = 0
+    for start in range(0, len(product_ids), SNAPSHOT_BATCH_SIZE):
+        batch = product_ids[start:start + SNAPSHOT_BATCH_SIZE]
+
+        snapshots = [snapshot_fields(doc) for doc in products.find({"_id": {"$in": batch}}, SNAPSHOT_PROJECTION)]
+        stale_lines = [
+            UpdateMany(
+                {"items": {"$elemMatch": {
+                    "product": snapshot["product"],
+                    "$or": [{field: {"$ne": snapshot[field]}} for field in ("name", "price", "thumbnail")],
+                }}},
+                # A product appears on at most one line per cart, so the
+                # positional operator (the line matched above) is enough.
+                {"$set": {f"items.$.{field}": snapshot[field] for field in ("name", "price", "thumbnail")}},
+            )
+            for snapshot in snapshots
+        ]
+        modified = carts.bulk_write(stale_lines, ordered=False).modified_count if stale_lines else 0
+        refreshed += modified
+
+        # Only overwrite the subtotal if the lines are unchanged since we read
+        # them; a concurrent mutation has already applied its own $inc.
+        subtotals, users = [], []
+        for cart in carts.find({"items.product": {"$in": batch}}, {"user": 1, "items": 1, "subtotal": 1}):
+            users.append(cart["user"])
+            subtotal = round(sum(line_total(item) for item in cart["items"]), 2)
+            if abs(subtotal - (cart.get("subtotal") or 0)) >= 0.005:
+                subtotals.append(UpdateOne({"_id": cart["_id"], "items": cart["items"]}, {"$set": {"subtotal": subtotal}}))
+        if subtotals:
+            carts.bulk_write(subtotals, ordered=False)
+        if modified or subtotals:
+            # Which carts the line updates touched is unknown; retire the
+            # ETags of every cart holding the batch.
+            bump(*[cart_tag(user_id) for user_id in users])
+
+    return f"Refreshed {refreshed} carts."
+
+@shared_task
+def purge_category(deletion_id):
+    """
+    Works through a category deletion (see api/category_purge.py) a few
+    batches at a time, queueing itself again until the category is empty.
+    Safe to run twice at once or after a crash: every batch starts from what
+    is left in the category.
+    """
+    deletion = CategoryDeletion.objects(id=deletion_id).first()
+    if deletion is None or deletion.status == "Done":
+        return "Nothing to purge."
+    for _ in range(PURGE_BATCHES_PER_TASK):
+        if not category_purge.purge_batch(deletion):
+            category_purge.finish(deletion)
+            return f"Deleted category {deletion.name}."
+    purge_category.delay(deletion_id)
+    return f"Purged {PURGE_BATCHES_PER_TASK} batches of category {deletion.name}; continuing."
+
+@shared_task
+def resume_category_deletions():
+    """ Re-queues category deletions whose purge_category task was lost """
+    stale = category_purge.stale_deletions()
+    for deletion_id in stale:
+        purge_category.delay(deletion_id)
+    return f"Resumed {len(stale)} category deletions."
+
+@shared_task
+def rebuild_recent_rollups(days=ROLLUP_RECONCILE_DAYS):
+    """
+    Recomputes the rollups of the last `days` whole (UTC) days from
+    `orders`. Order, cancel and coupon deltas are applied after their write
+    commits, so a crash in between leaves a period short; this repairs it
+    once the day is closed.
+    """
+    end = rollups.truncate(datetime.utcnow(), "day")
+    written = rollups.rebuild(end - timedelta(days=days), end)
+    return f"Rebuilt {written} rollup documents."
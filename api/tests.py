@@ -1,3 +1,1255 @@
-from django.test import TestCase
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from bson import ObjectId
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import AsyncRequestFactory, SimpleTestCase, override_settings
+from pymongo.errors import PyMongoError
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import async_mongo, async_views, bench, caching, cart_ops, catalog_io, catalog_snapshot, category_purge, checkout, coupons, fieldsets, inventory, metrics, order_history, order_status, outbox, rollups, search, tasks, throttling, user_cache, views
+from .fast_render import PRODUCT_ROWS
+from .management.commands import mongo_indexes
+from .models import Category, CategoryDeletion, Coupon, Order, OutboxEvent, Product, SalesRollup, TaskCheckpoint, User
+from .pagination import ProductKeysetPagination
+from .query_shapes import QueryShape
+from .serializers import ProductSerializer
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+try:
+    import mongomock_motor
+except ImportError:
+    mongomock_motor = None
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (fakeredis needs it for Lua scripts)
+except ImportError:
+    fakeredis = None
+
+
+@skipUnless(mongomock, "mongomock is not installed")
+class MongomockTestCase(SimpleTestCase):
+    """ Runs against a fresh in-memory MongoDB per test """
+
+    def setUp(self):
+        bench.use_mongomock("test_db")
+
+
+def emulate_mul(find_one_and_update):
+    """
+    mongomock has no `$mul`: apply it as a `$set` of the current values
+    times the factors (not atomic, which single-threaded tests do not need)
+    """
+    def patched(collection, filter, update, *args, **kwargs):
+        if "$mul" in update:
+            update = dict(update)
+            factors = update.pop("$mul")
+            current = collection.find_one(filter, list(factors)) or {}
+            products = {field: current[field] * factor for field, factor in factors.items() if field in current}
+            update["$set"] = dict(update.get("$set", {}), **products)
+        return find_one_and_update(collection, filter, update, *args, **kwargs)
+    return patched
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ProductKeysetPaginationTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        category = Category(name="Books").save()
+        self.products = [
+            Product(name=f"Item {i:02}", category=category, price=Decimal(["5.00", "1.25", "9.99"][i % 3])).save()
+            for i in range(10)
+        ]
+        self.user = SimpleNamespace(id="u", pk="u", is_authenticated=True)
+
+    def get(self, path):
+        request = APIRequestFactory().get(path)
+        force_authenticate(request, self.user)
+        return views.ProductViewSet.as_view({"get": "list"})(request)
+
+    def walk(self, path):
+        ids = []
+        while path:
+            response = self.get(path)
+            self.assertEqual(response.status_code, 200)
+            ids += [str(row["id"]) for row in response.data["results"]]
+            path = response.data["next"]
+        return ids
+
+    def test_cursors_walk_every_ordering(self):
+        by_price = sorted(self.products, key=lambda product: (product.price, product.id), reverse=True)
+        self.assertEqual(self.walk("/api/products/?page_size=3&ordering=-price"), [str(product.id) for product in by_price])
+        self.assertEqual(self.walk("/api/products/?page_size=4&ordering=name"), [str(product.id) for product in self.products])
+        self.assertEqual(
+            self.walk("/api/products/?page_size=4&ordering=price&min_price=2&max_price=9.99"),
+            [str(product.id) for product in sorted(self.products, key=lambda product: (product.price, product.id)) if product.price > 2],
+        )
+
+    def test_tampered_cursor_is_not_found(self):
+        cursor = parse_qs(urlsplit(self.get("/api/products/?page_size=3&ordering=price").data["next"]).query)["cursor"][0]
+        # A cursor only fits the ordering it was issued for.
+        self.assertEqual(self.get(f"/api/products/?page_size=3&ordering=-price&cursor={cursor}").status_code, 404)
+        self.assertEqual(self.get("/api/products/?cursor=bm90LWpzb24").status_code, 404)
+
+    def test_every_ordering_has_an_index(self):
+        indexes = [spec["fields"] for spec in Product._meta["index_specs"]]
+        for field in filter(None, ProductKeysetPagination.orderings.values()):
+            self.assertIn([(field, 1), ("_id", 1)], indexes)
+            self.assertIn([("category", 1), (field, 1), ("_id", 1)], indexes)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CatalogCacheTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.product = Product(name="Lamp", category=Category(name="Home").save(), price=Decimal("5.00")).save()
+        self.user = SimpleNamespace(id="u", pk="u", is_authenticated=True)
+
+    def call(self, method, actions, data=None, **kwargs):
+        request = getattr(APIRequestFactory(), method)("/api/products/", data, format="json")
+        force_authenticate(request, self.user)
+        return views.ProductViewSet.as_view(actions, detail="id" in kwargs)(request, **kwargs)
+
+    def test_reads_are_cached_until_the_product_changes(self):
+        detail = {"get": "retrieve", "patch": "partial_update"}
+        product_id = str(self.product.id)
+        self.assertEqual(self.call("get", {"get": "list"}).data["results"][0]["price"], "5.00")
+        self.assertEqual(self.call("get", detail, id=product_id).data["price"], "5.00")
+
+        with mock.patch.object(views.ProductViewSet, "get_queryset", side_effect=AssertionError("not cached")):
+            self.assertEqual(self.call("get", {"get": "list"}).data["results"][0]["price"], "5.00")
+            self.assertEqual(self.call("get", detail, id=product_id).data["price"], "5.00")
+
+        with mock.patch("api.serializers.refresh_cart_snapshots.delay"):
+            self.assertEqual(self.call("patch", detail, {"price": "7.50"}, id=product_id).status_code, 200)
+        self.assertEqual(self.call("get", {"get": "list"}).data["results"][0]["price"], "7.50")
+        self.assertEqual(self.call("get", detail, id=product_id).data["price"], "7.50")
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class UserCacheTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        user_cache._local.clear()
+        self.addCleanup(user_cache._local.clear)
+        self.user = User(email="admin@example.com", password="pw").save()
+
+    def test_users_are_cached_until_saved(self):
+        self.assertFalse(user_cache.get_user(self.user.id).is_admin)
+        with mock.patch.object(User, "objects", side_effect=AssertionError("not cached")):
+            self.assertEqual(user_cache.get_user(self.user.id).email, "admin@example.com")
+            user_cache._local.clear()
+            self.assertEqual(user_cache.get_user(self.user.id).id, self.user.id)
+
+        self.user.is_admin = True
+        self.user.save()
+        self.assertTrue(user_cache.get_user(self.user.id).is_admin)
+        self.assertIsNone(user_cache.get_user(ObjectId()))
+        self.assertIsNone(user_cache.get_user("not-an-id"))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CartMutationTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        category = Category(name="Books").save()
+        self.book = Product(name="Book", category=category, price=Decimal("10.00")).save()
+        self.pen = Product(name="Pen", category=category, price=Decimal("1.25")).save()
+        self.user = User(email="buyer@example.com", password="pw").save()
+
+    def call(self, method, data):
+        request = getattr(APIRequestFactory(), method)("/api/cart/item/", data, format="json")
+        force_authenticate(request, self.user)
+        return views.CartItemView.as_view()(request)
+
+    def test_lines_and_subtotal_follow_adds_and_removes(self):
+        self.call("post", {"product": str(self.book.id), "quantity": 1})
+        self.call("post", {"product": str(self.pen.id), "quantity": 4})
+        cart = self.call("post", {"product": str(self.book.id), "quantity": 2}).data["cart"]
+        self.assertEqual([(item["name"], item["quantity"]) for item in cart["items"]], [("Book", 3), ("Pen", 4)])
+        self.assertEqual(cart["subtotal"], "35.00")
+
+        cart = self.call("delete", {"product_id": str(self.pen.id)}).data["cart"]
+        self.assertEqual(([item["name"] for item in cart["items"]], cart["subtotal"]), (["Book"], "30.00"))
+        response = self.call("delete", {"product_id": str(self.pen.id)})
+        self.assertEqual((response.status_code, response.data["error"]), (404, "Product not in cart"))
+        self.assertEqual(self.call("delete", {"product_id": str(self.book.id)}).data["cart"]["subtotal"], "0.00")
+
+    def test_unknown_products_are_not_added(self):
+        response = self.call("post", {"product": str(ObjectId()), "quantity": 1})
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(cart_ops.get_cart(self.user.id))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CartLineSnapshotTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        category = Category(name="Books").save()
+        self.book = Product(name="Book", category=category, price=Decimal("10.00"), images=["https://example.com/b.png"]).save()
+        self.pen = Product(name="Pen", category=category, price=Decimal("1.50")).save()
+        self.user_id = ObjectId()
+
+    def add(self, product, quantity):
+        return cart_ops.add_item(self.user_id, cart_ops.product_snapshot(product.id), quantity)
+
+    def assertConsistent(self, cart):
+        self.assertAlmostEqual(cart["subtotal"], sum(cart_ops.line_total(line) for line in cart["items"]))
+
+    def test_repricing_a_line_moves_the_subtotal_by_its_whole_quantity(self):
+        # mongomock's find_one_and_update loses the positional match, so the
+        # line under test comes first in the cart.
+        self.add(self.book, 2)
+        self.add(self.pen, 1)
+        self.book.price = Decimal("12.00")
+        self.book.save()
+
+        cart = self.add(self.book, 1)
+        self.assertEqual((cart["items"][0]["quantity"], cart["items"][0]["price"]), (3, 12.0))
+        self.assertAlmostEqual(cart["subtotal"], 37.5)
+        self.assertConsistent(cart)
+
+        cart = cart_ops.remove_item(self.user_id, self.book.id)
+        self.assertEqual([line["product"] for line in cart["items"]], [self.pen.id])
+        self.assertAlmostEqual(cart["subtotal"], 1.5)
+
+    def test_refresh_rewrites_stale_snapshots_and_subtotals(self):
+        self.add(self.book, 2)
+        Product.objects(id=self.book.id).update(set__name="Hardback", set__price=Decimal("11.00"))
+        tasks.refresh_cart_snapshots([str(self.book.id)])
+
+        cart = cart_ops.get_cart(self.user_id)
+        self.assertEqual((cart["items"][0]["name"], cart["items"][0]["thumbnail"]), ("Hardback", "https://example.com/b.png"))
+        self.assertAlmostEqual(cart["subtotal"], 22.0)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CheckoutTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        category = Category(name="Books").save()
+        self.book = Product(name="Book", category=category, price=Decimal("10.00"), stock=5).save()
+        self.pen = Product(name="Pen", category=category, price=Decimal("1.25"), stock=1).save()
+        self.user = User(email="buyer@example.com", password="pw").save()
+        cart_ops.add_item(self.user.id, cart_ops.product_snapshot(self.book.id), 2)
+        cart_ops.add_item(self.user.id, cart_ops.product_snapshot(self.pen.id), 1)
+
+    def stock(self):
+        return [product.reload().stock for product in (self.book, self.pen)]
+
+    def test_order_takes_the_stock_and_empties_the_cart(self):
+        order = checkout.place_order(self.user)
+        self.assertEqual(order["total_price"], Decimal("21.25"))
+        self.assertEqual(self.stock(), [3, 0])
+        cart = cart_ops.get_cart(self.user.id)
+        self.assertEqual((cart["items"], cart["subtotal"]), ([], 0))
+        # The status change, and the stock taken without a transaction.
+        self.assertEqual(OutboxEvent.objects.count(), 2)
+        self.assertEqual([product.reload().checkout_holds for product in (self.book, self.pen)], [
+            [{"order": order["id"], "quantity": 2}], [{"order": order["id"], "quantity": 1}],
+        ])
+
+        self.assertEqual(outbox.drain(), 2)
+        self.assertEqual(self.stock(), [3, 0])
+        self.assertEqual([product.reload().checkout_holds for product in (self.book, self.pen)], [[], []])
+
+    def test_a_short_line_puts_back_the_lines_already_taken(self):
+        decremented = {}
+        with self.assertRaises(checkout.InsufficientStock):
+            checkout._decrement_stock_without_transaction(
+                Product._get_collection(), ObjectId(), {self.book.id: 2, self.pen.id: 3}, decremented,
+            )
+        self.assertEqual((self.stock(), decremented), ([5, 1], {}))
+
+        Product.objects(id=self.pen.id).update(set__stock=0)
+        with self.assertRaises(checkout.InsufficientStock):
+            checkout.place_order(self.user)
+        self.assertEqual((self.stock(), Order.objects.count()), ([5, 0], 0))
+
+    def test_a_failed_cart_update_takes_the_order_back(self):
+        update_one = mongomock.collection.Collection.update_one
+
+        def failing(collection, filter, update, *args, **kwargs):
+            if collection.name == "carts":
+                raise PyMongoError("connection reset")
+            return update_one(collection, filter, update, *args, **kwargs)
+
+        with mock.patch.object(mongomock.collection.Collection, "update_one", failing):
+            with self.assertRaises(PyMongoError):
+                checkout.place_order(self.user)
+        self.assertEqual(self.stock(), [5, 1])
+        self.assertEqual((Order.objects.count(), OutboxEvent.objects.count()), (0, 0))
+        self.assertEqual(len(cart_ops.get_cart(self.user.id)["items"]), 2)
+
+    def test_stock_taken_by_a_dead_checkout_comes_back(self):
+        insert_one = mongomock.collection.Collection.insert_one
+
+        def dying(collection, document, *args, **kwargs):
+            if collection.name == "orders":
+                # Not an Exception: nothing gets to clean up, as if the process died.
+                raise SystemExit
+            return insert_one(collection, document, *args, **kwargs)
+
+        with mock.patch.object(mongomock.collection.Collection, "insert_one", dying):
+            with self.assertRaises(SystemExit):
+                checkout.place_order(self.user)
+        self.assertEqual(self.stock(), [3, 0])
+        self.assertEqual(outbox.drain(), 0)  # held until the write could have been confirmed
+
+        OutboxEvent.objects.update(set__available_at=datetime.utcnow())
+        self.assertEqual(outbox.drain(), 2)
+        self.assertEqual(self.stock(), [5, 1])
+        self.assertEqual([product.reload().checkout_holds for product in (self.book, self.pen)], [[], []])
+        self.assertEqual(outbox.drain(), 0)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CatalogImportTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.books = Category(name="Books", description="Paper").save()
+
+    def lines(self, *rows):
+        return [row if isinstance(row, str) else json.dumps(row) for row in rows]
+
+    def test_errors_are_reported_per_line(self):
+        Product(name="Atlas", category=self.books, price=Decimal("30.00"), stock=4).save()
+        with mock.patch.object(catalog_io.refresh_cart_snapshots, "delay") as refresh:
+            report = catalog_io.import_products(self.lines(
+                {"name": "Novel", "category": "Books", "price": "9.50"},
+                "{not json",
+                "",
+                {"name": "Atlas", "category": str(self.books.id), "price": "25.00"},
+                {"name": "Comic", "category": "Nowhere", "price": "3.00"},
+                {"name": "Poster", "category": "Books", "price": "cheap"},
+                "[1, 2]",
+            ), chunk_size=2).as_dict()
+        refresh.assert_called_once_with()
+
+        self.assertEqual((report["created"], report["updated"], report["failed"]), (1, 1, 4))
+        self.assertEqual([error["line"] for error in report["errors"]], [2, 5, 6, 7])
+        self.assertEqual(report["errors"][1]["errors"], {"category": ["Invalid category ID"]})
+        atlas = Product.objects.get(name="Atlas")
+        # Fields a row leaves out keep their stored values.
+        self.assertEqual((atlas.price, atlas.stock), (Decimal("25.00"), 4))
+
+        exported = [json.loads(line) for line in catalog_io.export_products()]
+        self.assertEqual([(row["name"], row["price"], row["category"]) for row in exported], [
+            ("Atlas", "25.00", str(self.books.id)), ("Novel", "9.50", str(self.books.id)),
+        ])
+
+    def test_imported_categories_retire_their_cached_details(self):
+        request = APIRequestFactory().get(f"/api/categories/{self.books.id}/")
+        force_authenticate(request, SimpleNamespace(id="u", pk="u", is_authenticated=True, is_staff=True))
+        detail = views.CategoryViewSet.as_view({"get": "retrieve"}, detail=True)
+        etag = detail(request, pk=str(self.books.id))["ETag"]
+
+        report = catalog_io.import_categories(self.lines({"name": "Books", "description": "Paperback"}, {"name": "Games"}))
+        self.assertEqual((report.created, report.updated), (1, 1))
+        response = detail(request, pk=str(self.books.id))
+        self.assertEqual(response.data["description"], "Paperback")
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual([json.loads(line)["name"] for line in catalog_io.export_categories()], ["Books", "Games"])
+
+
+class MongoIndexTests(MongomockTestCase):
+
+    def test_declared_indexes_are_created(self):
+        call_command("mongo_indexes", "--no-explain", stdout=StringIO())
+        created = Product._get_db()["products"].index_information()
+        for spec in Product._meta["index_specs"]:
+            if all(isinstance(direction, int) for _, direction in spec["fields"]):
+                self.assertIn("_".join(f"{field}_{direction}" for field, direction in spec["fields"]), created)
+
+    def test_collection_scans_fail_the_audit(self):
+        plans = {
+            "by name": {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}},
+            "by description": {"queryPlanner": {
+                "winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}},
+                "rejectedPlans": [{"stage": "IXSCAN"}],
+            }},
+        }
+        shapes = [QueryShape(name, Product, {name.split()[1]: "x"}) for name in plans]
+
+        def raw_collection(document):
+            collection = mock.Mock()
+            collection.find.side_effect = lambda filter: mock.Mock(explain=lambda: plans[f"by {next(iter(filter))}"])
+            return collection
+
+        out = StringIO()
+        with mock.patch.object(mongo_indexes, "QUERY_SHAPES", shapes), \
+                mock.patch.object(mongo_indexes, "_raw_collection", raw_collection):
+            with self.assertRaisesMessage(CommandError, "1 query shape(s) use a collection scan: by description"):
+                call_command("mongo_indexes", "--no-sync", stdout=out)
+            call_command("mongo_indexes", "--no-sync", "--warn-only", stdout=out)
+        self.assertIn("ok        by name", out.getvalue())
+
+
+class ProductSearchTests(MongomockTestCase):
+    """ mongomock has no $text: the aggregation's output is canned """
+
+    def setUp(self):
+        super().setUp()
+        self.books = Category(name="Books").save()
+
+    def test_first_page_carries_facets_and_a_cursor(self):
+        docs = [{"_id": ObjectId(), "name": f"Phone {i}", "category": self.books.id, "price": 12.5, "score": 3.0 - i} for i in range(3)]
+        outcome = {
+            "results": docs,
+            "total": [{"count": 7}],
+            "categories": [{"_id": self.books.id, "count": 7}],
+            "price_ranges": [{"_id": 10, "count": 5}, {"_id": 1000, "count": 2}],
+        }
+        with mock.patch.object(mongomock.collection.Collection, "aggregate", return_value=iter([outcome])) as aggregate:
+            results, cursor, facets = search.search_products("phone", page_size=2)
+
+        pipeline = aggregate.call_args[0][0]
+        self.assertEqual(pipeline[0], {"$match": {"$text": {"$search": "phone"}}})
+        self.assertEqual([(row["name"], row["category"]) for row in results], [("Phone 0", "Books"), ("Phone 1", "Books")])
+        self.assertEqual(search.decode_cursor(cursor), (2.0, docs[1]["_id"]))
+        self.assertEqual(facets, {
+            "total": 7,
+            "categories": [{"id": str(self.books.id), "name": "Books", "count": 7}],
+            "price_ranges": [{"min": 10, "max": 25, "count": 5}, {"min": 1000, "max": None, "count": 2}],
+        })
+
+    def test_later_pages_skip_facets(self):
+        last_id = ObjectId()
+        pipeline = search.build_pipeline("phone", min_price=Decimal("5"), cursor=(2.0, last_id), page_size=2)
+        self.assertEqual(pipeline[0]["$match"]["price"], {"$gte": 5.0})
+        facets = pipeline[-1]["$facet"]
+        self.assertEqual(list(facets), ["results"])
+        self.assertEqual(facets["results"][0], {"$match": {"$or": [
+            {"score": {"$lt": 2.0}}, {"score": 2.0, "_id": {"$gt": last_id}},
+        ]}})
+        with self.assertRaises(NotFound):
+            search.decode_cursor("bm90LWpzb24")
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class FastListRenderingTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        books = Category(name="Books", description="Paper").save()
+        Category(name="Games").save()
+        Product(name="Novel", category=books, price=Decimal("9.90"), stock=3, description="A story").save()
+        Product(name="Atlas", category=books, price=Decimal("120"), images=["https://example.com/a.png"]).save()
+        Product(name="Zine", category=books, price=Decimal("0.5")).save()
+        self.user = SimpleNamespace(id="u", pk="u", is_authenticated=True, is_staff=True)
+
+    def render(self, viewset, path):
+        cache.clear()
+        request = APIRequestFactory().get(path)
+        force_authenticate(request, self.user)
+        response = viewset.as_view({"get": "list"})(request)
+        self.assertEqual(response.status_code, 200)
+        return response.render().content
+
+    def test_fast_path_matches_the_serializers_byte_for_byte(self):
+        for viewset, path in (
+            (views.ProductViewSet, "/api/products/?page_size=2&ordering=-price"),
+            (views.ProductViewSet, "/api/products/?ordering=name&fields=name,category,images"),
+            (views.CategoryViewSet, "/api/categories/"),
+        ):
+            with override_settings(FAST_LIST_RESPONSES=False):
+                expected = self.render(viewset, path)
+            self.assertEqual(self.render(viewset, path), expected, path)
+
+
+@skipUnless(mongomock_motor, "mongomock-motor is not installed")
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class AsyncReadTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        books = Category(name="Books").save()
+        for i, price in enumerate(["4.00", "2.50", "9.99", "2.50"]):
+            Product(name=f"Item {i}", category=books, price=Decimal(price), images=["https://example.com/i.png"] * i).save()
+        self.user = User(email="buyer@example.com", password="pw").save()
+        cart_ops.add_item(self.user.id, cart_ops.product_snapshot(Product.objects.first().id), 2)
+
+        # The async views read the same in-memory database through motor's API.
+        client = mongomock_motor.AsyncMongoMockClient(mock_mongo_client=Product._get_db().client)
+        patcher = mock.patch.object(async_mongo, "get_client", return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        overrides = override_settings(MONGODB_NAME=Product._get_db().name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.headers = {"Authorization": f"Bearer {RefreshToken.for_user(self.user).access_token}"}
+
+    def get_async(self, view, path, **kwargs):
+        request = AsyncRequestFactory().get(path, headers=self.headers)
+        response = async_to_sync(view.as_view())(request, **kwargs)
+        return response.status_code, json.loads(response.content)
+
+    def get_sync(self, view, path, **kwargs):
+        request = APIRequestFactory().get(path)
+        force_authenticate(request, self.user)
+        response = view(request, **kwargs)
+        return response.status_code, json.loads(response.render().content)
+
+    def test_async_reads_match_the_sync_views(self):
+        product_id = str(Product.objects.first().id)
+        for path in ("/api/products/?ordering=-price&page_size=3", "/api/products/?ordering=name&fields=name,category"):
+            async_status, async_data = self.get_async(async_views.AsyncProductListView, path.replace("/api/", "/api/async/"))
+            self.assertEqual(
+                (async_status, {**async_data, "next": async_data["next"] and async_data["next"].replace("/async", "")}),
+                self.get_sync(views.ProductViewSet.as_view({"get": "list"}), path),
+            )
+        self.assertEqual(
+            self.get_async(async_views.AsyncProductDetailView, f"/api/async/products/{product_id}/", id=product_id),
+            self.get_sync(views.ProductViewSet.as_view({"get": "retrieve"}, detail=True), f"/api/products/{product_id}/", id=product_id),
+        )
+        self.assertEqual(
+            self.get_async(async_views.AsyncCartView, "/api/async/cart/"),
+            self.get_sync(views.CartView.as_view(), "/api/cart/"),
+        )
+
+    def test_requests_need_a_token(self):
+        self.headers = {}
+        self.assertEqual(self.get_async(async_views.AsyncCartView, "/api/async/cart/")[0], 401)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class RollupTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category(name="Books").save()
+        self.book = Product(name="Book", category=self.category, price=Decimal("10.00"), stock=5).save()
+        self.user = User(email="buyer@example.com", password="pw").save()
+        cart_ops.add_item(self.user.id, cart_ops.product_snapshot(self.book.id), 2)
+        self.order = checkout.place_order(self.user)
+        rollups.record_order(self.order)
+
+    def rollups(self):
+        return {
+            rollup["granularity"]: rollup
+            for rollup in SalesRollup._get_collection().find({}, {"_id": 0, "period": 0})
+        }
+
+    def test_placed_order_is_counted_in_its_hour_and_day(self):
+        expected = {
+            "revenue_cents": 2000, "orders": 1, "units": 2,
+            "products": {str(self.book.id): 2}, "categories": {str(self.category.id): 2},
+        }
+        self.assertEqual(self.rollups(), {
+            "hour": dict(expected, granularity="hour"), "day": dict(expected, granularity="day"),
+        })
+
+    def test_cancel_and_coupon_adjust_the_order_period(self):
+        rollups.record_revenue_change(self.order["created_at"], "Pending", Decimal("20.00"), Decimal("18.00"))
+        self.assertEqual([rollup["revenue_cents"] for rollup in self.rollups().values()], [1800, 1800])
+
+        order_id = str(self.order["id"])
+        rollups.record_status_change(order_id, "Pending", "Cancelled")
+        for rollup in self.rollups().values():
+            self.assertEqual(
+                (rollup["revenue_cents"], rollup["orders"], rollup["units"], rollup["products"][str(self.book.id)]),
+                (-200, 0, 0, 0),
+            )
+        # A coupon on a cancelled order leaves the rollups alone.
+        rollups.record_revenue_change(self.order["created_at"], "Cancelled", Decimal("20.00"), Decimal("10.00"))
+        self.assertEqual([rollup["revenue_cents"] for rollup in self.rollups().values()], [-200, -200])
+
+    def test_nightly_rebuild_restores_a_lost_delta(self):
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        Order._get_collection().update_one({"_id": self.order["id"]}, {"$set": {"created_at": yesterday}})
+        SalesRollup.objects.delete()
+
+        tasks.rebuild_recent_rollups()
+        rebuilt = self.rollups()
+        self.assertEqual(
+            [(rebuilt[granularity]["revenue_cents"], rebuilt[granularity]["orders"]) for granularity in ("hour", "day")],
+            [(2000, 1), (2000, 1)],
+        )
+        self.assertEqual(rebuilt["day"]["products"], {str(self.book.id): 2})
+
+    def test_orders_without_created_at_are_dated_by_their_id(self):
+        orders = Order._get_collection()
+        orders.update_one({"_id": self.order["id"]}, {"$unset": {"created_at": ""}})
+        rollups.record_status_change(str(self.order["id"]), "Pending", "Cancelled")
+        self.assertEqual([rollup["orders"] for rollup in self.rollups().values()], [0, 0])
+
+        call_command("rebuild_rollups", "--all", stdout=StringIO())
+        call_command("backfill_order_dates", stdout=StringIO())
+        self.assertEqual(
+            orders.find_one({"_id": self.order["id"]})["created_at"],
+            self.order["id"].generation_time.replace(tzinfo=None),
+        )
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class OrderStatusNotificationTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.users = []
+        for i in range(3):
+            user = User(email=f"user{i}@example.com")
+            user.set_password("pw")
+            self.users.append(user.save())
+        # Celery runs the fan-out inline.
+        patcher = mock.patch.object(tasks.send_order_status_emails, "delay", tasks.send_order_status_emails)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def place_order(self, user, minutes_ago):
+        stamp = datetime.utcnow() - timedelta(minutes=minutes_ago)
+        Order._get_collection().insert_one(Order(
+            user=user, total_price=Decimal("10.00"), created_at=stamp, updated_at=stamp, status_changed_at=stamp,
+        ).to_mongo())
+        return Order.objects.order_by("-id").first()
+
+    def test_status_change_is_stamped_on_save(self):
+        order = self.place_order(self.users[0], minutes_ago=30)
+        before = order.status_changed_at
+
+        order.total_price = Decimal("9.00")
+        order.save()
+        self.assertEqual(Order.objects.get(id=order.id).status_changed_at, before)
+
+        order.status = "Shipped"
+        order.save()
+        order.reload()
+        self.assertGreater(order.status_changed_at, before)
+        self.assertEqual(order.updated_at, order.status_changed_at)
+
+    def test_sends_each_change_once_from_the_checkpoint(self):
+        orders = [self.place_order(self.users[i % 3], minutes_ago=10) for i in range(5)]
+        self.place_order(self.users[0], minutes_ago=0)  # still settling
+
+        tasks.send_periodic_order_status_updates()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            sorted(f"user{i % 3}@example.com" for i in range(5)),
+        )
+        bodies = {message.subject: message.body for message in mail.outbox}
+        self.assertEqual(
+            bodies[f"Order #{orders[0].id} Status Update"],
+            f"Your order (ID: {orders[0].id}) status is now: Pending.",
+        )
+        self.assertIsNotNone(TaskCheckpoint.objects(name="order_status_notifications").first())
+
+        mail.outbox.clear()
+        tasks.send_periodic_order_status_updates()
+        self.assertEqual(mail.outbox, [])
+
+    def test_one_mail_connection_and_one_email_lookup_per_chunk(self):
+        for i in range(5):
+            self.place_order(self.users[i % 3], minutes_ago=10)
+
+        lookups = []
+        find = mongomock.collection.Collection.find
+
+        def spy(collection, *args, **kwargs):
+            if collection.name == "users":
+                lookups.append(args)
+            return find(collection, *args, **kwargs)
+
+        with mock.patch.object(tasks, "NOTIFICATION_CHUNK_SIZE", 2), \
+                mock.patch.object(order_status, "get_connection", wraps=order_status.get_connection) as get_connection, \
+                mock.patch.object(mongomock.collection.Collection, "find", spy):
+            tasks.send_periodic_order_status_updates()
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(get_connection.call_count, 3)
+        self.assertEqual(len(lookups), 3)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class OrderStatusOutboxTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        user = User(email="buyer@example.com")
+        user.set_password("pw")
+        self.user = user.save()
+        self.order = Order(user=self.user, total_price=Decimal("10.00")).save()
+
+    def test_status_change_is_delivered_once(self):
+        self.assertEqual(order_status.set_status(self.order.id, "Shipped"), "Pending")
+        self.assertEqual(OutboxEvent.objects(processed_at=None).count(), 1)
+
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual([message.body for message in mail.outbox], [
+            f"Your order (ID: {self.order.id}) status is now: Shipped.",
+        ])
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_unchanged_status_writes_no_event(self):
+        self.assertEqual(order_status.set_status(self.order.id, "Pending"), "Pending")
+        self.assertEqual(OutboxEvent.objects.count(), 0)
+
+    def test_failed_handler_is_retried_after_the_lease(self):
+        order_status.set_status(self.order.id, "Shipped")
+        with mock.patch.object(order_status, "send_status_emails", side_effect=ConnectionError), \
+                self.assertLogs("api.outbox", "ERROR"):
+            self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(outbox.drain(), 0)  # still leased
+
+        OutboxEvent.objects(processed_at=None).update(set__available_at=datetime.utcnow())
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CouponRedemptionTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        user = User(email="buyer@example.com")
+        user.set_password("pw")
+        self.user = user.save()
+        self.orders = [Order(user=self.user, total_price=Decimal("20.00")).save() for _ in range(3)]
+        Coupon(code="SAVE10", discount_percentage=10, usage_limit=2,
+               expiry_date=datetime.utcnow() + timedelta(days=1)).save()
+        collection = mongomock.collection.Collection
+        patcher = mock.patch.object(collection, "find_one_and_update", emulate_mul(collection.find_one_and_update))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_usage_limit_is_enforced(self):
+        for order in self.orders[:2]:
+            _, total = coupons.redeem("SAVE10", str(order.id), self.user)
+            self.assertEqual(total, Decimal("18.00"))
+        with self.assertRaises(coupons.CouponExhausted):
+            coupons.redeem("SAVE10", str(self.orders[2].id), self.user)
+        self.assertEqual(Coupon.objects.get(code="SAVE10").used_count, 2)
+
+    def test_second_coupon_on_an_order_is_rejected_and_released(self):
+        coupons.redeem("SAVE10", str(self.orders[0].id), self.user)
+        with self.assertRaises(coupons.CouponAlreadyApplied):
+            coupons.redeem("SAVE10", str(self.orders[0].id), self.user)
+        self.assertEqual(Coupon.objects.get(code="SAVE10").used_count, 1)
+        self.assertEqual(Order.objects.get(id=self.orders[0].id).total_price, Decimal("18.00"))
+
+    def test_the_order_is_returned_as_it_was(self):
+        order, total = coupons.redeem("SAVE10", str(self.orders[0].id), self.user)
+        self.assertEqual((order["total_price"], total), (Decimal("20.00"), Decimal("18.00")))
+
+        Coupon(code="FREE", discount_percentage=100, usage_limit=1,
+               expiry_date=datetime.utcnow() + timedelta(days=1)).save()
+        order, total = coupons.redeem("FREE", str(self.orders[1].id), self.user)
+        self.assertEqual((order["total_price"], total), (Decimal("20.00"), Decimal("0.00")))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class OrderStatusTransitionTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User(email="buyer@example.com", password="pw").save()
+
+    def order(self, status="Pending"):
+        return Order(user=self.user, total_price=Decimal("10.00"), status=status).save().id
+
+    def test_status_never_moves_back(self):
+        order_id = self.order("Delivered")
+        with self.assertRaises(order_status.InvalidTransition):
+            order_status.set_status(order_id, "Pending")
+        self.assertEqual(Order.objects.get(id=order_id).status, "Delivered")
+        self.assertEqual(OutboxEvent.objects.count(), 0)
+
+    def test_bulk_changes_are_reported_one_by_one(self):
+        pending, shipped, delivered, cancelled = self.order(), self.order("Shipped"), self.order("Delivered"), self.order()
+        report = order_status.set_statuses([
+            (pending, "Shipped"),
+            (delivered, "Pending"),
+            (cancelled, "Cancelled"),
+            (ObjectId(), "Shipped"),
+            ("not-an-id", "Shipped"),
+            (pending, "Delivered"),
+            (delivered, "Returned"),
+            (shipped, "Shipped"),
+        ])
+        self.assertEqual([item["result"] for item in report], [
+            order_status.UPDATED, order_status.REJECTED, order_status.UPDATED, order_status.NOT_FOUND,
+            order_status.INVALID, order_status.INVALID, order_status.INVALID, order_status.UNCHANGED,
+        ])
+        self.assertEqual(report[0]["previous"], "Pending")
+        self.assertEqual(
+            {order.id: order.status for order in Order.objects},
+            {pending: "Shipped", shipped: "Shipped", delivered: "Delivered", cancelled: "Cancelled"},
+        )
+        self.assertEqual(OutboxEvent.objects.count(), 2)
+
+        rollups.record_status_changes((item["order_id"], item["previous"], item["status"]) for item in report[:3:2])
+        self.assertEqual([rollup.orders for rollup in SalesRollup.objects], [-1, -1])
+
+    def test_conflicted_changes_emit_no_event(self):
+        raced, clean = self.order(), self.order()
+        bulk_write = mongomock.collection.Collection.bulk_write
+
+        def racing(collection, requests, *args, **kwargs):
+            # Another writer delivers one order between the read and the write.
+            collection.update_one({"_id": raced}, {"$set": {"status": "Delivered"}})
+            return bulk_write(collection, requests, *args, **kwargs)
+
+        with mock.patch.object(mongomock.collection.Collection, "bulk_write", racing):
+            report = order_status.set_statuses([(raced, "Shipped"), (clean, "Shipped")])
+        self.assertEqual([item["result"] for item in report], [order_status.CONFLICT, order_status.UPDATED])
+        self.assertEqual(
+            [(event.payload["order_id"], event.payload["status"]) for event in OutboxEvent.objects],
+            [(clean, "Shipped")],
+        )
+        self.assertEqual(OutboxEvent.objects(available_at__gt=datetime.utcnow()).count(), 0)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CategoryDeletionTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category(name="Books").save()
+        self.other = Category(name="Games").save()
+        self.doomed = [
+            Product(name=f"Book {i}", category=self.category, price=Decimal("5.00")).save().id for i in range(5)
+        ]
+        self.kept = Product(name="Chess", category=self.other, price=Decimal("20.00")).save().id
+        self.user = User(email="buyer@example.com", password="pw").save()
+        for product_id in (self.doomed[0], self.kept):
+            cart_ops.add_item(self.user.id, cart_ops.product_snapshot(product_id), 2)
+
+    def delete(self, **params):
+        request = APIRequestFactory().delete(f"/api/categories/{self.category.id}/?" + "&".join(f"{k}={v}" for k, v in params.items()))
+        force_authenticate(request, SimpleNamespace(id=str(self.user.id), pk=str(self.user.id), is_authenticated=True, is_staff=True))
+        with mock.patch.object(tasks.purge_category, "delay") as delay:
+            response = views.CategoryViewSet.as_view({"delete": "destroy"})(request, pk=str(self.category.id))
+        self.assertEqual(response.status_code, 202)
+        delay.assert_called_once_with(response.data["id"])
+        return CategoryDeletion.objects.get(id=response.data["id"])
+
+    def test_products_are_purged_in_batches_after_the_tombstone(self):
+        deletion = self.delete()
+        self.assertFalse(Category.objects(id=self.category.id, deleted_at=None))
+        self.assertEqual(deletion.products_total, 5)
+
+        self.assertEqual(category_purge.purge_batch(deletion, batch_size=2), 2)
+        self.assertEqual(Product.objects(category=self.category.id).count(), 3)
+        tasks.purge_category(str(deletion.id))
+
+        deletion.reload()
+        self.assertEqual((deletion.status, deletion.products_done, deletion.carts_updated), ("Done", 5, 1))
+        self.assertFalse(Category.objects(id=self.category.id))
+        self.assertEqual(Product.objects.count(), 1)
+        cart = cart_ops.get_cart(self.user.id)
+        self.assertEqual([item["product"] for item in cart["items"]], [self.kept])
+        self.assertEqual(cart["subtotal"], 40.0)
+
+    def test_products_can_move_to_another_category(self):
+        deletion = self.delete(reassign_to=self.other.id)
+        tasks.purge_category(str(deletion.id))
+
+        self.assertEqual(Product.objects(category=self.other.id).count(), 6)
+        self.assertFalse(Category.objects(id=self.category.id))
+        self.assertEqual(len(cart_ops.get_cart(self.user.id)["items"]), 2)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class OrderHistoryTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = User(email="buyer@example.com", password="pw").save()
+        now = datetime.utcnow()
+        self.order_ids = []
+        for minutes_ago, total in enumerate(["10.00", "20.00", "30.00"]):
+            stamp = now - timedelta(minutes=minutes_ago)
+            self.order_ids.append(Order._get_collection().insert_one(Order(
+                user=self.user, total_price=Decimal(total), created_at=stamp, updated_at=stamp, status_changed_at=stamp,
+            ).to_mongo()).inserted_id)
+
+    def get(self, path="/api/orders/", **params):
+        request = APIRequestFactory().get(path, params)
+        force_authenticate(request, SimpleNamespace(id=str(self.user.id), pk=str(self.user.id), is_authenticated=True, is_admin=False))
+        return views.OrderListView.as_view()(request)
+
+    def test_pages_run_newest_first(self):
+        seen, path, params = [], "/api/orders/", {"page_size": 2, "fields": "id"}
+        while path:
+            response = self.get(path, **params)
+            seen += [row["id"] for row in response.data["results"]]
+            path, params = response.data["next"], {}
+        self.assertEqual(seen, self.order_ids)
+        self.assertEqual([row["id"] for row in self.get(status="Cancelled").data["results"]], [])
+
+    def test_undated_orders_page_after_the_dated_ones(self):
+        # Written before created_at had a default.
+        legacy = [
+            Order._get_collection().insert_one({"user": self.user.id, "total_price": 5.0, "status": "Pending"}).inserted_id
+            for _ in range(2)
+        ]
+        for ordering, expected in (("-created_at", self.order_ids + legacy[::-1]), ("created_at", legacy + self.order_ids[::-1])):
+            seen, path, params = [], "/api/orders/", {"page_size": 1, "fields": "id", "ordering": ordering}
+            while path:
+                response = self.get(path, **params)
+                self.assertEqual(response.status_code, 200)
+                seen += [row["id"] for row in response.data["results"]]
+                path, params = response.data["next"], {}
+            self.assertEqual(seen, expected)
+
+    def test_summary_is_cached_until_an_order_changes(self):
+        self.assertEqual(self.get().data["summary"], {
+            "order_count": 3, "lifetime_spend": "60.00",
+            "by_status": {"Pending": 3, "Shipped": 0, "Delivered": 0, "Cancelled": 0},
+        })
+        with mock.patch.object(order_history, "compute_summary", side_effect=AssertionError("not cached")):
+            self.assertEqual(self.get(page_size=1).data["summary"]["order_count"], 3)
+
+        order_status.set_status(self.order_ids[0], "Cancelled")
+        summary = self.get().data["summary"]
+        self.assertEqual(summary["lifetime_spend"], "50.00")
+        self.assertEqual(summary["by_status"]["Cancelled"], 1)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CatalogSnapshotTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        catalog_snapshot.reset()
+        self.addCleanup(catalog_snapshot.reset)
+        self.categories = [Category(name=name).save() for name in ("Books", "Games")]
+        self.products = [
+            Product(name=f"Item {i}", category=self.categories[i % 2], price=Decimal(["9.99", "2.50", "10.00"][i % 3]), stock=i).save()
+            for i in range(12)
+        ]
+        self.user = SimpleNamespace(id="u", pk="u", is_authenticated=True, is_staff=True)
+
+    def get(self, path, action="list", **kwargs):
+        request = APIRequestFactory().get(path)
+        force_authenticate(request, self.user)
+        response = views.ProductViewSet.as_view({"get": action})(request, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response.render().content
+
+    def walk(self, path):
+        pages = []
+        while path:
+            pages.append(self.get(path))
+            path = json.loads(pages[-1])["next"]
+        return pages
+
+    def test_snapshot_pages_match_mongodb(self):
+        paths = [
+            "/api/products/?page_size=5&ordering=-price",
+            f"/api/products/?page_size=2&ordering=price&min_price=2.5&max_price=9.99&category={self.categories[1].id}",
+            "/api/products/?page_size=4&ordering=name&fields=id,name",
+        ]
+        expected = [self.walk(path) for path in paths]
+        with override_settings(CATALOG_SNAPSHOT={"ENABLED": True, "CHECK_INTERVAL": 0}):
+            cache.clear()
+            self.assertEqual([self.walk(path) for path in paths], expected)
+            self.assertIsNotNone(catalog_snapshot._snapshot)
+
+    def test_refresh_reads_only_changed_products(self):
+        # Stamped well before the first load, outside the refresh's overlap.
+        Product._get_collection().update_many({}, {"$set": {"updated_at": datetime.utcnow() - timedelta(hours=1)}})
+        with override_settings(CATALOG_SNAPSHOT={"ENABLED": True, "CHECK_INTERVAL": 0}):
+            first = catalog_snapshot.get_snapshot()
+            self.assertIs(catalog_snapshot.get_snapshot(), first)
+
+            renamed, deleted = self.products[0], self.products[1]
+            renamed.name = "Renamed"
+            renamed.save()
+            deleted.delete()
+            caching.bump(caching.PRODUCT_LIST)
+            with mock.patch.object(catalog_snapshot, "ProductEntry", wraps=catalog_snapshot.ProductEntry) as entry:
+                second = catalog_snapshot.get_snapshot()
+            self.assertEqual(entry.call_count, 1)
+            self.assertEqual(second.products[renamed.id].name, "Renamed")
+            self.assertNotIn(deleted.id, second.products)
+            self.assertEqual(len(second.sorted[(None, "name")]), 11)
+            detail = json.loads(self.get(f"/api/products/{renamed.id}/", action="retrieve", id=str(renamed.id)))
+            self.assertEqual(detail["name"], "Renamed")
+
+    def test_refresh_patches_the_sorted_products(self):
+        with override_settings(CATALOG_SNAPSHOT={"ENABLED": True, "CHECK_INTERVAL": 0}):
+            first = catalog_snapshot.get_snapshot()
+            moved, repriced, deleted = self.products[:3]
+            moved.category = self.categories[1]
+            moved.save()
+            Product._get_collection().update_one(
+                {"_id": repriced.id}, {"$set": {"price": 0.5, "updated_at": datetime.utcnow()}},
+            )
+            deleted.delete()
+            Product(name="Item new", category=self.categories[0], price=Decimal("5.00")).save()
+            caching.bump(caching.PRODUCT_LIST)
+            with mock.patch.object(catalog_snapshot, "_sort", wraps=catalog_snapshot._sort) as full_sort:
+                second = catalog_snapshot.get_snapshot()
+            self.assertEqual(full_sort.call_count, 0)
+            self.assertEqual(second.sorted, catalog_snapshot._sort(second.products))
+            self.assertEqual(second.products_in("price")[0].id, repriced.id)
+            self.assertEqual(len(first.products_in("price")), 12)
+
+
+@skipUnless(fakeredis, "fakeredis and lupa are not installed")
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class InventoryReservationTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        inventory.set_client(fakeredis.FakeStrictRedis())
+        self.addCleanup(inventory.set_client, None)
+        category = Category(name="Books").save()
+        self.product = str(Product(name="Novel", category=category, price=Decimal("5.00"), stock=5).save().id)
+
+    def test_reservations_never_exceed_stock(self):
+        inventory.reserve("cart:a", {self.product: 3})
+        with self.assertRaises(inventory.OutOfStock):
+            inventory.reserve("cart:b", {self.product: 3})
+        inventory.reserve("cart:b", {self.product: 2})
+        self.assertEqual(inventory.available(self.product), 0)
+
+        inventory.release("cart:a")
+        self.assertEqual(inventory.available(self.product), 3)
+
+    def test_committed_stock_is_flushed_once(self):
+        inventory.reserve("cart:a", {self.product: 2})
+        inventory.commit("cart:a", {self.product: 2})
+        inventory.commit("cart:b", {self.product: 1})
+        self.assertEqual(Product.objects.get(id=self.product).stock, 5)
+
+        self.assertEqual(inventory.reconcile(), (0, 1))
+        self.assertEqual(inventory.reconcile(), (0, 0))
+        self.assertEqual(Product.objects.get(id=self.product).stock, 2)
+        self.assertEqual(inventory.available(self.product), 2)
+
+    def test_expired_holds_are_released(self):
+        inventory.reserve("cart:a", {self.product: 4}, ttl=60)
+        with mock.patch.object(inventory.time, "time", return_value=inventory.time.time() + 120):
+            self.assertEqual(inventory.sweep(), 1)
+        self.assertEqual(inventory.available(self.product), 5)
+
+    @override_settings(INVENTORY={"ENABLED": True})
+    def test_a_failed_cart_write_gives_the_hold_back(self):
+        user = User(email="buyer@example.com", password="pw").save()
+        inventory.reserve(inventory.cart_reservation(user.id), {self.product: 1})
+
+        request = APIRequestFactory().post("/api/cart/item/", {"product": self.product, "quantity": 3}, format="json")
+        force_authenticate(request, user)
+        with mock.patch.object(cart_ops, "add_item", side_effect=PyMongoError("connection reset")), \
+                self.assertRaises(PyMongoError):
+            views.CartItemView.as_view()(request)
+        # Only the earlier hold is left.
+        self.assertEqual(inventory.available(self.product), 4)
+
+    @override_settings(INVENTORY={"ENABLED": True})
+    def test_a_product_deleted_meanwhile_is_not_found(self):
+        user = User(email="buyer@example.com", password="pw").save()
+        snapshot = cart_ops.product_snapshot(self.product)
+        Product.objects(id=self.product).delete()
+
+        request = APIRequestFactory().post("/api/cart/item/", {"product": self.product, "quantity": 1}, format="json")
+        force_authenticate(request, user)
+        with mock.patch.object(cart_ops, "product_snapshot", return_value=snapshot):
+            response = views.CartItemView.as_view()(request)
+        self.assertEqual((response.status_code, response.data), (404, {"error": "Product not found"}))
+
+    @override_settings(INVENTORY={"ENABLED": True})
+    def test_an_import_overwrites_the_held_stock(self):
+        inventory.reserve("cart:a", {self.product: 1})
+        with mock.patch.object(catalog_io.refresh_cart_snapshots, "delay"):
+            catalog_io.import_products([json.dumps({"name": "Novel", "category": "Books", "price": "5.00", "stock": 9})])
+        self.assertEqual(inventory.available(self.product), 8)
+
+
+@skipUnless(fakeredis, "fakeredis and lupa are not installed")
+class GCRAThrottleTests(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        throttling.set_client(self.redis)
+        throttling._denied.clear()
+        self.addCleanup(throttling.set_client, None)
+
+    def test_allows_the_burst_then_throttles(self):
+        results = [throttling.hit("throttle:test:1", 3, 60) for _ in range(4)]
+        self.assertEqual(results[:3], [None, None, None])
+        self.assertGreater(results[3], 0)
+        self.assertLessEqual(results[3], 20)
+        self.assertIsNone(throttling.hit("throttle:test:2", 3, 60))
+
+    def test_throttled_clients_are_answered_without_redis(self):
+        for _ in range(2):
+            throttling.hit("throttle:test:1", 1, 60)
+        with mock.patch.object(self.redis, "evalsha", side_effect=AssertionError) as evalsha:
+            self.assertIsNotNone(throttling.hit("throttle:test:1", 1, 60))
+        evalsha.assert_not_called()
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class EntityTagTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tags = [caching.product_tag("p1"), caching.CATALOG]
+
+    def request(self, method="get", path="/api/products/p1/", **headers):
+        request = Request(getattr(APIRequestFactory(), method)(path, headers=headers))
+        request.user = SimpleNamespace(is_authenticated=True, is_admin=False)
+        return request
+
+    def etag(self):
+        return caching.entity_tag(caching.get_generations(self.tags), self.request(), detail=True)
+
+    def test_etag_changes_when_a_tag_is_bumped(self):
+        etag = self.etag()
+        self.assertTrue(caching.none_match(self.request(if_none_match=f"W/{etag}"), etag))
+        caching.invalidate_category("c1")
+        self.assertNotEqual(self.etag(), etag)
+
+    def test_only_one_writer_holding_an_etag_goes_ahead(self):
+        etag = self.etag()
+        caching.check_if_match(self.request("patch", if_match=etag), self.tags)
+        with self.assertRaises(caching.PreconditionFailed):
+            caching.check_if_match(self.request("patch", if_match=etag), self.tags)
+
+    def test_a_sparse_fieldset_is_a_variant_of_the_same_version(self):
+        generations = caching.get_generations(self.tags)
+        sparse = caching.entity_tag(generations, self.request(path="/api/products/p1/?fields=name"), detail=True)
+        self.assertNotEqual(sparse, self.etag())
+        caching.check_if_match(self.request("patch", if_match=sparse), self.tags)
+
+
+class SparseFieldsetTests(SimpleTestCase):
+
+    def test_fields_and_exclude_are_validated(self):
+        self.assertIsNone(fieldsets.parse({}, ProductSerializer))
+        self.assertEqual(fieldsets.parse({"fields": "name,price,stock", "exclude": "stock"}, ProductSerializer), {"name", "price"})
+        for params in ({"fields": "name,secret"}, {"exclude": "id,name,description,category,price,stock,images"}):
+            with self.assertRaises(ValidationError):
+                fieldsets.parse(params, ProductSerializer)
+
+    def test_unselected_fields_are_not_read(self):
+        converter = PRODUCT_ROWS.subset(frozenset({"id", "name"}))
+        self.assertIs(PRODUCT_ROWS.subset(frozenset({"id", "name"})), converter)
+        self.assertEqual(converter.fields, ("name",))
+        rows = [{"_id": "p1", "name": "Novel", "category": ObjectId()}]
+        with mock.patch.object(Category, "_get_collection", side_effect=AssertionError):
+            self.assertEqual(converter.convert(rows), [{"id": "p1", "name": "Novel"}])
+        self.assertEqual(
+            list(fieldsets.serializer_for(ProductSerializer, frozenset({"price"}))({"price": Decimal("2.50")}).data), ["price"]
+        )
+
+
+class RequestMetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.listener = metrics.MongoCommandListener()
+
+    def run_request(self, collections):
+        stats, token = metrics.begin()
+        try:
+            for collection in collections:
+                self.listener.started(SimpleNamespace(command_name="find", command={"find": collection}))
+                self.listener.succeeded(SimpleNamespace(duration_micros=1000))
+            metrics.record_cache(1, 1)
+        finally:
+            metrics.end(token)
+        return metrics.record("cart", "GET", 200, 0.02, stats)
+
+    def test_commands_are_counted_per_view(self):
+        self.run_request(["carts"])
+        self.listener.succeeded(SimpleNamespace(duration_micros=1000))  # outside a request
+        text = metrics.render_prometheus()
+        self.assertIn('api_mongo_commands_total{view="cart",method="GET"} 1', text)
+        self.assertIn('api_cache_misses_total{view="cart",method="GET"} 1', text)
+        self.assertIn('api_request_duration_seconds_bucket{view="cart",method="GET",le="0.025"} 1', text)
+
+    def test_repeated_reads_are_flagged(self):
+        with self.assertLogs("api.metrics", "WARNING"):
+            repeated = self.run_request(["carts"] + ["products"] * metrics.DEFAULTS["N_PLUS_ONE_THRESHOLD"])
+        self.assertEqual(repeated, [("find", "products")])
+        self.assertEqual(metrics.snapshot()[("cart", "GET")].n_plus_one, 1)
+
+        # Logged once per view, and for at most MAX_REPORTED_N_PLUS_ONE views.
+        with self.assertNoLogs("api.metrics", "WARNING"):
+            self.run_request(["products"] * metrics.DEFAULTS["N_PLUS_ONE_THRESHOLD"])
+            with mock.patch.object(metrics, "MAX_REPORTED_N_PLUS_ONE", 1):
+                stats, token = metrics.begin()
+                for _ in range(metrics.DEFAULTS["N_PLUS_ONE_THRESHOLD"]):
+                    self.listener.started(SimpleNamespace(command_name="find", command={"find": "orders"}))
+                metrics.end(token)
+                metrics.record("orders", "GET", 200, 0.02, stats)
+        self.assertEqual(metrics._reported_n_plus_one, {("cart", "GET")})
+
+    def test_unknown_methods_share_one_label(self):
+        stats, token = metrics.begin()
+        metrics.end(token)
+        for method in ("PROPFIND", "X-ANYTHING"):
+            metrics.record("cart", method, 405, 0.001, stats)
+        self.assertEqual(list(metrics.snapshot()), [("cart", "OTHER")])
+        self.assertEqual(metrics.snapshot()[("cart", "OTHER")].requests, 2)
+
+
+@skipUnless(fakeredis, "fakeredis and lupa are not installed")
+class QueryBudgetTests(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        overrides = override_settings(**bench.bench_settings(bench.fakeredis_caches()))
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        cache.clear()
+        metrics.reset()
+        self.data = bench.seed(users=3, products=60, categories=3, orders_per_user=1)
+
+    def test_endpoints_stay_within_their_query_budgets(self):
+        results = bench.run_endpoints(self.data, 3, cold=True)
+        self.assertEqual([problem for result in results for problem in result.violations()], [])
+
+    def test_a_query_per_cart_line_breaks_the_budget(self):
+        get_cart = cart_ops.get_cart
+
+        def get_cart_reading_each_product(user_id, projection=None):
+            cart = get_cart(user_id, projection)
+            for line in cart["items"]:
+                Product._get_collection().find_one({"_id": line["product"]})
+            return cart
+
+        endpoints = [endpoint for endpoint in bench.ENDPOINTS if endpoint.name == "cart"]
+        with mock.patch.object(cart_ops, "get_cart", get_cart_reading_each_product):
+            [result] = bench.run_endpoints(self.data, 2, cold=True, endpoints=endpoints)
+        self.assertEqual(max(result.commands), bench.QUERY_BUDGETS["cart"] + 3)
+        self.assertEqual(len(result.violations()), 1)
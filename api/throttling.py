@@ -0,0 +1,201 @@
+"""
+GCRA rate limiting in one Redis round trip.
+
+DRF's `SimpleRateThrottle` reads a pickled list of request timestamps from
+the cache, trims it and writes it back: several round trips per request and
+a payload that grows with the rate. GCRA only keeps each client's
+"theoretical arrival time" (one number), and a Lua script checks and
+advances it atomically on Redis's clock, so every process agrees.
+
+A client that is turned away is also remembered in process until it may
+retry, so a client hammering a limited endpoint is answered without
+touching Redis at all.
+
+Rates come from `DEFAULT_THROTTLE_RATES`. A view names its bucket with
+`throttle_scope`; the rate is looked up as `<scope>.<action>` (viewset
+actions), then `<scope>`, then `user` / `anon`, and each of those names is
+a separate bucket per user (or per client IP when anonymous).
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from redis.exceptions import RedisError
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # django-redis cache alias whose connection holds the throttle state.
+    "REDIS_ALIAS": "default",
+    # Clients remembered per process as throttled until they may retry.
+    "LOCAL_SIZE": 4096,
+}
+
+DURATIONS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# KEYS: bucket. ARGV: emission interval and burst (ms). Returns
+# {allowed, ms to wait}. Times are in ms so the stored number stays exact.
+GCRA = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now)
+local allow_at = tat + interval - burst
+if now < allow_at then
+    return {0, math.ceil(allow_at - now)}
+end
+redis.call('SET', KEYS[1], tat + interval, 'PX', math.ceil(tat + interval - now))
+return {1, 0}
+"""
+
+_client = None
+_scripts = {}
+
+
+def get_setting(name):
+    return getattr(settings, "THROTTLING", {}).get(name, DEFAULTS[name])
+
+
+def get_client():
+    """ The Redis connection, or None when the cache backend is not Redis """
+    if _client is not None:
+        return _client
+    from django_redis import get_redis_connection
+    try:
+        return get_redis_connection(get_setting("REDIS_ALIAS"))
+    except NotImplementedError:
+        return None
+
+
+def set_client(client):
+    """ Use `client` instead of the django-redis connection (benchmarks, tests) """
+    global _client
+    _client = client
+    _scripts.clear()
+
+
+def parse_rate(rate):
+    """ "100/hour" -> (100, 3600) """
+    num, period = rate.split("/")
+    return int(num), DURATIONS[period[0]]
+
+
+class _DenyList:
+    """ Per-process memory of throttled buckets and when they may retry """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._until = OrderedDict()
+        self._lock = threading.Lock()
+
+    def wait(self, key):
+        with self._lock:
+            until = self._until.get(key)
+            if until is None:
+                return None
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                del self._until[key]
+                return None
+            return remaining
+
+    def add(self, key, wait):
+        with self._lock:
+            self._until[key] = time.monotonic() + wait
+            self._until.move_to_end(key)
+            while len(self._until) > self.maxsize:
+                self._until.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._until.clear()
+
+
+_denied = _DenyList(get_setting("LOCAL_SIZE"))
+
+
+def hit(key, num, duration):
+    """
+    Count one request against `num` per `duration` seconds for bucket `key`.
+    Returns None if it is allowed, else the seconds until one would be.
+    """
+    wait = _denied.wait(key)
+    if wait is not None:
+        return wait
+
+    interval, burst = duration * 1000 / num, duration * 1000
+    client = get_client()
+    try:
+        if client is None:
+            allowed, wait_ms = _hit_cache(key, interval, burst)
+        else:
+            script = _scripts.get(id(client))
+            if script is None:
+                script = _scripts[id(client)] = client.register_script(GCRA)
+            allowed, wait_ms = script(keys=[key], args=[interval, burst])
+    except RedisError:
+        # Rate limiting is not worth an outage: let the request through.
+        logger.warning("Throttle store unavailable; not throttling %s", key, exc_info=True)
+        return None
+
+    if allowed:
+        return None
+    wait = float(wait_ms) / 1000
+    _denied.add(key, wait)
+    return wait
+
+
+def _hit_cache(key, interval, burst):
+    """
+    The same algorithm on a non-Redis cache backend (development and tests).
+    Not atomic, so concurrent requests can slip a little past the limit.
+    """
+    now = time.time() * 1000
+    tat = max(cache.get(key) or 0, now)
+    allow_at = tat + interval - burst
+    if now < allow_at:
+        return 0, allow_at - now
+    cache.set(key, tat + interval, timeout=(tat + interval - now) / 1000)
+    return 1, 0
+
+
+class GCRAThrottle(BaseThrottle):
+    """
+    Default throttle for every endpoint: one bucket per user (or client IP)
+    and rate name, see the module docstring.
+    """
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def get_rate_name(self, request, view):
+        rates = getattr(settings, "REST_FRAMEWORK", {}).get("DEFAULT_THROTTLE_RATES", {})
+        scope = getattr(view, "throttle_scope", None)
+        action = getattr(view, "action", None)
+        candidates = [f"{scope}.{action}", scope] if scope and action else [scope] if scope else []
+        candidates.append("user" if request.user and request.user.is_authenticated else "anon")
+        for name in candidates:
+            if rates.get(name):
+                return name, rates[name]
+        return None, None
+
+    def get_bucket(self, request, name):
+        if request.user and request.user.is_authenticated:
+            return f"throttle:{name}:{request.user.pk}"
+        return f"throttle:{name}:{self.get_ident(request)}"
+
+    def allow_request(self, request, view):
+        name, rate = self.get_rate_name(request, view)
+        if rate is None:
+            return True
+        num, duration = parse_rate(rate)
+        self.wait_seconds = hit(self.get_bucket(request, name), num, duration)
+        return self.wait_seconds is None
+
+    def wait(self):
+        return self.wait_seconds
@@ -0,0 +1,31 @@
+from pymongo.errors import PyMongoError
+
+_supported = {}
+
+
+def supports_transactions(db):
+    """
+    Multi-document transactions need a replica set or a sharded cluster;
+    standalone servers (and most local development setups) reject them.
+    """
+    client = db.client
+    key = id(client)
+    if key not in _supported:
+        try:
+            info = client.admin.command("ismaster")
+        except (PyMongoError, NotImplementedError):
+            info = {}
+        _supported[key] = bool(info.get("setName")) or info.get("msg") == "isdbgrid"
+    return _supported[key]
+
+
+def run_in_transaction(db, callback):
+    """
+    Run `callback(session)` inside a transaction when the deployment supports
+    one (retrying transient errors), otherwise call it with `session=None`.
+    Callbacks must therefore pass `session` through to every operation.
+    """
+    if supports_transactions(db):
+        with db.client.start_session() as session:
+            return session.with_transaction(callback)
+    return callback(None)
@@ -2,18 +2,24 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenRefreshView
 
+from .async_views import AsyncCartView, AsyncCategoryListView, AsyncProductDetailView, AsyncProductListView
 from .views import (
     RegisterView,
     LoginView,
     ProductViewSet,
     CategoryViewSet,
+    CategoryDeletionView,
     CartView,
     CartItemView,
     OrderView,
+    OrderListView,
     OrderStatusView,
+    OrderStatusBulkView,
     ApplyCouponView,
     CouponCreateView,
     LogoutView,
+    AnalyticsView,
+    MetricsView,
 )
 
 
@@ -26,11 +32,21 @@ urlpatterns = [
     path("login/", LoginView.as_view(), name="login"),
     path("logout/", LogoutView.as_view(), name="logout"),
     path("token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
+    path("categories/deletions/<str:id>/", CategoryDeletionView.as_view(), name="category-deletion"),
     path("cart/", CartView.as_view(), name="cart"),
     path("cart/item/", CartItemView.as_view(), name="cart-item-delete"),
     path("order/", OrderView.as_view(), name="order-create"),
+    path("orders/", OrderListView.as_view(), name="order-list"),
     path("order/status/", OrderStatusView.as_view(), name="order-status"),
+    path("order/status/bulk/", OrderStatusBulkView.as_view(), name="order-status-bulk"),
     path("order/apply-coupon/", ApplyCouponView.as_view(), name="apply-coupon"),
     path("coupon/create/", CouponCreateView.as_view(), name="coupon-create"),
+    path("analytics/", AnalyticsView.as_view(), name="analytics"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
+    # ASGI-only async read paths (see api/async_views.py)
+    path("async/products/", AsyncProductListView.as_view(), name="async-product-list"),
+    path("async/products/<str:id>/", AsyncProductDetailView.as_view(), name="async-product-detail"),
+    path("async/categories/", AsyncCategoryListView.as_view(), name="async-category-list"),
+    path("async/cart/", AsyncCartView.as_view(), name="async-cart"),
     path("", include(router.urls)),
 ]
@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import User
+
+DEFAULTS = {
+    # Entries kept in the per-process LRU in front of the shared cache.
+    "LOCAL_SIZE": 1024,
+    # Seconds an entry may be served from the per-process LRU. Other
+    # processes only see an invalidation once this expires, so keep it short.
+    "LOCAL_TTL": 30,
+    # Seconds an entry lives in the shared cache.
+    "TTL": 300,
+    # Build the user from signed token claims and never touch the database.
+    "FROM_CLAIMS": False,
+}
+
+# Only what authentication and permission checks read.
+AUTH_FIELDS = ("email", "is_admin")
+
+
+def get_setting(name):
+    return getattr(settings, "AUTH_USER_CACHE", {}).get(name, DEFAULTS[name])
+
+
+class LRUCache:
+    """ Small thread-safe LRU with a per-entry TTL """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_local = LRUCache(get_setting("LOCAL_SIZE"), get_setting("LOCAL_TTL"))
+
+
+def _cache_key(user_id):
+    return f"authuser:{user_id}"
+
+
+def build_user(fields):
+    """
+    Build an unsaved-looking `User` from cached fields without a query.
+
+    The instance is a real document, so it can still be used as a reference
+    value (e.g. `Cart.objects(user=request.user)`).
+    """
+    return User._from_son({
+        "_id": ObjectId(fields["id"]),
+        "email": fields.get("email"),
+        "is_admin": bool(fields.get("is_admin", False)),
+    })
+
+
+def get_user(user_id):
+    """ Resolve a user id through the local LRU, the shared cache, then MongoDB """
+    user_id = str(user_id)
+    fields = _local.get(user_id)
+    if fields is None:
+        fields = cache.get(_cache_key(user_id))
+        if fields is None:
+            try:
+                doc = User.objects(id=ObjectId(user_id)).only(*AUTH_FIELDS).as_pymongo().first()
+            except (InvalidId, TypeError):
+                return None
+            if doc is None:
+                return None
+            fields = {"id": user_id, **{name: doc.get(name) for name in AUTH_FIELDS}}
+            cache.set(_cache_key(user_id), fields, timeout=get_setting("TTL"))
+        _local.set(user_id, fields)
+    return build_user(fields)
+
+
+async def aget_user(user_id):
+    """ `get_user()` for async views, querying MongoDB through motor """
+    from .async_mongo import get_collection
+
+    user_id = str(user_id)
+    fields = _local.get(user_id)
+    if fields is None:
+        fields = await cache.aget(_cache_key(user_id))
+        if fields is None:
+            try:
+                query = {"_id": ObjectId(user_id)}
+            except (InvalidId, TypeError):
+                return None
+            doc = await get_collection(User).find_one(query, {name: 1 for name in AUTH_FIELDS})
+            if doc is None:
+                return None
+            fields = {"id": user_id, **{name: doc.get(name) for name in AUTH_FIELDS}}
+            await cache.aset(_cache_key(user_id), fields, timeout=get_setting("TTL"))
+        _local.set(user_id, fields)
+    return build_user(fields)
+
+
+def user_from_claims(validated_token):
+    """ Build the user straight from the signed token (see `token_claims`) """
+    try:
+        return build_user({
+            "id": validated_token["user_id"],
+            "email": validated_token.get("email"),
+            "is_admin": validated_token.get("is_admin", False),
+        })
+    except (InvalidId, TypeError, KeyError):
+        return None
+
+
+def token_claims(user):
+    """ Extra claims embedded at login so `FROM_CLAIMS` mode needs no lookup """
+    return {name: getattr(user, name) for name in AUTH_FIELDS}
+
+
+def invalidate_user(user_id):
+    user_id = str(user_id)
+    _local.pop(user_id)
+    cache.delete(_cache_key(user_id))
@@ -1,28 +1,62 @@
-from datetime import datetime
+from datetime import timedelta
 
-from django.core.cache import cache
+from bson import ObjectId
+from django.conf import settings
 from django.contrib.auth.hashers import make_password
+from django.http import HttpResponse, StreamingHttpResponse
 
 from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from rest_framework.throttling import UserRateThrottle, AnonRateThrottle
+from rest_framework.utils.urls import replace_query_param
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from .models import User, Product, Cart, Category, CartItem, Order, Coupon
+from . import cart_ops, catalog_io, category_purge, checkout, coupons, fieldsets, inventory, metrics, order_history, order_status, rollups, search
+from .caching import (
+    CATALOG,
+    CATEGORY_LIST,
+    PRODUCT_LIST,
+    TagCachedViewSetMixin,
+    cart_tag,
+    category_tag,
+    check_if_match,
+    entity_tag,
+    get_generations,
+    invalidate_cart,
+    invalidate_orders,
+    invalidate_product,
+    none_match,
+    not_modified,
+    orders_tag,
+    product_tag,
+)
+from .catalog_snapshot import CategorySnapshotMixin, ProductSnapshotMixin
+from .fast_render import CATEGORY_ROWS, ORDER_ROWS, PRODUCT_ROWS, FastListMixin
+from .fieldsets import SparseFieldsetMixin
+from .filters import parse_date_range, parse_product_filters
+from .models import User, Product, Cart, Category, CategoryDeletion, Order, Coupon
+from .pagination import OrderKeysetPagination, ProductKeysetPagination
 from .serializers import (
     UserSerializer,
     ProductSerializer,
     CategorySerializer,
+    CategoryDeletionSerializer,
     CartItemSerializer,
     CartSerializer,
     OrderSerializer,
+    OrderSummarySerializer,
     CouponSerializer,
 )
+from .tasks import drain_outbox, purge_category
+from .user_cache import token_claims
 
 
 class RegisterView(APIView):
+    throttle_scope = "auth"
+
     def post(self, request):
         serializer = UserSerializer(data=request.data)
         if serializer.is_valid():
@@ -31,6 +65,8 @@ class RegisterView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class LoginView(APIView):
+    throttle_scope = "auth"
+
     def post(self, request):
         email = request.data.get("email")
         password = request.data.get("password")
@@ -39,6 +75,8 @@ class LoginView(APIView):
             user = User.objects.get(email=email)
             if user.check_password(password):
                 refresh = RefreshToken.for_user(user)
+                for claim, value in token_claims(user).items():
+                    refresh[claim] = value
                 return Response({
                     "refresh": str(refresh),
                     "access": str(refresh.access_token),
@@ -48,8 +86,7 @@ class LoginView(APIView):
         
         return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
 
-# Without Using Caching
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(ProductSnapshotMixin, TagCachedViewSetMixin, SparseFieldsetMixin, FastListMixin, viewsets.ModelViewSet):
     """
     API to manage products: Add, Edit, Delete, and Fetch.
     """
@@ -57,88 +94,175 @@ class ProductViewSet(viewsets.ModelViewSet):
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticated]
     lookup_field = "id"  
-    throttle_classes = [UserRateThrottle, AnonRateThrottle]
+    throttle_scope = "products"
+    pagination_class = ProductKeysetPagination
+    cache_prefix = "product"
+    fast_list_converter = PRODUCT_ROWS
+    sparse_actions = ("list", "retrieve", "search")
+
+    def get_queryset(self):
+        # DRF only re-clones Django querysets; without .all() the class-level
+        # MongoEngine queryset would keep its result cache across requests.
+        queryset = super().get_queryset().all()
+        if self.action != "list":
+            return queryset
+
+        category, min_price, max_price = parse_product_filters(self.request.query_params)
+        if category:
+            queryset = queryset.filter(category=category)
+        if min_price is not None:
+            queryset = queryset.filter(price__gte=min_price)
+        if max_price is not None:
+            queryset = queryset.filter(price__lte=max_price)
+        return queryset
+
+    def get_cache_tags(self):
+        if self.detail:
+            return [product_tag(self.kwargs[self.lookup_field]), CATALOG]
+        return [PRODUCT_LIST, CATALOG]
+
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        """
+        Full-text search over name/description with category and price-range
+        facets. Hot queries are cached briefly.
+        """
+        return self.cached_response(
+            self.search_products, request, timeout=getattr(settings, "SEARCH_CACHE_TIMEOUT", 30)
+        )
+
+    def search_products(self, request):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response({"q": "This query parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        category, min_price, max_price = parse_product_filters(request.query_params)
+        encoded = request.query_params.get("cursor")
+        fields = self.get_fieldset()
+        results, next_cursor, facets = search.search_products(
+            query,
+            category=category,
+            min_price=min_price,
+            max_price=max_price,
+            cursor=search.decode_cursor(encoded) if encoded else None,
+            page_size=self.paginator.get_page_size(request),
+            fields=None if fields is None else fieldsets.document_fields(ProductSerializer, fields),
+        )
+
+        data = {"next": None, "results": self.get_serializer_class()(results, many=True).data}
+        if next_cursor:
+            data["next"] = replace_query_param(request.build_absolute_uri(), "cursor", next_cursor)
+        if facets is not None:
+            data["facets"] = facets
+        return Response(data)
+
+    @action(detail=False, methods=["post"], url_path="import", permission_classes=[IsAuthenticated, IsAdminUser])
+    def bulk_import(self, request):
+        """ Upsert products from an NDJSON request body, one product per line """
+        report = catalog_io.import_products(request.stream or [])
+        return Response(report.as_dict(), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["get"], url_path="export", permission_classes=[IsAuthenticated, IsAdminUser])
+    def bulk_export(self, request):
+        return StreamingHttpResponse(catalog_io.export_products(), content_type="application/x-ndjson")
 
     def destroy(self, request, *args, **kwargs):
         product = self.get_object()
         product.delete()
+        invalidate_product(product.id)
         return Response({"message": "Product deleted successfully"}, status=status.HTTP_204_NO_CONTENT)
 
-## Using Caching
-# class ProductViewSet(viewsets.ModelViewSet):
-#     """
-#     API to manage products: Add, Edit, Delete, and Fetch.
-#     """
-#     queryset = Product.objects.all()
-#     serializer_class = ProductSerializer
-
-#     def list(self, request, *args, **kwargs):
-#         cache_key = "product_list"
-#         cached_data = cache.get(cache_key)
-
-#         if cached_data:
-#             return Response(cached_data)
-
-#         queryset = self.get_queryset()
-#         serializer = self.get_serializer(queryset, many=True)
-#         cache.set(cache_key, serializer.data, timeout=300)  # Cache for 5 minutes (300 sec)
-
-#         return Response(serializer.data)
-
-#     def retrieve(self, request, *args, **kwargs):
-#         product_id = kwargs.get("pk")
-#         cache_key = f"product_{product_id}"
-#         cached_data = cache.get(cache_key)
-
-#         if cached_data:
-#             return Response(cached_data)
-
-#         instance = self.get_object()
-#         serializer = self.get_serializer(instance)
-#         cache.set(cache_key, serializer.data, timeout=300)  # Cache for 5 minutes
-
-#         return Response(serializer.data)
-
-#     def destroy(self, request, *args, **kwargs):
-#         response = super().destroy(request, *args, **kwargs)
-#         cache.delete("product_list")
-#         return response
-
-#     def update(self, request, *args, **kwargs):
-#         response = super().update(request, *args, **kwargs)
-#         product_id = kwargs.get("pk")
-#         cache.delete(f"product_{product_id}")
-#         cache.delete("product_list")
-#         return response
-
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(CategorySnapshotMixin, TagCachedViewSetMixin, SparseFieldsetMixin, FastListMixin, viewsets.ModelViewSet):
     """
     API to manage categories: Add, Edit, Delete, and Fetch.
     """
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
+    throttle_scope = "categories"
+    cache_prefix = "category"
+    fast_list_converter = CATEGORY_ROWS
+
+    def get_queryset(self):
+        # Categories being deleted are gone as far as the API is concerned.
+        return super().get_queryset().filter(deleted_at=None)
+
+    def get_cache_tags(self):
+        if self.detail:
+            return [category_tag(self.kwargs[self.lookup_url_kwarg or self.lookup_field])]
+        return [CATEGORY_LIST]
+
+    def destroy(self, request, *args, **kwargs):
+        """
+        Tombstone the category and purge its products in the background
+        (api/category_purge.py); `?reassign_to=<category id>` moves them there
+        instead. Answers 202 with the job, whose progress is at `Location`.
+        """
+        category = self.get_object()
+        reassign_to = request.query_params.get("reassign_to")
+        if reassign_to is not None:
+            if not ObjectId.is_valid(reassign_to) or ObjectId(reassign_to) == category.id \
+                    or not Category.objects(id=reassign_to, deleted_at=None).only("id").first():
+                return Response({"reassign_to": "Must be another existing category."}, status=status.HTTP_400_BAD_REQUEST)
+            reassign_to = ObjectId(reassign_to)
+
+        deletion = category_purge.start(category.id, reassign_to)
+        if deletion is None:
+            return Response({"error": "Category not found"}, status=status.HTTP_404_NOT_FOUND)
+        purge_category.delay(str(deletion.id))
+        location = reverse("category-deletion", kwargs={"id": deletion.id}, request=request)
+        return Response(CategoryDeletionSerializer(deletion).data, status=status.HTTP_202_ACCEPTED, headers={"Location": location})
+
+    @action(detail=False, methods=["post"], url_path="import")
+    def bulk_import(self, request):
+        """ Upsert categories from an NDJSON request body, one category per line """
+        report = catalog_io.import_categories(request.stream or [])
+        return Response(report.as_dict(), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["get"], url_path="export")
+    def bulk_export(self, request):
+        return StreamingHttpResponse(catalog_io.export_categories(), content_type="application/x-ndjson")
+
+class CategoryDeletionView(APIView):
+    """ Progress of a category deletion started by `DELETE /api/categories/<id>/` """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    throttle_scope = "categories"
+
+    def get(self, request, id):
+        deletion = CategoryDeletion.objects(id=id).first() if ObjectId.is_valid(id) else None
+        if deletion is None:
+            return Response({"error": "Category deletion not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(CategoryDeletionSerializer(deletion).data)
 
 class CartView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = "cart"
 
     def get(self, request):
-        cart = Cart.objects(user=request.user).first()
+        """ The cart; `?fields=`/`?exclude=` select top-level fields (see api/fieldsets.py) """
+        fields = fieldsets.parse(request.query_params, CartSerializer)
+        etag = entity_tag(get_generations([cart_tag(request.user.id)]), request, detail=True)
+        if none_match(request, etag):
+            return not_modified(etag)
+        cart = cart_ops.get_cart(request.user.id, fieldsets.projection(CartSerializer, fields))
         if not cart:
             return Response({"message": "Cart is empty."}, status=status.HTTP_404_NOT_FOUND)
-        serializer = CartSerializer(cart)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        serializer = fieldsets.serializer_for(CartSerializer, fields)(cart_ops.as_cart_data(cart))
+        return Response(serializer.data, status=status.HTTP_200_OK, headers={"ETag": etag})
 
     def delete(self, request):
-        cart = Cart.objects(user=request.user).first()
-        if cart:
-            cart.items = []
-            cart.save()
+        check_if_match(request, [cart_tag(request.user.id)])
+        if inventory.enabled():
+            inventory.release(inventory.cart_reservation(request.user.id))
+        cleared = cart_ops.clear(request.user.id)
+        invalidate_cart(request.user.id)
+        if cleared:
             return Response({"message": "Cart cleared successfully."}, status=status.HTTP_200_OK)
         return Response({"message": "Cart is already empty."}, status=status.HTTP_404_NOT_FOUND)
 
 class CartItemView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = "cart"
 
     def post(self, request):
         serializer = CartItemSerializer(data=request.data)
@@ -146,22 +270,33 @@ class CartItemView(APIView):
             product_id = serializer.validated_data['product']
             quantity = serializer.validated_data['quantity']
 
-            product = Product.objects(id=product_id).first()
-            if not product:
+            snapshot = cart_ops.product_snapshot(product_id)
+            if not snapshot:
                 return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
 
-            cart = Cart.objects(user=request.user).first()
-            if not cart:
-                cart = Cart(user=request.user, items=[])
-            
-            existing_item = next((item for item in cart.items if str(item.product.id) == product_id), None)
-            if existing_item:
-                existing_item.quantity += quantity  
-            else:
-                cart.items.append(CartItem(product=product, quantity=quantity))
-
-            cart.save()
-            return Response({"message": "Item added to cart"}, status=status.HTTP_200_OK)
+            check_if_match(request, [cart_tag(request.user.id)])
+
+            if inventory.enabled():
+                try:
+                    inventory.reserve(inventory.cart_reservation(request.user.id), {product_id: quantity})
+                except inventory.OutOfStock:
+                    return Response({"error": "Insufficient stock"}, status=status.HTTP_409_CONFLICT)
+                except Product.DoesNotExist:
+                    # Deleted since the snapshot was read.
+                    return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+
+            try:
+                cart = cart_ops.add_item(request.user.id, snapshot, quantity)
+            except Exception:
+                if inventory.enabled():
+                    # Not in the cart, so checkout would never sell it.
+                    inventory.unreserve(inventory.cart_reservation(request.user.id), {product_id: quantity})
+                raise
+            invalidate_cart(request.user.id)
+            return Response(
+                {"message": "Item added to cart", "cart": CartSerializer(cart_ops.as_cart_data(cart)).data},
+                status=status.HTTP_200_OK
+            )
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -171,43 +306,97 @@ class CartItemView(APIView):
         if not product_id:
             return Response({"error": "Product ID is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        cart = Cart.objects(user=request.user).first()
-        if not cart:
-            return Response({"error": "Cart not found"}, status=status.HTTP_404_NOT_FOUND)
-
-        filtered_items = [item for item in cart.items if str(item.product.id) != product_id]
+        if not ObjectId.is_valid(product_id):
+            return Response({"error": "Invalid product ID"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if len(filtered_items) == len(cart.items):
+        check_if_match(request, [cart_tag(request.user.id)])
+        cart = cart_ops.remove_item(request.user.id, product_id)
+        invalidate_cart(request.user.id)
+        if not cart:
+            if not Cart.objects(user=request.user).only("id").first():
+                return Response({"error": "Cart not found"}, status=status.HTTP_404_NOT_FOUND)
             return Response({"error": "Product not in cart"}, status=status.HTTP_404_NOT_FOUND)
 
-        cart.items = filtered_items
-        cart.save()
-        
-        return Response({"message": "Item removed from cart"}, status=status.HTTP_200_OK)
+        if inventory.enabled():
+            inventory.release(inventory.cart_reservation(request.user.id), [product_id])
+        return Response(
+            {"message": "Item removed from cart", "cart": CartSerializer(cart_ops.as_cart_data(cart)).data},
+            status=status.HTTP_200_OK
+        )
 
 class OrderView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = "orders"
 
     def post(self, request):
-        user = request.user
-        cart = Cart.objects(user=user).first()
-
-        if not cart or not cart.items:
-            return Response({"error": "Cart is empty"}, status=status.HTTP_400_BAD_REQUEST)
-
-        items = [{"product": str(item.product.id), "quantity": item.quantity, "price": item.product.price} for item in cart.items]
-        total_price = sum(item["quantity"] * item["price"] for item in items)
-
-        order = Order(user=user, items=items, total_price=total_price)
-        order.save()
+        try:
+            order = checkout.place_order(request.user)
+        except checkout.CheckoutError as exc:
+            return Response(exc.as_response_data(), status=exc.status_code)
+
+        invalidate_cart(request.user.id)
+        invalidate_orders(request.user.id)
+        if not inventory.enabled():
+            # Stock is part of the product payload; with Redis inventory the
+            # reconciler bumps these when it writes stock back.
+            for item in order["items"]:
+                invalidate_product(item["product"])
+        # Not part of the order write; rebuild_recent_rollups repairs a
+        # delta lost to a crash here.
+        rollups.record_order(order)
+        drain_outbox.delay()
+        return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
 
-        cart.items = []
-        cart.save()
+class OrderListView(APIView):
+    """
+    The user's orders, newest first: keyset-paginated on (user, created_at),
+    filtered by `?status=`, with `?fields=`/`?exclude=` and a `summary` of
+    all their orders (api/order_history.py). Admins can pass `?user=<id>`.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_scope = "order_history"
+    pagination_class = OrderKeysetPagination
 
-        return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
+    def get(self, request):
+        user_id = request.user.id
+        if request.user.is_admin and "user" in request.query_params:
+            user_id = request.query_params["user"]
+            if not ObjectId.is_valid(user_id):
+                return Response({"user": "Invalid user ID"}, status=status.HTTP_400_BAD_REQUEST)
+
+        query = {"user": ObjectId(user_id)}
+        order_status_filter = request.query_params.get("status")
+        if order_status_filter:
+            if order_status_filter not in Order.STATUS_CHOICES:
+                return Response(
+                    {"status": f"Must be one of: {', '.join(Order.STATUS_CHOICES)}"}, status=status.HTTP_400_BAD_REQUEST
+                )
+            query["status"] = order_status_filter
+        converter = ORDER_ROWS.subset(fieldsets.parse(request.query_params, OrderSerializer))
+
+        tag = orders_tag(user_id)
+        generations = get_generations([tag])
+        etag = entity_tag(generations, request)
+        if none_match(request, etag):
+            return not_modified(etag)
+
+        paginator = self.pagination_class()
+        query, sort, limit = paginator.get_raw_query(request, query)
+        projection = {field: 1 for field in (*converter.fields, *paginator.get_sort_fields(request))}
+        page = paginator.set_page(list(Order._get_collection().find(query, projection).sort(sort).limit(limit)))
+        return Response(
+            {
+                "next": paginator.get_next_link(),
+                "summary": OrderSummarySerializer(order_history.get_summary(user_id, generations[tag])).data,
+                "results": converter.convert(page),
+            },
+            status=status.HTTP_200_OK,
+            headers={"ETag": etag},
+        )
 
 class OrderStatusView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = "orders"
     allowed_statuses = {'Pending', 'Shipped', 'Delivered', 'Cancelled'}
 
     def post(self, request):
@@ -226,41 +415,66 @@ class OrderStatusView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        order = Order.objects(id=order_id).first()
-        if not order:
+        try:
+            previous = order_status.set_status(order_id, new_status) if ObjectId.is_valid(order_id) else None
+        except order_status.InvalidTransition as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_409_CONFLICT)
+        if previous is None:
             return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
-
-        order.status = new_status
-        order.save()
+        if previous != new_status:
+            rollups.record_status_change(order_id, previous, new_status)
+            # Deliver the notification now rather than on the next beat.
+            drain_outbox.delay()
 
         return Response({"message": "Order status updated successfully", "status": new_status}, status=status.HTTP_200_OK)
 
-class ApplyCouponView(APIView):
-    permission_classes = [IsAuthenticated]
 
-    def post(self, request):
-        code = request.data.get("code")
-        order_id = request.data.get("order_id")
+class OrderStatusBulkView(APIView):
+    """
+    Many status changes per call: `{"changes": [{"order_id": ..., "status": ...}, ...]}`,
+    up to `order_status.MAX_BULK_CHANGES`. Each change is reported on its own;
+    one that is invalid or out of order does not stop the others.
+    """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    throttle_scope = "order_status_bulk"
 
-        order = Order.objects(id=order_id).first()
-        if not order:
-            return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
+    def post(self, request):
+        changes = request.data.get("changes") if isinstance(request.data, dict) else None
+        if not isinstance(changes, list) or not changes:
+            return Response({"error": "changes must be a non-empty list"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(changes) > order_status.MAX_BULK_CHANGES:
+            return Response(
+                {"error": f"At most {order_status.MAX_BULK_CHANGES} changes per request"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        coupon = Coupon.objects(code=code).first()
-        if not coupon:
-            return Response({"error": "Invalid coupon code"}, status=status.HTTP_400_BAD_REQUEST)
+        report = order_status.set_statuses(
+            (change.get("order_id"), change.get("status")) if isinstance(change, dict) else (None, None)
+            for change in changes
+        )
+        updated = [item for item in report if item["result"] == order_status.UPDATED]
+        if updated:
+            rollups.record_status_changes((item["order_id"], item["previous"], item["status"]) for item in updated)
+            drain_outbox.delay()
+        return Response({"updated": len(updated), "results": report}, status=status.HTTP_200_OK)
 
-        if coupon.expiry_date < datetime.utcnow():
-            return Response({"error": "Coupon has expired"}, status=status.HTTP_400_BAD_REQUEST)
+class ApplyCouponView(APIView):
+    permission_classes = [IsAuthenticated]
+    throttle_scope = "coupons"
 
-        discount_amount = (order.total_price * coupon.discount_percentage) / 100
-        order.total_price -= discount_amount
-        order.save()
+    def post(self, request):
+        try:
+            order, new_total = coupons.redeem(request.data.get("code"), request.data.get("order_id"), request.user)
+        except coupons.RedemptionError as exc:
+            return Response(exc.as_response_data(), status=exc.status_code)
 
-        return Response({"message": "Coupon applied", "new_total": order.total_price}, status=status.HTTP_200_OK)
+        rollups.record_revenue_change(rollups.placed_at(order), order["status"], order["total_price"], new_total)
+        invalidate_orders(order["user"])
+        return Response({"message": "Coupon applied", "new_total": new_total}, status=status.HTTP_200_OK)
 
 class CouponCreateView(APIView):
     permission_classes = [IsAuthenticated, IsAdminUser]  
+    throttle_scope = "coupons"
 
     def post(self, request):
         serializer = CouponSerializer(data=request.data)
@@ -278,6 +492,37 @@ class CouponCreateView(APIView):
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class AnalyticsView(APIView):
+    """
+    Sales rollups for a date range: `?granularity=day|hour&start=&end=`
+    (see `parse_date_range`). Defaults to the last 30 days by day.
+    """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    throttle_scope = "analytics"
+    max_periods = {"day": 366, "hour": 31 * 24}
+
+    def get(self, request):
+        granularity = request.query_params.get("granularity", "day")
+        if granularity not in self.max_periods:
+            return Response({"granularity": "Must be 'day' or 'hour'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        start, end = parse_date_range(request.query_params)
+        step = timedelta(days=1) if granularity == "day" else timedelta(hours=1)
+        if (end - start) / step > self.max_periods[granularity]:
+            return Response(
+                {"error": f"At most {self.max_periods[granularity]} {granularity} periods per request"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(rollups.summarize(granularity, start, end), status=status.HTTP_200_OK)
+
+class MetricsView(APIView):
+    """ Per-view request metrics in the Prometheus text format (api/metrics.py) """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    throttle_classes = []
+
+    def get(self, request):
+        return HttpResponse(metrics.render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 class LogoutView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -13,6 +13,9 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 from pathlib import Path
 from datetime import timedelta
 import mongoengine
+from celery.schedules import crontab
+
+from api.metrics import MongoCommandListener
 
 # from mongoengine import connect
 
@@ -55,6 +58,7 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    'api.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -106,7 +110,13 @@ WSGI_APPLICATION = 'e_commerce_api.wsgi.application'
 #     }
 # }
 
-mongoengine.connect("ecommerce_db", host="mongodb://localhost:27017/")
+MONGODB_NAME = "ecommerce_db"
+MONGODB_HOST = "mongodb://localhost:27017/"
+# Connection pool size of the motor client used by the async views (api/async_mongo.py)
+MONGODB_ASYNC_MAX_POOL_SIZE = 100
+
+# The listener feeds per-request MongoDB command counts to api/metrics.py
+mongoengine.connect(MONGODB_NAME, host=MONGODB_HOST, event_listeners=[MongoCommandListener()])
 
 AUTHENTICATION_BACKENDS = ['ecommerce.auth_backend.MongoUserBackend']
 
@@ -114,18 +124,52 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'api.jwt_auth.MongoDBJWTAuthentication', 
     ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.MongoJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    # GCRA in one Redis call (api/throttling.py). A view's `throttle_scope`
+    # picks its rate: '<scope>.<action>', then '<scope>', then user/anon.
+    'DEFAULT_THROTTLE_CLASSES': (
+        'api.throttling.GCRAThrottle',
+    ),
     'DEFAULT_THROTTLE_RATES': {
         'user': '100/hour',  
         'anon': '10/minute', 
+        'auth': '10/minute',
+        'products': '100/hour',
+        'categories': '1000/hour',
+        'cart': '600/hour',
+        'orders': '100/hour',
+        'order_history': '600/hour',
+        'order_status_bulk': '600/hour',
+        'coupons': '60/hour',
+        'analytics': '300/hour',
     }
 }
 
+# Throttle state lives on this django-redis connection (api/throttling.py)
+THROTTLING = {
+    'REDIS_ALIAS': 'default',
+    'LOCAL_SIZE': 4096,
+}
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1),
     'USER_ID_FIELD': 'id', 
     'USER_ID_CLAIM': 'user_id',
 }
 
+# Resolution cache for the JWT-authenticated user (api/user_cache.py)
+AUTH_USER_CACHE = {
+    'LOCAL_SIZE': 1024,
+    'LOCAL_TTL': 30,
+    'TTL': 300,
+    # When True, request.user is built from the token's email/is_admin claims
+    # and is_admin changes only take effect once the user logs in again.
+    'FROM_CLAIMS': False,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -169,7 +213,8 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        # django_redis.cache.RedisCache plus hit/miss metrics
+        "BACKEND": "api.cache_backends.RedisCache",
         "LOCATION": "redis://127.0.0.1:6379/1",  # Change to the Redis URL if hosted remotely
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
@@ -177,10 +222,79 @@ CACHES = {
     }
 }
 
+# Request metrics (api/metrics.py), scraped from /api/metrics/ by admins
+METRICS = {
+    'ENABLED': True,
+    # Add a Server-Timing header (and X-N-Plus-One when flagged) to responses
+    'SERVER_TIMING_HEADER': False,
+    # Requests repeating one read on one collection this often count as N+1
+    'N_PLUS_ONE_THRESHOLD': 5,
+}
+
+# Seconds a cached catalog response lives; writes invalidate earlier (api/caching.py)
+CATALOG_CACHE_TIMEOUT = 300
+# Serve product/category lists from raw projected rows instead of the
+# serializers (api/fast_render.py); output is byte-identical either way
+FAST_LIST_RESPONSES = True
+
+# Keep the catalog in each worker's memory and serve product/category list
+# and detail reads from it (api/catalog_snapshot.py)
+CATALOG_SNAPSHOT = {
+    'ENABLED': False,
+    # Seconds between checks of the catalog version in the cache
+    'CHECK_INTERVAL': 1.0,
+    # Seconds before a refresh even without a version change (raw writes
+    # that skip the cache invalidation)
+    'MAX_AGE': 300,
+    # Larger catalogs are read from MongoDB instead
+    'MAX_PRODUCTS': 200000,
+}
+
+# Stock reservations held in Redis (api/inventory.py). The keys have no TTL,
+# so the Redis behind REDIS_ALIAS must not evict them (e.g. noeviction).
+INVENTORY = {
+    'ENABLED': False,
+    'REDIS_ALIAS': 'default',
+    # Seconds a cart's hold lasts after its last change
+    'CART_RESERVATION_TTL': 15 * 60,
+    'FLUSH_BATCH_SIZE': 500,
+    'SWEEP_BATCH_SIZE': 1000,
+}
+
+# Seconds a product search response (results and facets) is cached
+SEARCH_CACHE_TIMEOUT = 30
+# Seconds a user's order summary is cached; new orders, status changes and
+# coupons invalidate earlier (api/order_history.py)
+ORDER_SUMMARY_CACHE_TIMEOUT = 3600
+
 CELERY_BEAT_SCHEDULE = {
-    "send_order_status_notifications": {
-        "task": "orders.tasks.send_periodic_order_status_updates",
-        "schedule": 3600.0,  # Runs every hour (3600 seconds)
+    # Status notifications are queued as they happen (api/outbox.py); this
+    # only picks up retries and deliveries whose drain_outbox.delay() was lost.
+    "drain_outbox": {
+        "task": "api.tasks.drain_outbox",
+        "schedule": 60.0,
+    },
+    # Expires cart holds and writes sold stock back to products; a no-op
+    # unless INVENTORY['ENABLED']
+    "reconcile_inventory": {
+        "task": "api.tasks.reconcile_inventory",
+        "schedule": 30.0,
+    },
+    # Safety net for snapshot refreshes that were never enqueued
+    "refresh_cart_snapshots": {
+        "task": "api.tasks.refresh_cart_snapshots",
+        "schedule": 6 * 3600.0,
+    },
+    # Picks up category deletions whose purge_category task was lost
+    "resume_category_deletions": {
+        "task": "api.tasks.resume_category_deletions",
+        "schedule": 300.0,
+    },
+    # Sales rollups are updated after the order write commits; recomputing
+    # the last closed days from orders repairs deltas a crash dropped
+    "rebuild_recent_rollups": {
+        "task": "api.tasks.rebuild_recent_rollups",
+        "schedule": crontab(hour=0, minute=15),
     },
 }
 